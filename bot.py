@@ -2,10 +2,13 @@
 import os
 import time
 import asyncio
+from datetime import datetime, timezone
 import json
-from typing import Optional, Dict, Any
+from collections import deque, OrderedDict
+from typing import Optional, Dict, Any, Callable, Awaitable
 
-from aiogram import Bot, Dispatcher, F
+import httpx
+from aiogram import Bot, Dispatcher, F, BaseMiddleware
 from aiogram.client.default import DefaultBotProperties
 from aiogram.enums import ParseMode
 from aiogram.filters import Command, CommandStart
@@ -14,21 +17,21 @@ from aiogram.types import (
 	ReplyKeyboardMarkup, KeyboardButton,
 	InlineKeyboardMarkup, InlineKeyboardButton,
 	CallbackQuery,
+	TelegramObject,
 	FSInputFile,
-	URLInputFile,
+	BufferedInputFile,
+	InputFile,
 )
 
 from db import (
-	init_db, get_blocks, get_block,
-	inc_start, inc_message,
+	init_db, get_blocks, get_blocks_versioned, get_block,
+	flush_user_activity, reconcile_stats,
+	copy_events, ensure_event_partitions, drop_old_event_partitions,
+	add_stats_series, prune_stats_series,
 	upsert_job, fetch_due_jobs, mark_job_done,
-	get_flow_triggers,
 
-	# flow modes
-	get_flow_modes,
-
-	# flow actions
-	get_flow_actions,
+	# ✅ modes + triggers + actions одним снапшотом
+	get_config_snapshot,
 
 	# gate pressed + cancel reminder job
 	mark_gate_pressed,
@@ -38,8 +41,13 @@ from db import (
 	# for broadcasts (all users)
 	get_users,
 
-	# ✅ нужно для user-state (разблокировка уроков)
-	get_pool,
+	# ✅ user-state (разблокировка уроков)
+	get_user_state, mark_course_completed,
+
+	# ✅ LISTEN/NOTIFY из CRM (инвалидация кешей)
+	open_listener,
+	FLOW_CHANGED_CHANNEL,
+	CONFIG_CHANGED_CHANNEL,
 )
 
 BOT_TOKEN = os.getenv("BOT_TOKEN")
@@ -62,12 +70,9 @@ bot = Bot(BOT_TOKEN, default=DefaultBotProperties(parse_mode=ParseMode.HTML))
 dp = Dispatcher()
 
 _jobs_task: asyncio.Task | None = None
-
-# кеш режимов флоу
-_FLOW_MODES: dict[str, str] = {}
-
-# per-user lock, чтобы не было параллельного render_flow на одного юзера
-_USER_LOCKS: dict[int, asyncio.Lock] = {}
+_listener_task: asyncio.Task | None = None
+_activity_task: asyncio.Task | None = None
+_events_task: asyncio.Task | None = None
 
 # защита от дублей jobs пока задача в процессе
 _RUNNING_JOBS: set[int] = set()
@@ -75,28 +80,215 @@ _RUNNING_JOBS: set[int] = set()
 # ограничим общий параллелизм джобов, чтобы не убить бот/DB
 _JOB_SEM = asyncio.Semaphore(int(os.getenv("JOBS_CONCURRENCY", "25")))
 
-# как часто подтягивать режимы из БД (если в CRM переключили mode без рестарта бота)
+# fallback: как часто перечитывать конфиг, пока LISTEN-соединения нет
 _FLOW_MODES_REFRESH_SECONDS = int(os.getenv("FLOW_MODES_REFRESH_SECONDS", "20"))
 
 
-def _lock(uid: int) -> asyncio.Lock:
-	uid = int(uid)
-	if uid not in _USER_LOCKS:
-		_USER_LOCKS[uid] = asyncio.Lock()
-	return _USER_LOCKS[uid]
+# ─────────────────────────────────────────────────────────────
+# ✅ Config snapshot (modes + triggers + actions)
+#
+# Загружается один раз при старте и целиком подменяется, когда CRM
+# шлёт NOTIFY config_changed (set_flow_mode / set_flow_trigger / upsert_flow_action ...).
+# /start и jobs читают только память — ноль запросов к конфигу на юзера.
+
+class ConfigSnapshot:
+	__slots__ = ("modes", "auto_triggers", "actions_by_flow", "actions_by_id")
+
+	def __init__(self, modes: dict, auto_triggers: tuple, actions_by_flow: dict, actions_by_id: dict):
+		self.modes = modes                      # flow -> off/manual/auto
+		self.auto_triggers = auto_triggers      # ((flow, offset_seconds), ...) только mode=auto
+		self.actions_by_flow = actions_by_flow  # after_flow -> ((action_id, target_flow, delay), ...)
+		self.actions_by_id = actions_by_id      # action_id -> target_flow (только активные)
+
+	@classmethod
+	def build(cls, raw: dict) -> "ConfigSnapshot":
+		modes = {
+			(f or "").strip(): (m or "off").strip().lower()
+			for f, m in (raw.get("modes") or {}).items()
+			if (f or "").strip()
+		}
+
+		auto_triggers = []
+		for tr in raw.get("triggers") or []:
+			flow = (tr.get("flow") or "").strip()
+			offset_seconds = int(tr.get("offset_seconds") or 0)
+			if not flow or int(tr.get("is_active") or 0) != 1 or offset_seconds < 0:
+				continue
+			if modes.get(flow, "off") != "auto":
+				continue
+			auto_triggers.append((flow, offset_seconds))
+
+		actions_by_flow: dict[str, list] = {}
+		actions_by_id: dict[int, str] = {}
+		for a in raw.get("actions") or []:
+			if int(a.get("is_active", 0) or 0) != 1:
+				continue
+			if (a.get("action_type") or "start_flow") != "start_flow":
+				continue
+			target = (a.get("target_flow") or "").strip()
+			if not target:
+				continue
+			action_id = int(a.get("id") or 0)
+			delay = max(0, int(a.get("delay_seconds", 0) or 0))
+			after = (a.get("after_flow") or "").strip()
+			actions_by_flow.setdefault(after, []).append((action_id, target, delay))
+			if action_id > 0:
+				actions_by_id[action_id] = target
+
+		return cls(
+			modes,
+			tuple(auto_triggers),
+			{k: tuple(v) for k, v in actions_by_flow.items()},
+			actions_by_id,
+		)
+
+
+_CONFIG = ConfigSnapshot({}, (), {}, {})
+_config_reload_task: asyncio.Task | None = None
+_config_dirty = False
 
 
 def _mode(flow: str) -> str:
 	"""off/manual/auto (default off)"""
-	return (_FLOW_MODES.get((flow or "").strip()) or "off").strip().lower()
+	return _CONFIG.modes.get((flow or "").strip()) or "off"
+
+
+async def refresh_config() -> None:
+	global _CONFIG
+	try:
+		_CONFIG = ConfigSnapshot.build(await get_config_snapshot())
+	except Exception:
+		# оставляем предыдущий снапшот — лучше старый конфиг, чем пустой
+		pass
+
+
+async def _reload_config_coalesced() -> None:
+	global _config_dirty
+	while True:
+		_config_dirty = False
+		await refresh_config()
+		if not _config_dirty:
+			return
+
+
+def _schedule_config_reload() -> None:
+	"""Пачка NOTIFY подряд -> максимум одна лишняя перезагрузка."""
+	global _config_reload_task, _config_dirty
+	_config_dirty = True
+	if _config_reload_task is None or _config_reload_task.done():
+		_config_reload_task = asyncio.create_task(_reload_config_coalesced())
+
+
+def _on_config_changed(conn, pid, channel, payload) -> None:
+	_schedule_config_reload()
+
+
+# ─────────────────────────────────────────────────────────────
+# ✅ Flow content cache (версии flow + NOTIFY из CRM)
+#
+# Блоки flow меняются только когда админ редактирует их в CRM, поэтому
+# render_flow берёт из памяти готовый план (см. compile_flow_plan). CRM поднимает flow_versions.version и шлёт
+# NOTIFY — кеш сбрасывается сразу. Пока LISTEN-соединения нет, кеш не используется.
+
+_FLOW_CACHE: dict[str, "FlowPlan"] = {}
+_FLOW_VERSIONS: dict[str, int] = {}
+_listener_ready = False
+
+_LISTENER_PING_SECONDS = 15
+_LISTENER_RETRY_SECONDS = 3
 
 
-async def refresh_flow_modes() -> None:
-	global _FLOW_MODES
+def _on_flow_changed(conn, pid, channel, payload) -> None:
 	try:
-		_FLOW_MODES = await get_flow_modes()
+		data = json.loads(payload or "{}")
+		flow = (data.get("flow") or "").strip()
+		version = int(data.get("version") or 0)
 	except Exception:
-		_FLOW_MODES = {}
+		# непонятный payload — безопаснее забыть всё
+		_FLOW_CACHE.clear()
+		return
+
+	if not flow:
+		return
+
+	if version > _FLOW_VERSIONS.get(flow, 0):
+		_FLOW_VERSIONS[flow] = version
+	cached = _FLOW_CACHE.get(flow)
+	if cached and cached.version < version:
+		_FLOW_CACHE.pop(flow, None)
+
+
+def _reset_listener_caches() -> None:
+	_FLOW_CACHE.clear()
+	_FLOW_VERSIONS.clear()
+
+
+async def get_flow_plan(flow: str) -> "FlowPlan":
+	"""
+	Скомпилированный план flow — из памяти, если версия актуальна.
+	"""
+	flow = (flow or "").strip()
+	if not _listener_ready:
+		return compile_flow_plan(flow, 0, await get_blocks(flow))
+
+	cached = _FLOW_CACHE.get(flow)
+	if cached and cached.version >= _FLOW_VERSIONS.get(flow, 0):
+		return cached
+
+	version, blocks = await get_blocks_versioned(flow)
+	plan = compile_flow_plan(flow, version, blocks)
+	if version > _FLOW_VERSIONS.get(flow, 0):
+		_FLOW_VERSIONS[flow] = version
+	# NOTIFY мог прийти пока читали — тогда не кешируем устаревшее
+	if _listener_ready and version >= _FLOW_VERSIONS.get(flow, 0):
+		_FLOW_CACHE[flow] = plan
+	return plan
+
+
+def _listener_handlers() -> dict:
+	return {
+		FLOW_CHANGED_CHANNEL: _on_flow_changed,
+		CONFIG_CHANGED_CHANNEL: _on_config_changed,
+	}
+
+
+async def db_listener_loop():
+	"""
+	Держит одно LISTEN-соединение. При обрыве — сбрасывает кеши
+	(уведомления могли потеряться) и переподключается.
+	"""
+	global _listener_ready
+
+	try:
+		while True:
+			conn = None
+			try:
+				conn = await open_listener(_listener_handlers())
+				_reset_listener_caches()
+				_listener_ready = True
+				# пока LISTEN не было, изменения конфига могли пройти мимо
+				_schedule_config_reload()
+
+				while not conn.is_closed():
+					await asyncio.sleep(_LISTENER_PING_SECONDS)
+					await conn.execute("SELECT 1;", timeout=5)
+			except asyncio.CancelledError:
+				raise
+			except Exception:
+				pass
+			finally:
+				_listener_ready = False
+				_reset_listener_caches()
+				if conn is not None and not conn.is_closed():
+					try:
+						await conn.close(timeout=5)
+					except Exception:
+						pass
+
+			await asyncio.sleep(_LISTENER_RETRY_SECONDS)
+
+	except asyncio.CancelledError:
+		return
 
 
 # ─────────────────────────────────────────────────────────────
@@ -121,43 +313,47 @@ def _parse_delay_seconds(raw: Any) -> float:
 
 # ─────────────────────────────────────────────────────────────
 # ✅ user state (разблокировка "Уроки" после окончания курса)
+#
+# bot_users.state — JSONB. Горячие юзеры держатся в ограниченном LRU:
+# чтение меню/уроков не ходит в БД, запись идёт сразу в БД (jsonb_set)
+# и тем же результатом обновляет кеш (write-through).
+
+_USER_STATE_CACHE_SIZE = int(os.getenv("USER_STATE_CACHE_SIZE", "10000"))
+_USER_STATE_CACHE: OrderedDict[int, Dict[str, Any]] = OrderedDict()
+
+
+def _cache_user_state(user_id: int, state: Dict[str, Any]) -> None:
+	_USER_STATE_CACHE[user_id] = state
+	_USER_STATE_CACHE.move_to_end(user_id)
+	while len(_USER_STATE_CACHE) > _USER_STATE_CACHE_SIZE:
+		_USER_STATE_CACHE.popitem(last=False)
+
+
+def invalidate_user_state(user_id: int) -> None:
+	_USER_STATE_CACHE.pop(int(user_id), None)
+
 
 async def _get_user_state(user_id: int) -> Dict[str, Any]:
-	pool = await get_pool()
-	async with pool.acquire() as conn:
-		row = await conn.fetchrow("SELECT state FROM users WHERE user_id=$1;", int(user_id))
-		if not row:
-			await conn.execute(
-				"INSERT INTO users(user_id, state, flow_status, last_start_at, updated_at) "
-				"VALUES ($1,'{}','','','') ON CONFLICT (user_id) DO NOTHING;",
-				int(user_id),
-			)
-			return {}
-		raw = (row["state"] or "").strip()
-		if not raw:
-			return {}
-		try:
-			v = json.loads(raw)
-			return v if isinstance(v, dict) else {}
-		except Exception:
-			return {}
-
-
-async def _set_user_state(user_id: int, state: Dict[str, Any]) -> None:
-	pool = await get_pool()
-	js = json.dumps(state or {}, ensure_ascii=False)
-	now = str(int(time.time()))
-	async with pool.acquire() as conn:
-		await conn.execute(
-			"""
-			INSERT INTO users(user_id, state, flow_status, last_start_at, updated_at)
-			VALUES ($1,$2,'','','')
-			ON CONFLICT (user_id) DO UPDATE SET
-				state=EXCLUDED.state,
-				updated_at=$3;
-			""",
-			int(user_id), js, now
-		)
+	"""Не мутировать результат — это общий объект из кеша."""
+	uid = int(user_id)
+	st = _USER_STATE_CACHE.get(uid)
+	if st is not None:
+		_USER_STATE_CACHE.move_to_end(uid)
+		return st
+
+	st = await get_user_state(uid)
+	_cache_user_state(uid, st)
+	return st
+
+
+async def _complete_course(user_id: int) -> None:
+	uid = int(user_id)
+	try:
+		st = await mark_course_completed(uid)
+	except Exception:
+		invalidate_user_state(uid)
+		raise
+	_cache_user_state(uid, st)
 
 
 async def is_lessons_unlocked(user_id: int) -> bool:
@@ -169,8 +365,7 @@ async def unlock_lessons(user_id: int) -> None:
 	st = await _get_user_state(user_id)
 	if st.get("lessons_unlocked"):
 		return
-	st["lessons_unlocked"] = True
-	await _set_user_state(user_id, st)
+	await _complete_course(user_id)
 
 
 # ─────────────────────────────────────────────────────────────
@@ -267,15 +462,19 @@ def _resolve_local_path(file_path: str) -> str:
 	if not p:
 		return ""
 
-	if os.path.isabs(p):
+	if p.startswith("http://") or p.startswith("https://"):
+		return ""
+
+	if os.path.isabs(p) and os.path.isfile(p):
 		return p
 
-	cand = os.path.join(BASE_DIR, p)
-	if os.path.exists(cand):
+	# "/media/x.mp4" из CRM — это путь относительно проекта, а не корня FS
+	cand = os.path.join(BASE_DIR, p.lstrip("/"))
+	if os.path.isfile(cand):
 		return cand
 
 	cand2 = os.path.join(BASE_DIR, "media", os.path.basename(p))
-	if os.path.exists(cand2):
+	if os.path.isfile(cand2):
 		return cand2
 
 	return ""
@@ -326,52 +525,175 @@ def _ensure_filename_with_ext(file_name: str, file_path: str) -> str:
 	return fn
 
 
+# ─────────────────────────────────────────────────────────────
+# ✅ Media source policy
+#
+# 1) локальный файл (CRM и бот обычно живут рядом и видят одну папку media/)
+# 2) уже загруженный в Telegram file_id (чтобы не грузить один и тот же файл каждому)
+# 3) удалённый URL — через один общий keep-alive http-клиент с таймаутами;
+#    неудачные скачивания кешируем "негативно", чтобы битая ссылка
+#    не стоила таймаута на каждого получателя.
+
+_MEDIA_HTTP_TIMEOUT = float(os.getenv("MEDIA_HTTP_TIMEOUT", "20"))
+_MEDIA_MAX_BYTES = int(os.getenv("MEDIA_MAX_BYTES", str(50 * 1024 * 1024)))
+_MEDIA_FAIL_TTL_SECONDS = int(os.getenv("MEDIA_FAIL_TTL_SECONDS", "300"))
+
+_http: httpx.AsyncClient | None = None
+
+# url -> monotonic ts, до которого не пробуем скачивать снова
+_MEDIA_FAILED: dict[str, float] = {}
+
+# (kind, file_path) -> telegram file_id
+_MEDIA_FILE_IDS: dict[tuple[str, str], str] = {}
+
+
+def _http_client() -> httpx.AsyncClient:
+	global _http
+	if _http is None or _http.is_closed:
+		_http = httpx.AsyncClient(
+			timeout=httpx.Timeout(_MEDIA_HTTP_TIMEOUT, connect=5.0),
+			limits=httpx.Limits(max_connections=20, max_keepalive_connections=10, keepalive_expiry=60.0),
+			follow_redirects=True,
+		)
+	return _http
+
+
+async def close_http_client() -> None:
+	global _http
+	if _http is not None and not _http.is_closed:
+		await _http.aclose()
+	_http = None
+
+
+def _media_failed_recently(url: str) -> bool:
+	until = _MEDIA_FAILED.get(url)
+	if until is None:
+		return False
+	if until > time.monotonic():
+		return True
+	_MEDIA_FAILED.pop(url, None)
+	return False
+
+
+def _remember_media_failure(url: str) -> None:
+	now = time.monotonic()
+	if len(_MEDIA_FAILED) > 1000:
+		for k in [k for k, v in _MEDIA_FAILED.items() if v <= now]:
+			_MEDIA_FAILED.pop(k, None)
+	_MEDIA_FAILED[url] = now + _MEDIA_FAIL_TTL_SECONDS
+
+
+async def _download_media(url: str, filename: str) -> Optional[BufferedInputFile]:
+	if _media_failed_recently(url):
+		return None
+
+	try:
+		size = 0
+		chunks: list[bytes] = []
+		async with _http_client().stream("GET", url) as resp:
+			resp.raise_for_status()
+			async for chunk in resp.aiter_bytes():
+				size += len(chunk)
+				if size > _MEDIA_MAX_BYTES:
+					raise ValueError(f"media too large: {url}")
+				chunks.append(chunk)
+		return BufferedInputFile(b"".join(chunks), filename=filename)
+	except Exception:
+		_remember_media_failure(url)
+		return None
+
+
+async def _resolve_media(kind: str, file_path: str, filename: str) -> Optional[str | InputFile]:
+	"""
+	Возвращает то, что можно отдать в bot.send_*: file_id, FSInputFile или BufferedInputFile.
+	None — файл недоступен ни локально, ни по URL.
+	"""
+	file_id = _MEDIA_FILE_IDS.get((kind, file_path))
+	if file_id:
+		return file_id
+
+	abs_path = _resolve_local_path(file_path)
+	if abs_path:
+		return FSInputFile(abs_path, filename=filename)
+
+	url = _to_public_url(file_path)
+	if url:
+		return await _download_media(url, filename)
+
+	return None
+
+
+def _sent_file_id(kind: str, msg: Message) -> str:
+	try:
+		if kind == "photo" and msg.photo:
+			return msg.photo[-1].file_id
+		if kind == "video" and msg.video:
+			return msg.video.file_id
+		if kind == "audio" and msg.audio:
+			return msg.audio.file_id
+		if kind == "video_note" and msg.video_note:
+			return msg.video_note.file_id
+		if kind == "document" and msg.document:
+			return msg.document.file_id
+	except Exception:
+		pass
+	return ""
+
+
+async def _send_media(chat_id: int, kind: str, media: str | InputFile) -> Message:
+	if kind == "photo":
+		return await bot.send_photo(chat_id, photo=media)
+	if kind == "video":
+		return await bot.send_video(chat_id, video=media)
+	if kind == "audio":
+		return await bot.send_audio(chat_id, audio=media)
+	if kind == "video_note":
+		return await bot.send_video_note(chat_id, video_note=media)
+	return await bot.send_document(chat_id, document=media)
+
+
+async def _send_media_cached(chat_id: int, kind: str, file_path: str, filename: str, media: str | InputFile) -> None:
+	cache_key = (kind, file_path)
+	try:
+		msg = await _send_media(chat_id, kind, media)
+	except Exception:
+		# протухший file_id — забываем и пробуем заново с исходника
+		if not isinstance(media, str):
+			raise
+		_MEDIA_FILE_IDS.pop(cache_key, None)
+		media = await _resolve_media(kind, file_path, filename)
+		if media is None:
+			raise
+		msg = await _send_media(chat_id, kind, media)
+
+	fid = _sent_file_id(kind, msg)
+	if fid:
+		_MEDIA_FILE_IDS[cache_key] = fid
+
+
 async def send_attachment(
 	chat_id: int,
 	file_path: str,
 	file_kind: str = "",
 	file_name: str = "",
 ) -> None:
+	file_path = (file_path or "").strip()
 	if not file_path:
 		return
 
 	kind = _normalize_kind(file_kind, file_path)
 	fn = _ensure_filename_with_ext(file_name, file_path)
+	await _send_file(chat_id, file_path, kind, fn)
 
-	# 1) URL
-	url = _to_public_url(file_path)
-	if url:
-		try:
-			input_file = URLInputFile(url, filename=fn)
-			if kind == "photo":
-				await bot.send_photo(chat_id, photo=input_file)
-			elif kind == "video":
-				await bot.send_video(chat_id, video=input_file)
-			elif kind == "audio":
-				await bot.send_audio(chat_id, audio=input_file)
-			else:
-				await bot.send_document(chat_id, document=input_file)
-			return
-		except Exception:
-			pass
 
-	# 2) local
-	abs_path = _resolve_local_path(file_path)
-	if not abs_path:
+async def _send_file(chat_id: int, file_path: str, kind: str, fn: str) -> None:
+	media = await _resolve_media(kind, file_path, fn)
+	if media is None:
 		await bot.send_message(chat_id, f"⚠️ Файл не найден: <code>{file_path}</code>")
 		return
 
-	kind = kind or _guess_kind_from_ext(abs_path)
-	f = FSInputFile(abs_path, filename=fn)
 	try:
-		if kind == "photo":
-			await bot.send_photo(chat_id, photo=f)
-		elif kind == "video":
-			await bot.send_video(chat_id, video=f)
-		elif kind == "audio":
-			await bot.send_audio(chat_id, audio=f)
-		else:
-			await bot.send_document(chat_id, document=f)
+		await _send_media_cached(chat_id, kind, file_path, fn, media)
 	except Exception:
 		await bot.send_message(chat_id, f"⚠️ Не удалось отправить файл: <code>{file_path}</code>")
 
@@ -381,21 +703,13 @@ async def send_circle(chat_id: int, circle_path: str) -> None:
 	if not p:
 		return
 
-	url = _to_public_url(p)
-	if url:
-		try:
-			await bot.send_video_note(chat_id, video_note=URLInputFile(url, filename="circle.mp4"))
-			return
-		except Exception:
-			pass
-
-	abs_path = _resolve_local_path(p)
-	if not abs_path:
+	media = await _resolve_media("video_note", p, "circle.mp4")
+	if media is None:
 		await bot.send_message(chat_id, f"⚠️ Файл не найден: <code>{p}</code>")
 		return
 
 	try:
-		await bot.send_video_note(chat_id, video_note=FSInputFile(abs_path, filename="circle.mp4"))
+		await _send_media_cached(chat_id, "video_note", p, "circle.mp4", media)
 	except Exception:
 		await bot.send_message(chat_id, f"⚠️ Не удалось отправить кружок: <code>{p}</code>")
 
@@ -434,182 +748,293 @@ async def _schedule_gate_reminder(user_id: int, block_id: int, next_flow: str, s
 # After-flow actions runner (ставим jobs, не запускаем render_flow напрямую)
 
 async def _schedule_after_flow_actions(user_id: int, after_flow: str) -> None:
-	try:
-		actions = await get_flow_actions(after_flow)
-	except Exception:
-		return
-
+	actions = _CONFIG.actions_by_flow.get((after_flow or "").strip())
 	if not actions:
 		return
 
 	now = int(time.time())
-	for a in actions:
+	for action_id, target, delay in actions:
 		try:
-			if int(a.get("is_active", 0) or 0) != 1:
-				continue
-			if (a.get("action_type") or "start_flow") != "start_flow":
-				continue
-
-			target = (a.get("target_flow") or "").strip()
-			if not target:
-				continue
-
-			delay = int(a.get("delay_seconds", 0) or 0)
-			if delay < 0:
-				delay = 0
-
-			action_id = int(a.get("id") or 0)
 			key = _job_action(action_id) if action_id > 0 else _job_flow(target)
 			await upsert_job(int(user_id), key, now + delay)
 		except Exception:
 			continue
 
 
+# ─────────────────────────────────────────────────────────────
+# ✅ Flow plans: блоки flow компилируются один раз на версию
+#
+# Всё, что не зависит от пользователя (strip строк, delay, buttons JSON,
+# выбор способа отправки, is_active, дефолты gate), считается при компиляции.
+# render_flow просто проходит по готовым шагам.
+
+STEP_NONE = 0
+STEP_TEXT = 1
+STEP_CIRCLE = 2
+STEP_VIDEO = 3
+
+
+class GateSpec:
+	__slots__ = ("block_id", "next_flow", "button_text", "prompt_text", "reminder_seconds")
+
+	def __init__(self, block_id: int, next_flow: str, button_text: str, prompt_text: str, reminder_seconds: int):
+		self.block_id = block_id
+		self.next_flow = next_flow
+		self.button_text = button_text
+		self.prompt_text = prompt_text
+		self.reminder_seconds = reminder_seconds
+
+
+class FlowStep:
+	__slots__ = (
+		"kind", "text", "kb", "with_menu",
+		"media_path", "video_title", "video_kb",
+		"file_path", "file_kind", "file_name",
+		"delay", "gate", "block_id",
+	)
+
+	def __init__(self):
+		self.kind = STEP_NONE
+		self.block_id = 0
+		self.text = ""
+		self.kb: Optional[InlineKeyboardMarkup] = None
+		self.with_menu = False
+		self.media_path = ""
+		self.video_title = ""
+		self.video_kb: Optional[InlineKeyboardMarkup] = None
+		self.file_path = ""
+		self.file_kind = ""
+		self.file_name = ""
+		self.delay = 0.0
+		self.gate: Optional[GateSpec] = None
+
+
+class FlowPlan:
+	__slots__ = ("flow", "version", "steps")
+
+	def __init__(self, flow: str, version: int, steps: tuple):
+		self.flow = flow
+		self.version = version
+		self.steps = steps
+
+
+def _compile_step(flow: str, block: dict, menu_attached: bool) -> FlowStep:
+	st = FlowStep()
+	st.block_id = int(block.get("id") or 0)
+	t = (block.get("type") or "").strip()
+	text = block.get("text") or ""
+	raw_buttons = block.get("buttons") or ""
+	kb = build_buttons_kb(raw_buttons)
+
+	# reply keyboard прикрепляем только один раз на тексте welcome
+	attach_reply_menu = (flow == "welcome") and (not menu_attached) and (t in ("text", "")) and bool(text.strip())
+
+	if t == "circle" and block.get("circle"):
+		st.kind = STEP_CIRCLE
+		st.media_path = (block.get("circle") or "").strip()
+
+	elif t == "video" and block.get("video"):
+		st.kind = STEP_VIDEO
+		st.video_title = (block.get("title") or "").strip() or "<b>Видео урок:</b>"
+		st.video_kb = InlineKeyboardMarkup(
+			inline_keyboard=[[InlineKeyboardButton(text="▶️ Смотреть видео", url=block["video"])]]
+		)
+		st.kb = kb
+
+	elif t == "buttons":
+		st.kind = STEP_TEXT
+		title = (block.get("title") or "").strip()
+		msg = title or text.strip() or " "
+		if kb:
+			st.text, st.kb = msg, kb
+		elif raw_buttons:
+			st.text = "⚠️ buttons_json битый (невалидный JSON)."
+		else:
+			st.text = msg
+
+	elif text:
+		st.kind = STEP_TEXT
+		st.text = text
+		if attach_reply_menu:
+			st.with_menu = True
+		else:
+			st.kb = kb
+
+	file_path = (block.get("file_path") or "").strip()
+	if file_path:
+		st.file_path = file_path
+		st.file_kind = _normalize_kind((block.get("file_kind") or "").strip(), file_path)
+		st.file_name = _ensure_filename_with_ext((block.get("file_name") or "").strip(), file_path)
+
+	st.delay = _parse_delay_seconds(block.get("delay", None))
+
+	next_flow = (block.get("gate_next_flow") or "").strip()
+	if next_flow:
+		st.gate = GateSpec(
+			block_id=int(block.get("id") or 0),
+			next_flow=next_flow,
+			button_text=(block.get("gate_button_text") or "").strip() or "Дальше",
+			prompt_text=(block.get("gate_prompt_text") or "").strip() or " ",
+			reminder_seconds=int(block.get("gate_reminder_seconds") or 0),
+		)
+
+	return st
+
+
+def compile_flow_plan(flow: str, version: int, blocks: list[dict]) -> FlowPlan:
+	steps: list[FlowStep] = []
+	menu_attached = False
+
+	for block in blocks:
+		if not block.get("is_active"):
+			continue
+
+		st = _compile_step(flow, block, menu_attached)
+		menu_attached = menu_attached or st.with_menu
+		steps.append(st)
+
+		# после gate бот останавливается — дальше в план ничего не кладём
+		if st.gate:
+			break
+
+	return FlowPlan(flow, version, tuple(steps))
+
+
 # ─────────────────────────────────────────────────────────────
 # Flow rendering (serialized per user)
+#
+# У каждого активного юзера — свой mailbox: упорядоченная очередь запросов
+# render_flow и одна короткоживущая задача, которая её разбирает.
+# Когда очередь пуста, mailbox удаляется — память ~ числу активных юзеров,
+# а не всей аудитории (как было с вечным dict asyncio.Lock).
+
+class _Mailbox:
+	__slots__ = ("queue", "task")
+
+	def __init__(self):
+		self.queue: deque[tuple[str, asyncio.Future]] = deque()
+		self.task: asyncio.Task | None = None
+
+
+_MAILBOXES: dict[int, _Mailbox] = {}
+
+
+async def _drain_mailbox(uid: int, box: _Mailbox) -> None:
+	try:
+		while box.queue:
+			flow, fut = box.queue.popleft()
+			if fut.cancelled():
+				continue
+			try:
+				await _render_flow_now(uid, flow)
+			except Exception as e:
+				if not fut.done():
+					fut.set_exception(e)
+			else:
+				if not fut.done():
+					fut.set_result(None)
+	finally:
+		# между проверкой queue и удалением нет await — новый запрос не потеряется
+		if _MAILBOXES.get(uid) is box:
+			del _MAILBOXES[uid]
+		while box.queue:
+			_, fut = box.queue.popleft()
+			if not fut.done():
+				fut.cancel()
+
 
 async def render_flow(chat_id: int, flow: str):
+	"""
+	Ставит flow в очередь юзера и ждёт, пока он будет отправлен.
+	Flow одного юзера идут строго по очереди, разных юзеров — параллельно.
+	"""
 	flow = (flow or "").strip()
 	if not flow:
 		return
 
-	async with _lock(chat_id):
-		blocks = await get_blocks(flow)
+	uid = int(chat_id)
+	fut = asyncio.get_running_loop().create_future()
 
-		# ✅ меню приклеиваем один раз (как было), но с учётом unlocked
-		menu_attached = False
+	box = _MAILBOXES.get(uid)
+	if box is None:
+		box = _Mailbox()
+		_MAILBOXES[uid] = box
+	box.queue.append((flow, fut))
 
-		for block in blocks:
-			if not block.get("is_active"):
-				continue
+	if box.task is None:
+		box.task = asyncio.create_task(_drain_mailbox(uid, box))
 
-			t = (block.get("type") or "").strip()
-			# ✅ FIX delay
-			delay = _parse_delay_seconds(block.get("delay", None))
-			kb = build_buttons_kb(block.get("buttons"))
-
-			# reply keyboard прикрепляем только один раз на тексте welcome
-			attach_reply_menu = False
-			if (flow == "welcome") and (not menu_attached) and (t in ("text", "", None)) and bool((block.get("text") or "").strip()):
-				attach_reply_menu = True
-
-			# 1) content
-			if t == "circle" and block.get("circle"):
-				await send_circle(chat_id, block.get("circle", ""))
-
-			elif t == "video" and block.get("video"):
-				title = (block.get("title") or "").strip() or "<b>Видео урок:</b>"
-				await bot.send_message(
-					chat_id,
-					title,
-					reply_markup=InlineKeyboardMarkup(
-						inline_keyboard=[[InlineKeyboardButton(text="▶️ Смотреть видео", url=block["video"])]]
-					)
-				)
-				if kb:
-					await bot.send_message(chat_id, " ", reply_markup=kb)
-
-			elif t == "buttons":
-				title = (block.get("title") or "").strip()
-				text = (block.get("text") or "").strip()
-				msg = title or text or " "
-				if kb:
-					await bot.send_message(chat_id, msg, reply_markup=kb)
-				else:
-					if block.get("buttons"):
-						await bot.send_message(chat_id, "⚠️ buttons_json битый (невалидный JSON).")
-					else:
-						await bot.send_message(chat_id, msg)
+	await fut
 
-			elif t == "text" and block.get("text"):
-				if attach_reply_menu:
-					unlocked = await is_lessons_unlocked(chat_id)
-					await bot.send_message(chat_id, block["text"], reply_markup=reply_main_menu(unlocked))
-					menu_attached = True
-				else:
-					await bot.send_message(chat_id, block["text"], reply_markup=kb)
 
+async def _render_flow_now(chat_id: int, flow: str):
+	plan = await get_flow_plan(flow)
+
+	for st in plan.steps:
+		# 1) content
+		if st.kind == STEP_TEXT:
+			if st.with_menu:
+				unlocked = await is_lessons_unlocked(chat_id)
+				await bot.send_message(chat_id, st.text, reply_markup=reply_main_menu(unlocked))
 			else:
-				if block.get("text"):
-					if attach_reply_menu:
-						unlocked = await is_lessons_unlocked(chat_id)
-						await bot.send_message(chat_id, block["text"], reply_markup=reply_main_menu(unlocked))
-						menu_attached = True
-					else:
-						await bot.send_message(chat_id, block["text"], reply_markup=kb)
-
-			# 2) attachment
-			file_path = (block.get("file_path") or "").strip()
-			file_kind = (block.get("file_kind") or "").strip()
-			file_name = (block.get("file_name") or "").strip()
-			if file_path:
-				await send_attachment(chat_id, file_path, file_kind, file_name)
-
-			# 3) GATE
-			next_flow = (block.get("gate_next_flow") or "").strip()
-			if next_flow:
-				if delay > 0:
-					await asyncio.sleep(delay)
-
-				btn_text = (block.get("gate_button_text") or "").strip() or "Дальше"
-				prompt_text = (block.get("gate_prompt_text") or "").strip() or " "
-				rem_sec = int(block.get("gate_reminder_seconds") or 0)
-				block_id = int(block.get("id") or 0)
-
-				if rem_sec > 0 and block_id > 0:
-					await _schedule_gate_reminder(chat_id, block_id, next_flow, rem_sec)
-
-				await bot.send_message(
-					chat_id,
-					prompt_text,
-					reply_markup=InlineKeyboardMarkup(
-						inline_keyboard=[[
-							InlineKeyboardButton(
-								text=btn_text,
-								callback_data=_gate_cb(chat_id, block_id, next_flow)
-							)
-						]]
-					)
+				await bot.send_message(chat_id, st.text, reply_markup=st.kb)
+
+		elif st.kind == STEP_CIRCLE:
+			await send_circle(chat_id, st.media_path)
+
+		elif st.kind == STEP_VIDEO:
+			await bot.send_message(chat_id, st.video_title, reply_markup=st.video_kb)
+			if st.kb:
+				await bot.send_message(chat_id, " ", reply_markup=st.kb)
+
+		# 2) attachment
+		if st.file_path:
+			await _send_file(chat_id, st.file_path, st.file_kind, st.file_name)
+
+		if st.kind != STEP_NONE or st.file_path:
+			log_event(chat_id, "block_delivered", flow, st.block_id)
+
+		# 3) delay (перед gate — тоже)
+		if st.delay > 0:
+			await asyncio.sleep(st.delay)
+
+		# 4) GATE
+		gate = st.gate
+		if gate:
+			if gate.reminder_seconds > 0 and gate.block_id > 0:
+				await _schedule_gate_reminder(chat_id, gate.block_id, gate.next_flow, gate.reminder_seconds)
+
+			await bot.send_message(
+				chat_id,
+				gate.prompt_text,
+				reply_markup=InlineKeyboardMarkup(
+					inline_keyboard=[[
+						InlineKeyboardButton(
+							text=gate.button_text,
+							callback_data=_gate_cb(chat_id, gate.block_id, gate.next_flow)
+						)
+					]]
 				)
-				return
-
-			# 4) delay for non-gate blocks
-			if delay > 0:
-				await asyncio.sleep(delay)
+			)
+			log_event(chat_id, "gate_shown", flow, gate.block_id)
+			return
 
-		# ✅ конец курса -> разблокируем уроки (только это добавили)
-		if flow == _COURSE_COMPLETE_FLOW:
-			await unlock_lessons(chat_id)
+	# ✅ конец курса -> разблокируем уроки (только это добавили)
+	if flow == _COURSE_COMPLETE_FLOW:
+		await unlock_lessons(chat_id)
 
-		await _schedule_after_flow_actions(chat_id, flow)
+	await _schedule_after_flow_actions(chat_id, flow)
 
 
 # ─────────────────────────────────────────────────────────────
 # Scheduling from CRM (flow_triggers) only if mode == auto
 
 async def schedule_from_flow_triggers(user_id: int) -> bool:
-	try:
-		triggers = await get_flow_triggers()
-	except Exception:
-		return False
-
 	now = int(time.time())
 	any_set = False
 
-	for tr in triggers:
+	for flow, offset_seconds in _CONFIG.auto_triggers:
 		try:
-			flow = (tr.get("flow") or "").strip()
-			is_active = int(tr.get("is_active") or 0)
-			offset_seconds = int(tr.get("offset_seconds") or 0)
-
-			if not flow or is_active != 1:
-				continue
-			if offset_seconds < 0:
-				continue
-
-			if _mode(flow) != "auto":
-				continue
-
 			await upsert_job(int(user_id), _job_flow(flow), now + offset_seconds)
 			any_set = True
 		except Exception:
@@ -684,20 +1109,9 @@ async def _execute_job_and_mark_done(jid: int, uid: int, job_key: str) -> None:
 				except Exception:
 					aid = 0
 
-				if aid > 0:
-					try:
-						actions = await get_flow_actions(None)
-					except Exception:
-						actions = []
-
-					target = ""
-					for a in actions or []:
-						if int(a.get("id") or 0) == aid and int(a.get("is_active") or 0) == 1:
-							target = (a.get("target_flow") or "").strip()
-							break
-
-					if target:
-						await render_flow(uid, target)
+				target = _CONFIG.actions_by_id.get(aid) if aid > 0 else ""
+				if target:
+					await render_flow(uid, target)
 
 			elif job_key.startswith("gate:"):
 				parts = job_key.split(":", 2)
@@ -710,9 +1124,11 @@ async def _execute_job_and_mark_done(jid: int, uid: int, job_key: str) -> None:
 					else:
 						btn_text = "Дальше"
 						text = " "
+						gate_flow = ""
 						try:
 							b = await get_block(block_id)
 							if b:
+								gate_flow = (b.get("flow") or "").strip()
 								custom = (b.get("gate_reminder_text") or "").strip()
 								if custom:
 									text = custom
@@ -734,10 +1150,14 @@ async def _execute_job_and_mark_done(jid: int, uid: int, job_key: str) -> None:
 								]]
 							)
 						)
+						log_event(uid, "gate_shown", gate_flow, block_id, "reminder")
 
 			elif job_key.startswith("broadcast:"):
 				await _run_broadcast_job(uid, job_key)
 
+		except Exception as e:
+			log_event(uid, "job_failed", detail=f"{job_key}: {type(e).__name__}: {e}"[:500])
+
 		finally:
 			try:
 				await mark_job_done(jid)
@@ -753,9 +1173,10 @@ async def jobs_loop():
 			try:
 				now = int(time.time())
 
-				if now - last_modes_refresh >= _FLOW_MODES_REFRESH_SECONDS:
+				# обычно конфиг приходит через NOTIFY; опрос — только пока LISTEN не работает
+				if not _listener_ready and now - last_modes_refresh >= _FLOW_MODES_REFRESH_SECONDS:
 					last_modes_refresh = now
-					await refresh_flow_modes()
+					await refresh_config()
 
 				due = await fetch_due_jobs(50)
 
@@ -767,6 +1188,7 @@ async def jobs_loop():
 
 					uid = int(job["user_id"])
 					job_key = (job.get("flow") or "").strip()
+					record_metric("job_lag", max(0, now - int(job["run_at_ts"])))
 
 					asyncio.create_task(_execute_job_and_mark_done(jid, uid, job_key))
 
@@ -779,24 +1201,239 @@ async def jobs_loop():
 		return
 
 
+# ─────────────────────────────────────────────────────────────
+# ✅ Activity counters (coalesced)
+#
+# Одна middleware на все сообщения/нажатия копит дельты по user_id в памяти,
+# а flush раз в ACTIVITY_FLUSH_SECONDS пишет их одним batched UPSERT.
+# Болтливый юзер = одна строка в пачке, а не row-lock на каждое сообщение.
+
+_ACTIVITY_FLUSH_SECONDS = float(os.getenv("ACTIVITY_FLUSH_SECONDS", "5"))
+# тот же flush ведёт stats_totals/stats_hourly; сверка с bot_users — редко
+_STATS_RECONCILE_SECONDS = float(os.getenv("STATS_RECONCILE_SECONDS", "3600"))
+
+
+class _Activity:
+	__slots__ = ("username", "starts", "messages", "first_ts", "last_ts", "last_start_ts")
+
+	def __init__(self, username: str, now: int):
+		self.username = username
+		self.starts = 0
+		self.messages = 0
+		self.first_ts = now
+		self.last_ts = now
+		self.last_start_ts = 0
+
+
+_ACTIVITY: dict[int, _Activity] = {}
+
+
+def record_activity(user_id: int, username: str, is_start: bool = False) -> None:
+	uid = int(user_id)
+	now = int(time.time())
+	a = _ACTIVITY.get(uid)
+	if a is None:
+		a = _Activity(username, now)
+		_ACTIVITY[uid] = a
+	a.username = username
+	a.last_ts = now
+	if is_start:
+		a.starts += 1
+		a.last_start_ts = now
+	else:
+		a.messages += 1
+	log_event(uid, "start" if is_start else "message")
+
+
+def _merge_back(batch: dict[int, _Activity]) -> None:
+	# flush не удался — возвращаем дельты, чтобы не потерять счётчики
+	for uid, old in batch.items():
+		cur = _ACTIVITY.get(uid)
+		if cur is None:
+			_ACTIVITY[uid] = old
+			continue
+		cur.starts += old.starts
+		cur.messages += old.messages
+		cur.first_ts = min(cur.first_ts, old.first_ts)
+		cur.last_start_ts = max(cur.last_start_ts, old.last_start_ts)
+
+
+async def flush_activity() -> None:
+	global _ACTIVITY
+	if not _ACTIVITY:
+		return
+
+	batch, _ACTIVITY = _ACTIVITY, {}
+	rows = [
+		(uid, a.username, a.starts, a.messages, a.first_ts, a.last_ts, a.last_start_ts)
+		for uid, a in batch.items()
+	]
+	try:
+		await flush_user_activity(rows)
+	except Exception:
+		_merge_back(batch)
+
+
+async def activity_flush_loop():
+	last_reconcile = time.monotonic()
+	try:
+		while True:
+			await asyncio.sleep(_ACTIVITY_FLUSH_SECONDS)
+			await flush_activity()
+
+			if time.monotonic() - last_reconcile >= _STATS_RECONCILE_SECONDS:
+				last_reconcile = time.monotonic()
+				try:
+					await reconcile_stats()
+				except Exception:
+					pass
+	except asyncio.CancelledError:
+		return
+
+
+def _is_start_command(text: Optional[str]) -> bool:
+	parts = (text or "").split(maxsplit=1)
+	return bool(parts) and parts[0].split("@", 1)[0] == "/start"
+
+
+class ActivityMiddleware(BaseMiddleware):
+	async def __call__(
+		self,
+		handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+		event: TelegramObject,
+		data: Dict[str, Any],
+	) -> Any:
+		user = getattr(event, "from_user", None)
+		if user is not None:
+			is_start = isinstance(event, Message) and _is_start_command(event.text)
+			record_activity(user.id, user.username or "", is_start=is_start)
+		return await handler(event, data)
+
+
+dp.message.outer_middleware(ActivityMiddleware())
+dp.callback_query.outer_middleware(ActivityMiddleware())
+
+
+# ─────────────────────────────────────────────────────────────
+# ✅ Event log (append-only)
+#
+# log_event() только кладёт кортеж в буфер; events_flush_loop раз в
+# EVENTS_FLUSH_SECONDS (или сразу, если буфер набрал EVENTS_FLUSH_MAX) пишет
+# пачку одним COPY в партицию дня. Раз в час — создание партиций наперёд
+# и удаление старше EVENTS_RETENTION_DAYS.
+
+_EVENTS_FLUSH_SECONDS = float(os.getenv("EVENTS_FLUSH_SECONDS", "2"))
+_EVENTS_FLUSH_MAX = int(os.getenv("EVENTS_FLUSH_MAX", "5000"))
+# если БД долго недоступна — держим не больше этого, самые старые выбрасываем
+_EVENTS_BUFFER_LIMIT = int(os.getenv("EVENTS_BUFFER_LIMIT", "200000"))
+_EVENTS_MAINTENANCE_SECONDS = 3600
+
+_EVENTS: list[tuple] = []
+_events_wakeup = asyncio.Event()
+
+# минутные точки для stats_series: (minute_ts, metric) -> [sum, n, max]
+_SERIES: dict[tuple[int, str], list[int]] = {}
+_SERIES_BY_EVENT = {"start": "starts", "message": "messages", "block_delivered": "deliveries"}
+
+
+def record_metric(metric: str, value: int = 1) -> None:
+	now = int(time.time())
+	key = (now - now % 60, metric)
+	a = _SERIES.get(key)
+	if a is None:
+		_SERIES[key] = [int(value), 1, int(value)]
+	else:
+		a[0] += int(value)
+		a[1] += 1
+		a[2] = max(a[2], int(value))
+
+
+def log_event(user_id: int, kind: str, flow: str = "", block_id: int = 0, detail: str = "") -> None:
+	_EVENTS.append((
+		datetime.now(timezone.utc), int(user_id), kind,
+		(flow or "").strip(), int(block_id or 0), detail or "",
+	))
+	metric = _SERIES_BY_EVENT.get(kind)
+	if metric:
+		record_metric(metric)
+	if len(_EVENTS) >= _EVENTS_FLUSH_MAX:
+		_events_wakeup.set()
+
+
+async def _flush_series() -> None:
+	global _SERIES
+	if not _SERIES:
+		return
+
+	batch, _SERIES = _SERIES, {}
+	try:
+		await add_stats_series([(ts, m, a[0], a[1], a[2]) for (ts, m), a in batch.items()])
+	except Exception:
+		for key, old in batch.items():
+			cur = _SERIES.get(key)
+			if cur is None:
+				_SERIES[key] = old
+			else:
+				cur[0] += old[0]
+				cur[1] += old[1]
+				cur[2] = max(cur[2], old[2])
+
+
+async def flush_events() -> None:
+	global _EVENTS
+	await _flush_series()
+
+	if not _EVENTS:
+		return
+
+	batch, _EVENTS = _EVENTS, []
+	try:
+		await copy_events(batch)
+	except Exception:
+		# вернём пачку в начало буфера, но не дадим ему расти бесконечно
+		_EVENTS = (batch + _EVENTS)[-_EVENTS_BUFFER_LIMIT:]
+
+
+async def _maintain_event_partitions() -> None:
+	try:
+		await ensure_event_partitions()
+		await drop_old_event_partitions()
+		await prune_stats_series()
+	except Exception:
+		pass
+
+
+async def events_flush_loop():
+	last_maintenance = time.monotonic()
+	try:
+		while True:
+			try:
+				await asyncio.wait_for(_events_wakeup.wait(), timeout=_EVENTS_FLUSH_SECONDS)
+			except asyncio.TimeoutError:
+				pass
+			_events_wakeup.clear()
+
+			await flush_events()
+
+			if time.monotonic() - last_maintenance >= _EVENTS_MAINTENANCE_SECONDS:
+				last_maintenance = time.monotonic()
+				await _maintain_event_partitions()
+	except asyncio.CancelledError:
+		return
+
+
 # ─────────────────────────────────────────────────────────────
 # Handlers
 
 @dp.message(CommandStart())
 async def cmd_start(message: Message):
 	uid = message.from_user.id
-	username = message.from_user.username or ""
-
-	await inc_start(uid, username)
-
-	await refresh_flow_modes()
 	await schedule_from_flow_triggers(uid)
 	return
 
 
 @dp.message(Command("menu"))
 async def cmd_menu(message: Message):
-	await inc_message(message.from_user.id, message.from_user.username or "")
 	unlocked = await is_lessons_unlocked(message.from_user.id)
 	await message.answer(" ", reply_markup=reply_main_menu(unlocked))
 
@@ -805,7 +1442,6 @@ async def cmd_menu(message: Message):
 # но обработчик остаётся: если юзер введёт вручную — покажем замок.
 @dp.message(Command("lessons"))
 async def cmd_lessons(message: Message):
-	await inc_message(message.from_user.id, message.from_user.username or "")
 	if not await is_lessons_unlocked(message.from_user.id):
 		await message.answer("🔒 Уроки откроются после полного прохождения курса.")
 		return
@@ -814,7 +1450,6 @@ async def cmd_lessons(message: Message):
 
 @dp.message(Command("faq"))
 async def cmd_faq(message: Message):
-	await inc_message(message.from_user.id, message.from_user.username or "")
 	await message.answer(
 		"❓ <b>FAQ</b>\n\n"
 		"• Курс состоит из 3 уроков\n"
@@ -825,56 +1460,47 @@ async def cmd_faq(message: Message):
 
 @dp.message(Command("web"))
 async def cmd_web(message: Message):
-	await inc_message(message.from_user.id, message.from_user.username or "")
 	await message.answer("🌐 <b>Наш сайт</b>", reply_markup=inline_web_button())
 
 
 @dp.message(Command("club"))
 async def cmd_club(message: Message):
-	await inc_message(message.from_user.id, message.from_user.username or "")
 	await message.answer("🏛️ <b>Клуб Архитектура Счастья</b>", reply_markup=inline_club_button())
 
 
 @dp.message(Command("support"))
 async def cmd_support(message: Message):
-	await inc_message(message.from_user.id, message.from_user.username or "")
 	await message.answer(f"🆘 Поддержка: {SUPPORT_USERNAME}")
 
 
 @dp.message(F.text == "📚 Уроки")
 async def btn_lessons(message: Message):
-	await inc_message(message.from_user.id, message.from_user.username or "")
 	await cmd_lessons(message)
 
 
 @dp.message(F.text == "❓ FAQ")
 async def btn_faq(message: Message):
-	await inc_message(message.from_user.id, message.from_user.username or "")
 	await cmd_faq(message)
 
 
 @dp.message(F.text == "🌐 Сайт")
 async def btn_web(message: Message):
-	await inc_message(message.from_user.id, message.from_user.username or "")
 	await cmd_web(message)
 
 
 @dp.message(F.text == "🏛️ Клуб Архитектура Счастья")
 async def btn_club(message: Message):
-	await inc_message(message.from_user.id, message.from_user.username or "")
 	await cmd_club(message)
 
 
 @dp.message(F.text == "🆘 Поддержка")
 async def btn_support(message: Message):
-	await inc_message(message.from_user.id, message.from_user.username or "")
 	await cmd_support(message)
 
 
 @dp.callback_query(F.data.startswith("lesson:"))
 async def cb_lesson(call: CallbackQuery):
 	await call.answer()
-	await inc_message(call.from_user.id, call.from_user.username or "")
 
 	# ✅ уроки доступны только после конца курса
 	if not await is_lessons_unlocked(call.from_user.id):
@@ -905,6 +1531,7 @@ async def cb_gate_next(call: CallbackQuery):
 			await mark_gate_pressed(target_uid, block_id)
 		except Exception:
 			pass
+	log_event(target_uid, "gate_pressed", next_flow, block_id)
 
 	try:
 		await mark_job_done_by_user_flow(target_uid, _job_gate(block_id, next_flow))
@@ -915,20 +1542,13 @@ async def cb_gate_next(call: CallbackQuery):
 	await render_flow(target_uid, next_flow)
 
 
-@dp.message()
-async def any_message(message: Message):
-	if message.text and message.text.startswith("/"):
-		return
-	await inc_message(message.from_user.id, message.from_user.username or "")
-
-
 # ─────────────────────────────────────────────────────────────
 
 async def on_startup():
-	global _jobs_task
+	global _jobs_task, _listener_task, _activity_task, _events_task
 
 	await init_db()
-	await refresh_flow_modes()
+	await refresh_config()
 
 	# ✅ /lessons НЕ добавляем в список команд (чтобы “не появлялась” до конца курса)
 	await bot.set_my_commands([
@@ -940,13 +1560,27 @@ async def on_startup():
 		BotCommand(command="support", description="Поддержка"),
 	])
 
+	if _listener_task is None or _listener_task.done():
+		_listener_task = asyncio.create_task(db_listener_loop())
+
 	if _jobs_task is None or _jobs_task.done():
 		_jobs_task = asyncio.create_task(jobs_loop())
 
+	if _activity_task is None or _activity_task.done():
+		_activity_task = asyncio.create_task(activity_flush_loop())
+
+	if _events_task is None or _events_task.done():
+		_events_task = asyncio.create_task(events_flush_loop())
+
 
 async def main():
 	await on_startup()
-	await dp.start_polling(bot)
+	try:
+		await dp.start_polling(bot)
+	finally:
+		await flush_activity()
+		await flush_events()
+		await close_http_client()
 
 
 if __name__ == "__main__":
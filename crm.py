@@ -1,14 +1,22 @@
 # crm.py
 import os
+import re
 import json
-import uuid
+import time
+import asyncio
+import hashlib
+import zlib
+import mimetypes
 from typing import Optional
-from io import BytesIO
-from datetime import datetime
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import quote
+from datetime import datetime, timezone, timedelta
+from email.utils import formatdate, parsedate_to_datetime
 
+import asyncpg
 from fastapi import FastAPI, Request, Form, UploadFile, File
-from fastapi.responses import RedirectResponse, HTMLResponse, StreamingResponse
-from fastapi.staticfiles import StaticFiles
+from fastapi.responses import RedirectResponse, HTMLResponse, StreamingResponse, Response, JSONResponse
 from fastapi.templating import Jinja2Templates
 
 from openpyxl import Workbook
@@ -16,29 +24,54 @@ from openpyxl.utils import get_column_letter
 
 from db import (
 	init_db,
-	get_flows, create_flow, delete_flow, move_flow,
+	get_flows, create_flow, delete_flow, move_flow, reorder_flows, clone_flow,
 	get_blocks, get_block, create_block, update_block, delete_block,
-	next_position, swap_positions,
-	get_stats, get_users,
-	get_flow_triggers, set_flow_trigger, delete_flow_trigger,
+	next_position, move_block, reorder_blocks, bulk_update_blocks, BLOCK_BULK_OPS,
+	get_stats, get_users_page, iter_users,
+	set_flow_trigger, delete_flow_trigger,
 
 	# ✅ flow modes (off/manual/auto)
-	get_flow_modes, set_flow_mode,
+	set_flow_mode,
 
 	# ✅ flow actions (after flow -> start flow)
-	get_flow_actions, upsert_flow_action, delete_flow_action,
+	upsert_flow_action, delete_flow_action,
 
 	# ✅ broadcasts (new)
-	list_broadcasts, create_broadcast, delete_broadcast, set_broadcast_active,
+	create_broadcast, delete_broadcast, set_broadcast_active,
+
+	# ✅ граф переходов между flow
+	get_flow_graph_data,
+
+	# ✅ главная CRM одним снапшотом
+	get_crm_index_snapshot,
+
+	# ✅ поиск юзеров + карточка
+	search_users, get_user_card,
+
+	# ✅ CSV export через COPY
+	copy_users_csv, copy_events_csv, USER_STATUSES,
+
+	# ✅ funnel (pre-aggregated)
+	get_funnel,
+
+	# ✅ DAU/WAU/MAU + retention (activity bitmaps)
+	get_active_users, get_retention,
+
+	# ✅ time series (stats_series)
+	get_stats_series, series_bucket, SERIES_RESOLUTIONS, SERIES_METRICS,
+
+	# ✅ flow bundles (JSON export / import)
+	export_flow_bundle, import_flow_bundle, flow_bundle_records,
 )
+from flow_graph import build_flow_graph, find_auto_cycles, zero_delay_cycles, expected_start_offsets, reachable_flows
 
 from seed import seed as run_seed  # ✅ автосид
 
 app = FastAPI()
 templates = Jinja2Templates(directory="templates")
 
-os.makedirs("media", exist_ok=True)
-app.mount("/media", StaticFiles(directory="media"), name="media")
+MEDIA_DIR = os.path.abspath("media")
+os.makedirs(MEDIA_DIR, exist_ok=True)
 
 
 @app.on_event("startup")
@@ -128,22 +161,398 @@ def _clamp_int(v: int, lo: int, hi: int) -> int:
 
 
 # ─────────────────────────────────────────────────────────────
-# INDEX (FLOWS + STATS + USERS + TRIGGERS + MODES + ACTIONS + BROADCASTS)
+# CPU EXECUTOR
+#
+# Тяжёлая синхронная работа (хеширование медиа, сборка XLSX) — не в event loop,
+# а в отдельном ограниченном пуле потоков, чтобы остальные запросы CRM
+# не замирали. Потоки, а не процессы: hashlib отпускает GIL на больших буферах,
+# а состояние openpyxl-книги (временные файлы листов) не переносится между процессами.
+# Экспортов одновременно — не больше _EXPORT_SLOTS, лишние ждут своей очереди.
+
+_CPU_WORKERS = max(1, int(os.getenv("CRM_CPU_WORKERS", "2")))
+_EXPORT_SLOTS = max(1, int(os.getenv("CRM_EXPORT_SLOTS", "2")))
+
+_cpu_pool = ThreadPoolExecutor(max_workers=_CPU_WORKERS, thread_name_prefix="crm-cpu")
+# сборка XLSX держит свой поток всё время save() — отдельный пул, чтобы не занять хеширование
+_export_pool = ThreadPoolExecutor(max_workers=_EXPORT_SLOTS, thread_name_prefix="crm-export")
+_export_sem = asyncio.Semaphore(_EXPORT_SLOTS)
+
+
+async def run_cpu(fn, *args):
+	return await asyncio.get_running_loop().run_in_executor(_cpu_pool, fn, *args)
+
+
+async def run_export(fn, *args):
+	return await asyncio.get_running_loop().run_in_executor(_export_pool, fn, *args)
+
+
+@app.on_event("shutdown")
+async def _shutdown_executors():
+	_cpu_pool.shutdown(wait=False, cancel_futures=True)
+	_export_pool.shutdown(wait=False, cancel_futures=True)
+
+
+# ─────────────────────────────────────────────────────────────
+# MEDIA (content-addressed, immutable)
+#
+# Загрузки сохраняются как media/<sha256[:32]><ext>, поэтому URL меняется
+# вместе с содержимым и файл можно кешировать навсегда (Cache-Control: immutable).
+# Старые файлы без хеша в имени (например media/welcome.mp4) отдаются
+# с ETag и короткой ревалидацией. Поддерживаются If-None-Match,
+# If-Modified-Since, Range и If-Range — Telegram и прокси могут докачивать видео кусками.
+
+_HASHED_MEDIA_RE = re.compile(r"^[0-9a-f]{32}(\.[A-Za-z0-9]{1,8})?$")
+_MEDIA_CHUNK = 256 * 1024
+_MEDIA_IMMUTABLE_CC = "public, max-age=31536000, immutable"
+_MEDIA_MUTABLE_CC = "public, max-age=300, must-revalidate"
+
+# (path, mtime_ns, size) -> sha256 hex
+_MEDIA_ETAGS: dict[tuple[str, int, int], str] = {}
+
+
+def _sha256_file(path: str) -> str:
+	h = hashlib.sha256()
+	with open(path, "rb") as f:
+		for chunk in iter(lambda: f.read(1024 * 1024), b""):
+			h.update(chunk)
+	return h.hexdigest()
+
+
+async def _media_etag(path: str, st: os.stat_result) -> str:
+	name = os.path.basename(path)
+	if _HASHED_MEDIA_RE.match(name):
+		return f'"{os.path.splitext(name)[0]}"'
+
+	key = (path, int(st.st_mtime_ns), int(st.st_size))
+	digest = _MEDIA_ETAGS.get(key)
+	if digest is None:
+		digest = await run_cpu(_sha256_file, path)
+		_MEDIA_ETAGS[key] = digest
+	return f'"{digest[:32]}"'
+
+
+def _etag_matches(header: str, etag: str) -> bool:
+	h = (header or "").strip()
+	if not h:
+		return False
+	if h == "*":
+		return True
+	tags = [t.strip() for t in h.split(",")]
+	return etag in tags or f"W/{etag}" in tags
+
+
+def _parse_range(header: str, size: int) -> Optional[tuple[int, int]]:
+	"""
+	"bytes=0-99" / "bytes=100-" / "bytes=-500" -> (start, end) включительно.
+	Несколько диапазонов не поддерживаем — отдадим файл целиком.
+	Невалидный / за пределами файла -> (-1, -1) (это 416).
+	"""
+	h = (header or "").strip().lower()
+	if not h.startswith("bytes=") or "," in h:
+		return None
+
+	spec = h[len("bytes="):].strip()
+	start_s, _, end_s = spec.partition("-")
+	try:
+		if start_s == "":
+			length = int(end_s)
+			if length <= 0:
+				return (-1, -1)
+			start = max(0, size - length)
+			end = size - 1
+		else:
+			start = int(start_s)
+			end = int(end_s) if end_s else size - 1
+	except ValueError:
+		return None
+
+	end = min(end, size - 1)
+	if start < 0 or start > end or start >= size:
+		return (-1, -1)
+	return (start, end)
+
+
+async def _iter_file(path: str, start: int, length: int):
+	with open(path, "rb") as f:
+		f.seek(start)
+		remaining = length
+		while remaining > 0:
+			chunk = await asyncio.to_thread(f.read, min(_MEDIA_CHUNK, remaining))
+			if not chunk:
+				break
+			remaining -= len(chunk)
+			yield chunk
+
+
+def _media_abs_path(name: str) -> str:
+	p = os.path.abspath(os.path.join(MEDIA_DIR, name))
+	if not p.startswith(MEDIA_DIR + os.sep):
+		return ""
+	return p if os.path.isfile(p) else ""
+
+
+# Telegram Bot API не отправит файл больше 50 MB — такой блок всё равно не дойдёт
+_MAX_UPLOAD_BYTES = int(float(os.getenv("MEDIA_MAX_UPLOAD_MB", "50")) * 1024 * 1024)
+
+
+class UploadRejected(ValueError):
+	pass
+
+
+def _store_upload_sync(src, ext: str) -> str:
+	"""
+	Копирует загрузку кусками во временный файл, считая sha256 по пути,
+	и переименовывает в <sha256[:32]><ext>. Память — один кусок.
+	"""
+	src.seek(0)
+	h = hashlib.sha256()
+	size = 0
+	tmp = os.path.join(MEDIA_DIR, f".upload-{os.getpid()}-{id(src)}.part")
+	try:
+		with open(tmp, "wb") as f:
+			for chunk in iter(lambda: src.read(1024 * 1024), b""):
+				size += len(chunk)
+				if size > _MAX_UPLOAD_BYTES:
+					raise UploadRejected(f"Файл больше {_MAX_UPLOAD_BYTES // (1024 * 1024)} MB — Telegram его не отправит")
+				h.update(chunk)
+				f.write(chunk)
+		if size == 0:
+			raise UploadRejected("Пустой файл")
+
+		fname = f"{h.hexdigest()[:32]}{ext}"
+		dst = os.path.join(MEDIA_DIR, fname)
+		if os.path.exists(dst):
+			os.remove(tmp)
+		else:
+			os.replace(tmp, dst)
+		return fname
+	except BaseException:
+		if os.path.exists(tmp):
+			os.remove(tmp)
+		raise
+
+
+async def _save_upload(upload: UploadFile, default_ext: str = "") -> tuple[str, str]:
+	"""
+	Сохраняет загрузку в media/ под именем по sha256 содержимого.
+	Возвращает (public_path, original_safe_name). Одинаковые файлы не дублируются.
+	UploadRejected — если файл пустой или больше лимита Telegram.
+	"""
+	orig_name = _safe_filename(upload.filename or "")
+	ext = os.path.splitext(orig_name)[1].lower() or default_ext
+
+	fname = await run_cpu(_store_upload_sync, upload.file, ext)
+	return f"/media/{fname}", orig_name
+
+
+@app.api_route("/media/{name:path}", methods=["GET", "HEAD"])
+async def media_file(request: Request, name: str):
+	path = _media_abs_path(name)
+	if not path:
+		return Response(status_code=404)
+
+	st = os.stat(path)
+	size = int(st.st_size)
+	etag = await _media_etag(path, st)
+	immutable = bool(_HASHED_MEDIA_RE.match(os.path.basename(path)))
+
+	headers = {
+		"ETag": etag,
+		"Last-Modified": formatdate(st.st_mtime, usegmt=True),
+		"Cache-Control": _MEDIA_IMMUTABLE_CC if immutable else _MEDIA_MUTABLE_CC,
+		"Accept-Ranges": "bytes",
+	}
+
+	# conditional GET
+	inm = request.headers.get("if-none-match")
+	if inm is not None:
+		if _etag_matches(inm, etag):
+			return Response(status_code=304, headers=headers)
+	else:
+		ims = request.headers.get("if-modified-since")
+		if ims:
+			try:
+				since = parsedate_to_datetime(ims)
+				if since.tzinfo is None:
+					since = since.replace(tzinfo=timezone.utc)
+				if int(st.st_mtime) <= int(since.timestamp()):
+					return Response(status_code=304, headers=headers)
+			except Exception:
+				pass
+
+	media_type = mimetypes.guess_type(path)[0] or "application/octet-stream"
+
+	# Range (If-Range: если файл изменился — отдаём целиком)
+	rng = None
+	range_h = request.headers.get("range")
+	if range_h and size > 0:
+		if_range = (request.headers.get("if-range") or "").strip()
+		if not if_range or if_range == etag:
+			rng = _parse_range(range_h, size)
+
+	if rng == (-1, -1):
+		headers["Content-Range"] = f"bytes */{size}"
+		return Response(status_code=416, headers=headers)
+
+	if rng:
+		start, end = rng
+		length = end - start + 1
+		headers["Content-Range"] = f"bytes {start}-{end}/{size}"
+		status = 206
+	else:
+		start, length = 0, size
+		status = 200
+
+	headers["Content-Length"] = str(length)
+	if request.method == "HEAD":
+		return Response(status_code=status, headers=headers, media_type=media_type)
+
+	return StreamingResponse(
+		_iter_file(path, start, length),
+		status_code=status,
+		headers=headers,
+		media_type=media_type,
+	)
+
+
+# ─────────────────────────────────────────────────────────────
+# FLOW GRAPH (проверка циклов до сохранения)
+
+def _graph_from(data: dict):
+	return build_flow_graph(
+		data["flows"], data["blocks"], data["actions"],
+		triggers=data["triggers"], modes=data["modes"],
+	)
+
+
+def _zero_cycle_flows(graph) -> set:
+	out = set()
+	for c in zero_delay_cycles(graph):
+		out.update(c.flows)
+	return out
+
+
+async def _check_graph_change(action: Optional[dict] = None, block: Optional[dict] = None) -> str:
+	"""
+	Примеряет правку к текущему графу. Возвращает текст ошибки,
+	если она создаёт новый цикл без задержки (job storm), иначе "".
+	"""
+	try:
+		data = await get_flow_graph_data()
+	except Exception:
+		return ""
+
+	before = _graph_from(data)
+
+	if action is not None:
+		key = (action["after_flow"], action.get("action_type", "start_flow"), action["target_flow"])
+		data["actions"] = [
+			a for a in data["actions"]
+			if (a["after_flow"], a["action_type"], a["target_flow"]) != key
+		] + [action]
+
+	if block is not None:
+		bid = int(block.get("id") or 0)
+		data["blocks"] = [b for b in data["blocks"] if not bid or b["id"] != bid] + [block]
+
+	after = _graph_from(data)
+	new_bad = _zero_cycle_flows(after) - _zero_cycle_flows(before)
+	if not new_bad:
+		return ""
+
+	for c in zero_delay_cycles(after):
+		if new_bad.intersection(c.flows):
+			return c.describe()
+	return "Правка создаёт бесконечный цикл без задержки"
 
-@app.get("/", response_class=HTMLResponse)
-async def index(request: Request):
-	flows = await get_flows()
-	stats = await get_stats()
-	users = await get_users(200)
 
-	# ✅ flow modes
+def _new_cycle_error(before, after) -> str:
+	new_bad = _zero_cycle_flows(after) - _zero_cycle_flows(before)
+	for c in zero_delay_cycles(after):
+		if new_bad.intersection(c.flows):
+			return c.describe()
+	return ""
+
+
+async def _check_bulk_blocks(flow: str, ids: set, op: str, delay: float) -> str:
+	"""Как _check_graph_change, но для массовой операции над блоками flow."""
 	try:
-		modes = await get_flow_modes()  # dict: flow -> mode
+		data = await get_flow_graph_data()
 	except Exception:
-		modes = {}
+		return ""
+
+	before = _graph_from(data)
+	blocks = []
+	for b in data["blocks"]:
+		if b["flow"] == flow and b["id"] in ids:
+			if op == "delete":
+				continue
+			b = dict(b)
+			if op == "delay":
+				b["delay"] = delay
+			else:
+				b["is_active"] = 1 if op == "enable" else 0
+		blocks.append(b)
+	data["blocks"] = blocks
+	return _new_cycle_error(before, _graph_from(data))
+
+
+def _with_error(url: str, error: str) -> str:
+	return f"{url}?error={quote(error)}" if error else url
+
+
+# ─────────────────────────────────────────────────────────────
+# INDEX (FLOWS + STATS + USERS + TRIGGERS + MODES + ACTIONS + BROADCASTS)
+
+_USERS_PAGE_SIZE = 50
+
+
+def _fmt_ts(ts: int) -> str:
+	if not ts:
+		return ""
+	return datetime.utcfromtimestamp(int(ts)).strftime("%Y-%m-%d %H:%M:%S")
+
+
+def _parse_cursor(raw: str) -> tuple[Optional[int], Optional[int]]:
+	# "<last_seen_ts>:<user_id>"
+	try:
+		ts_s, uid_s = (raw or "").split(":", 1)
+		return int(ts_s), int(uid_s)
+	except ValueError:
+		return None, None
+
+
+def _fmt_cursor(cur) -> str:
+	return f"{cur[0]}:{cur[1]}" if cur else ""
+
+
+# Всё, кроме stats и страницы users, собирается из одного снапшота БД и живёт
+# _INDEX_CACHE_TTL секунд; любой POST в CRM сбрасывает кеш (см. middleware ниже).
+# Изменения со стороны бота (next_run_ts рассылок) видны не позже TTL.
+_INDEX_CACHE_TTL = float(os.getenv("CRM_INDEX_CACHE_SECONDS", "10"))
+_index_cache: Optional[tuple[float, dict]] = None
+_index_cache_gen = 0
+
+
+def _invalidate_index_cache() -> None:
+	global _index_cache, _index_cache_gen
+	_index_cache = None
+	_index_cache_gen += 1
+
+
+@app.middleware("http")
+async def _invalidate_on_write(request: Request, call_next):
+	response = await call_next(request)
+	if request.method not in ("GET", "HEAD", "OPTIONS"):
+		_invalidate_index_cache()
+	return response
+
+
+def _build_index_view(snap: dict) -> dict:
+	flows = snap["flows"]
+	modes = snap["modes"]
 
 	# triggers (offset + enabled) — используется только когда mode=auto
-	raw = await get_flow_triggers()
 	triggers_map = {}
 
 	for f in flows:
@@ -156,7 +565,7 @@ async def index(request: Request):
 			"mode": _norm_mode(modes.get(f, "off")),
 		}
 
-	for t in raw:
+	for t in snap["triggers"]:
 		flow = (t.get("flow") or "").strip()
 		if not flow:
 			continue
@@ -184,22 +593,14 @@ async def index(request: Request):
 			})
 
 	# ✅ сценарии "после flow"
-	try:
-		actions = await get_flow_actions(None)
-	except Exception:
-		actions = []
-
+	actions = [dict(a) for a in snap["actions"]]
 	for a in actions:
 		val, unit = _seconds_to_value_unit(int(a.get("delay_seconds", 0) or 0), preferred_unit="minutes")
 		a["delay_value"] = int(val)
 		a["delay_unit"] = unit
 
 	# ✅ broadcasts list (new)
-	try:
-		broadcasts = await list_broadcasts()
-	except Exception:
-		broadcasts = []
-
+	broadcasts = snap["broadcasts"]
 	for b in broadcasts:
 		# convenient derived fields for template
 		b["is_all_users"] = (b.get("target_user_id") is None)
@@ -207,20 +608,111 @@ async def index(request: Request):
 		b["at_hour"] = int(b.get("at_hour", 12) or 12)
 		b["at_minute"] = int(b.get("at_minute", 0) or 0)
 
+	# ✅ граф flow: циклы + ожидаемое время старта после /start
+	graph_warnings: list[str] = []
+	flow_offsets: dict[str, str] = {}
+	unreachable: list[str] = []
+	try:
+		graph = _graph_from(snap)
+		graph_warnings = [c.describe() for c in find_auto_cycles(graph)]
+		for f, sec in expected_start_offsets(graph).items():
+			val, unit = _seconds_to_value_unit(sec, preferred_unit="minutes")
+			flow_offsets[f] = f"{val} {unit}"
+		# ✅ недостижимые: ни auto после /start, ни gate/action, ни активный broadcast
+		if graph.roots:
+			bc_roots = {b["flow"] for b in broadcasts if int(b.get("is_active") or 0)}
+			reachable = reachable_flows(graph, extra_roots=bc_roots)
+			unreachable = [f for f in flows if f not in reachable]
+	except Exception:
+		pass
+
+	return {
+		"flows": flows,
+		"triggers": triggers_map,   # triggers[flow]["mode"] уже здесь
+		"actions": actions,         # ✅ flow_actions для UI
+		"broadcasts": broadcasts,   # ✅ new recurring broadcasts
+		"graph_warnings": graph_warnings,
+		"flow_offsets": flow_offsets,
+		"unreachable_flows": unreachable,
+	}
+
+
+async def _index_view() -> dict:
+	global _index_cache
+	now = time.monotonic()
+	if _index_cache is not None and now - _index_cache[0] < _INDEX_CACHE_TTL:
+		return _index_cache[1]
+
+	gen = _index_cache_gen
+	view = _build_index_view(await get_crm_index_snapshot())
+	# пока грузили, мог пройти POST — такой результат не кешируем
+	if gen == _index_cache_gen:
+		_index_cache = (now, view)
+	return view
+
+
+@app.get("/", response_class=HTMLResponse)
+async def index(request: Request):
+	# ✅ users: keyset-страницы (?after=ts:id / ?before=ts:id)
+	before = request.query_params.get("before", "")
+	after_ts, after_id = _parse_cursor(before or request.query_params.get("after", ""))
+
+	# три независимых чтения — параллельно, каждое на своём соединении пула
+	view, stats, page = await asyncio.gather(
+		_index_view(),
+		get_stats(),
+		get_users_page(after_ts, after_id, _USERS_PAGE_SIZE, backward=bool(before)),
+	)
+
+	users = page["users"]
+	for u in users:
+		u["first_seen"] = _fmt_ts(u["first_seen_ts"])
+		u["last_seen"] = _fmt_ts(u["last_seen_ts"])
+
 	return templates.TemplateResponse(
 		"index.html",
 		{
 			"request": request,
-			"flows": flows,
+			**view,
 			"stats": stats,
 			"users": users,
-			"triggers": triggers_map,   # triggers[flow]["mode"] уже здесь
-			"actions": actions,         # ✅ flow_actions для UI
-			"broadcasts": broadcasts,   # ✅ new recurring broadcasts
+			"users_next": _fmt_cursor(page["next"]),
+			"users_prev": _fmt_cursor(page["prev"]),
+			"error": request.query_params.get("error", ""),
 		},
 	)
 
 
+# ─────────────────────────────────────────────────────────────
+# USER SEARCH + CARD
+
+@app.get("/users/search", response_class=HTMLResponse)
+async def users_search(request: Request, q: str = ""):
+	q = (q or "").strip()
+	users = await search_users(q, 50) if q else []
+	for u in users:
+		u["first_seen"] = _fmt_ts(u["first_seen_ts"])
+		u["last_seen"] = _fmt_ts(u["last_seen_ts"])
+	return templates.TemplateResponse("users_search.html", {"request": request, "q": q, "users": users})
+
+
+@app.get("/user/{user_id}", response_class=HTMLResponse)
+async def user_card(request: Request, user_id: int):
+	card = await get_user_card(user_id)
+	if card is None:
+		return HTMLResponse("User not found", status_code=404)
+
+	u = card["user"]
+	u["first_seen"] = _fmt_ts(u["first_seen_ts"])
+	u["last_seen"] = _fmt_ts(u["last_seen_ts"])
+	for j in card["jobs"]:
+		j["run_at"] = _fmt_ts(j["run_at_ts"])
+	for g in card["gates"]:
+		g["pressed"] = _fmt_ts(g["pressed_at"])
+
+	return templates.TemplateResponse("user.html", {"request": request, **card})
+
+
 # ─────────────────────────────────────────────────────────────
 # FLOW MODE + TRIGGERS routes
 #
@@ -309,6 +801,18 @@ async def flow_action_upsert(
 	if delay < 0:
 		delay = 0
 
+	if int(is_active):
+		err = await _check_graph_change(action={
+			"id": 0,
+			"after_flow": after_flow,
+			"action_type": "start_flow",
+			"target_flow": target_flow,
+			"delay_seconds": delay,
+			"is_active": 1,
+		})
+		if err:
+			return RedirectResponse(_with_error("/", err), status_code=302)
+
 	await upsert_flow_action(
 		after_flow=after_flow,
 		target_flow=target_flow,
@@ -414,58 +918,361 @@ async def broadcast_toggle(broadcast_id: int, is_active: int = Form(1)):
 # ─────────────────────────────────────────────────────────────
 # EXPORT (XLSX)
 
+# XLSX: openpyxl write-only — строки сразу уходят во временный файл листа,
+# а zip собирается при save(). save() пишет в _QueueWriter, и ответ отдаётся
+# кусками, пока архив ещё собирается. Памяти — O(одной пачки), лимита строк нет.
+
+_EXPORT_BATCH = 2000
+_EXPORT_CHUNK = 256 * 1024
+_XLSX_MEDIA_TYPE = "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
+
+_USERS_XLSX_HEADERS = [
+	"user_id",
+	"username",
+	"first_seen_ts",
+	"last_seen_ts",
+	"first_seen_utc",
+	"last_seen_utc",
+	"starts_count",
+	"messages_count",
+]
+
+
+class _UsersXlsx:
+	def __init__(self):
+		self.wb = Workbook(write_only=True)
+		self.ws = self.wb.create_sheet("bot_users")
+		# ширины — до первой строки (в write-only потом нельзя)
+		for col_idx, h in enumerate(_USERS_XLSX_HEADERS, start=1):
+			self.ws.column_dimensions[get_column_letter(col_idx)].width = max(14, len(h) + 2)
+		self.ws.append(_USERS_XLSX_HEADERS)
+
+	def add_rows(self, users: list[dict]) -> None:
+		for u in users:
+			self.ws.append([
+				u.get("user_id"),
+				u.get("username", ""),
+				u.get("first_seen_ts"),
+				u.get("last_seen_ts"),
+				_fmt_ts(u.get("first_seen_ts")),
+				_fmt_ts(u.get("last_seen_ts")),
+				u.get("starts_count", 0),
+				u.get("messages_count", 0),
+			])
+
+	def save(self, fileobj) -> None:
+		self.wb.save(fileobj)
+
+
+class _QueueWriter:
+	"""
+	Файлоподобный приёмник для ZipFile (без seek/tell) в рабочем потоке:
+	копит байты и отдаёт их кусками в asyncio.Queue (с backpressure).
+	"""
+
+	def __init__(self, loop: asyncio.AbstractEventLoop, queue: asyncio.Queue):
+		self._loop = loop
+		self._queue = queue
+		self._buf = bytearray()
+		self.cancelled = False
+
+	def _put(self, item) -> None:
+		if self.cancelled:
+			raise OSError("export cancelled")
+		asyncio.run_coroutine_threadsafe(self._queue.put(item), self._loop).result()
+
+	def write(self, data) -> int:
+		self._buf += data
+		if len(self._buf) >= _EXPORT_CHUNK:
+			self._put(bytes(self._buf))
+			self._buf.clear()
+		return len(data)
+
+	def flush(self) -> None:
+		pass
+
+	def close(self) -> None:
+		if self._buf:
+			self._put(bytes(self._buf))
+			self._buf.clear()
+
+
+async def _stream_save(save, max_chunks: int = 8):
+	"""save(fileobj) в потоке -> async-итератор байтов для StreamingResponse."""
+	loop = asyncio.get_running_loop()
+	queue: asyncio.Queue = asyncio.Queue(maxsize=max_chunks)
+	writer = _QueueWriter(loop, queue)
+	done = object()
+
+	def run():
+		try:
+			save(writer)
+			writer.close()
+		finally:
+			asyncio.run_coroutine_threadsafe(queue.put(done), loop)
+
+	task = asyncio.ensure_future(run_export(run))
+	try:
+		while True:
+			item = await queue.get()
+			if item is done:
+				break
+			yield item
+		await task
+	finally:
+		if not task.done():
+			# клиент ушёл: отпускаем поток (следующий write бросит OSError)
+			writer.cancelled = True
+			while not task.done():
+				try:
+					queue.get_nowait()
+				except asyncio.QueueEmpty:
+					await asyncio.sleep(0.05)
+
+
+async def _users_xlsx_stream():
+	# слот занят на всё время экспорта: наполнение книги + save()
+	async with _export_sem:
+		book = await run_export(_UsersXlsx)
+		async for batch in iter_users(_EXPORT_BATCH):
+			await run_export(book.add_rows, batch)
+		stream = _stream_save(book.save)
+		try:
+			async for chunk in stream:
+				yield chunk
+		finally:
+			await stream.aclose()
+
+
 @app.get("/export/users.xlsx")
 async def export_users_xlsx():
-	users = await get_users(50000)
-
-	wb = Workbook()
-	ws = wb.active
-	ws.title = "bot_users"
-
-	headers = [
-		"user_id",
-		"username",
-		"first_seen_ts",
-		"last_seen_ts",
-		"first_seen_utc",
-		"last_seen_utc",
-		"starts_count",
-		"messages_count",
-	]
-	ws.append(headers)
+	filename = f"bot_users_{datetime.utcnow().strftime('%Y%m%d_%H%M%S')}.xlsx"
+	return StreamingResponse(
+		_users_xlsx_stream(),
+		media_type=_XLSX_MEDIA_TYPE,
+		headers={"Content-Disposition": f'attachment; filename="{filename}"'},
+	)
 
-	def ts_to_utc_str(ts: int) -> str:
-		if not ts:
-			return ""
-		return datetime.utcfromtimestamp(int(ts)).strftime("%Y-%m-%d %H:%M:%S")
 
-	for u in users:
-		ws.append([
-			u.get("user_id"),
-			u.get("username", ""),
-			u.get("first_seen_ts"),
-			u.get("last_seen_ts"),
-			ts_to_utc_str(u.get("first_seen_ts")),
-			ts_to_utc_str(u.get("last_seen_ts")),
-			u.get("starts_count", 0),
-			u.get("messages_count", 0),
-		])
-
-	for col_idx, h in enumerate(headers, start=1):
-		ws.column_dimensions[get_column_letter(col_idx)].width = max(14, len(h) + 2)
-
-	buf = BytesIO()
-	wb.save(buf)
-	buf.seek(0)
+# CSV: COPY ... TO STDOUT -> очередь -> ответ (опционально gzip на лету).
+# Фильтры уходят в SQL; для events диапазон дат отсекает партиции.
 
-	filename = f"bot_users_{datetime.utcnow().strftime('%Y%m%d_%H%M%S')}.xlsx"
+_EVENTS_EXPORT_DEFAULT_DAYS = 7
+
+
+def _parse_day(s: str):
+	try:
+		return datetime.strptime((s or "").strip(), "%Y-%m-%d").replace(tzinfo=timezone.utc)
+	except ValueError:
+		return None
+
+
+async def _stream_copy(run_copy, gz: bool, max_chunks: int = 16):
+	"""run_copy(output) -> async-итератор байтов; output(chunk) ждёт, если клиент не успевает."""
+	queue: asyncio.Queue = asyncio.Queue(maxsize=max_chunks)
+	done = object()
+
+	async def output(chunk: bytes) -> None:
+		await queue.put(chunk)
+
+	async def run() -> None:
+		try:
+			await run_copy(output)
+		finally:
+			await queue.put(done)
+
+	task = asyncio.create_task(run())
+	z = zlib.compressobj(6, zlib.DEFLATED, 31) if gz else None
+	try:
+		while True:
+			item = await queue.get()
+			if item is done:
+				break
+			if z is None:
+				yield item
+			else:
+				out = z.compress(item)
+				if out:
+					yield out
+		await task  # ошибка COPY -> обрыв ответа, а не "успешный" обрезанный файл
+		if z is not None:
+			yield z.flush()
+	finally:
+		if not task.done():
+			task.cancel()
+
+
+def _csv_response(run_copy, name: str, gz: bool) -> StreamingResponse:
+	stamp = datetime.utcnow().strftime("%Y%m%d_%H%M%S")
+	filename = f"{name}_{stamp}.csv" + (".gz" if gz else "")
 	return StreamingResponse(
-		buf,
-		media_type="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
+		_stream_copy(run_copy, gz),
+		media_type="application/gzip" if gz else "text/csv; charset=utf-8",
 		headers={"Content-Disposition": f'attachment; filename="{filename}"'},
 	)
 
 
+@app.get("/export/users.csv")
+async def export_users_csv(seen_from: str = "", seen_to: str = "", status: str = "", gz: int = 0):
+	"""?seen_from=YYYY-MM-DD&seen_to=YYYY-MM-DD (по last_seen, to — не включая) &status=new|in_progress|completed&gz=1"""
+	d_from, d_to = _parse_day(seen_from), _parse_day(seen_to)
+	status = status if status in USER_STATUSES else ""
+
+	async def run(output):
+		await copy_users_csv(
+			output,
+			seen_from=int(d_from.timestamp()) if d_from else None,
+			seen_to=int(d_to.timestamp()) if d_to else None,
+			status=status,
+		)
+
+	return _csv_response(run, "bot_users", bool(gz))
+
+
+@app.get("/export/events.csv.gz")
+async def export_events_csv_gz(date_from: str = "", date_to: str = "", kind: str = "", flow: str = "", user_id: int = 0):
+	"""?date_from=YYYY-MM-DD&date_to=YYYY-MM-DD (включительно; по умолчанию последние 7 дней) &kind=a,b&flow=&user_id="""
+	d_to = _parse_day(date_to)
+	d_to = (d_to + timedelta(days=1)) if d_to else datetime.now(timezone.utc)
+	d_from = _parse_day(date_from) or (d_to - timedelta(days=_EVENTS_EXPORT_DEFAULT_DAYS))
+	kinds = [k.strip() for k in kind.split(",") if k.strip()]
+
+	async def run(output):
+		await copy_events_csv(
+			output, d_from, d_to,
+			kinds=kinds, flow=(flow or "").strip(), user_id=(user_id or None),
+		)
+
+	return _csv_response(run, "events", True)
+
+
+# ─────────────────────────────────────────────────────────────
+# FLOW BUNDLES (перенос flow между staging и prod)
+#
+# Медиа в бандл не встраиваются: только ссылки /media/... с sha256 и размером.
+# При импорте файлы сверяются с media/ этого сервера — недостающие или другие
+# по содержимому перечисляются в ответе (их нужно скопировать отдельно).
+
+_MEDIA_PREFIX = "/media/"
+
+
+def _bundle_media_refs(flows: list) -> set:
+	refs = set()
+	for f in flows:
+		for b in f.get("blocks") or []:
+			for key in ("circle", "file_path"):
+				p = str(b.get(key) or "").strip()
+				if p.startswith(_MEDIA_PREFIX):
+					refs.add(p)
+	return refs
+
+
+async def _media_sha256(path: str) -> dict:
+	st = os.stat(path)
+	key = (path, int(st.st_mtime_ns), int(st.st_size))
+	digest = _MEDIA_ETAGS.get(key)
+	if digest is None:
+		digest = await run_cpu(_sha256_file, path)
+		_MEDIA_ETAGS[key] = digest
+	return {"sha256": digest, "size": int(st.st_size)}
+
+
+async def _local_media(refs) -> dict:
+	"""ref -> {"sha256", "size"} или None, если файла нет. Хеши считаются параллельно в пуле."""
+	refs = sorted(refs)
+	paths = [_media_abs_path(r[len(_MEDIA_PREFIX):]) for r in refs]
+	infos = await asyncio.gather(*(_media_sha256(p) if p else asyncio.sleep(0) for p in paths))
+	return dict(zip(refs, infos))
+
+
+async def _check_bundle_graph(rec: dict) -> str:
+	"""Как _check_graph_change, но для замены flow бандла целиком."""
+	try:
+		data = await get_flow_graph_data()
+	except Exception:
+		return ""
+
+	before = _graph_from(data)
+
+	names = set(rec["flows"])
+	data["flows"] = data["flows"] + [n for n in rec["flows"] if n not in data["flows"]]
+	data["blocks"] = [b for b in data["blocks"] if b["flow"] not in names] + [
+		{"id": 0, "flow": r[0], "position": r[1], "is_active": r[8], "delay": r[9], "gate_next_flow": r[13]}
+		for r in rec["blocks"]
+	]
+	data["actions"] = [a for a in data["actions"] if a["after_flow"] not in names] + [
+		{"id": 0, "after_flow": r[0], "action_type": r[1], "target_flow": r[2], "delay_seconds": r[3], "is_active": r[4]}
+		for r in rec["actions"]
+	]
+	data["triggers"] = [t for t in data["triggers"] if t["flow"] not in names] + [
+		{"flow": r[0], "trigger": r[1], "offset_seconds": r[2], "is_active": r[3]}
+		for r in rec["triggers"]
+	]
+	data["modes"].update(dict(rec["modes"]))
+
+	return _new_cycle_error(before, _graph_from(data))
+
+
+@app.get("/export/flows.json")
+async def export_flows_json(flow: str = ""):
+	"""?flow=a,b — только эти flow (по умолчанию все)."""
+	names = [f.strip() for f in flow.split(",") if f.strip()] or None
+	bundle = await export_flow_bundle(names)
+	bundle["media"] = await _local_media(_bundle_media_refs(bundle["flows"]))
+
+	stamp = datetime.utcnow().strftime("%Y%m%d_%H%M%S")
+	return JSONResponse(
+		bundle,
+		headers={"Content-Disposition": f'attachment; filename="flows_{stamp}.json"'},
+	)
+
+
+@app.post("/import/flows")
+async def import_flows(bundle_file: UploadFile | None = File(None)):
+	if bundle_file is None or not bundle_file.filename:
+		return RedirectResponse(_with_error("/", "Выбери JSON-файл бандла"), status_code=302)
+
+	raw = await bundle_file.read(_MAX_UPLOAD_BYTES + 1)
+	if len(raw) > _MAX_UPLOAD_BYTES:
+		return RedirectResponse(_with_error("/", "Файл бандла слишком большой"), status_code=302)
+
+	try:
+		bundle = await run_cpu(json.loads, raw)
+		rec = flow_bundle_records(bundle)
+	except (ValueError, TypeError, AttributeError) as e:
+		return RedirectResponse(_with_error("/", f"Импорт отклонён: {e}"), status_code=302)
+
+	err = await _check_bundle_graph(rec)
+	if err:
+		return RedirectResponse(_with_error("/", f"Импорт отклонён: {err}"), status_code=302)
+
+	# ✅ медиа: сверяем sha256 из бандла с файлами на этом сервере
+	expected = bundle.get("media") or {}
+	local = await _local_media(_bundle_media_refs(bundle.get("flows") or []))
+	missing = [r for r, info in local.items() if info is None]
+	changed = [
+		r for r, info in local.items()
+		if info is not None and isinstance(expected.get(r), dict)
+		and expected[r].get("sha256") and expected[r]["sha256"] != info["sha256"]
+	]
+
+	try:
+		names = await import_flow_bundle(bundle)
+	except asyncpg.PostgresError as e:
+		# то, что не поймала проверка бандла (типы/ограничения БД) — транзакция откатилась целиком
+		return RedirectResponse(_with_error("/", f"Импорт отклонён: {e}"), status_code=302)
+
+	problems = []
+	if missing:
+		problems.append("нет файлов: " + ", ".join(missing))
+	if changed:
+		problems.append("другое содержимое: " + ", ".join(changed))
+	if problems:
+		msg = f"Импортировано flow: {', '.join(names)}. Медиа нужно скопировать в media/ — " + "; ".join(problems)
+		return RedirectResponse(_with_error("/", msg), status_code=302)
+	return RedirectResponse("/", status_code=302)
+
+
 # ─────────────────────────────────────────────────────────────
 # FLOWS
 
@@ -507,12 +1314,181 @@ async def flow_down(flow: str):
 	return RedirectResponse("/", status_code=302)
 
 
+async def _json_list(request: Request, key: str) -> Optional[list]:
+	try:
+		body = await request.json()
+	except ValueError:
+		return None
+	items = body.get(key) if isinstance(body, dict) else None
+	return items if isinstance(items, list) else None
+
+
+_STALE_ORDER = "Список устарел — обнови страницу"
+
+
+@app.post("/flow/{flow}/clone")
+async def flow_clone(flow: str, name: str = Form("")):
+	name = (name or "").strip()
+	if not name:
+		return RedirectResponse(_with_error("/", "Укажи имя копии"), status_code=302)
+	try:
+		await clone_flow(flow, name)
+	except ValueError as e:
+		return RedirectResponse(_with_error("/", f"Не удалось скопировать {flow}: {e}"), status_code=302)
+	return RedirectResponse(f"/flow/{name}", status_code=302)
+
+
+@app.post("/flows/reorder")
+async def flows_reorder(request: Request):
+	"""drag-and-drop: {"names": [flow, ...]} — полный порядок flow."""
+	names = await _json_list(request, "names")
+	try:
+		ok = names is not None and await reorder_flows([str(n) for n in names])
+	except ValueError:
+		ok = False
+	if not ok:
+		return JSONResponse({"ok": False, "error": _STALE_ORDER}, status_code=409)
+	return JSONResponse({"ok": True})
+
+
+# ─────────────────────────────────────────────────────────────
+# FUNNEL (funnel_daily: доставки / gate показан / нажат)
+
+_FUNNEL_PERIODS = (1, 7, 30, 90)
+
+
+def _pct(part: int, whole: int) -> str:
+	return f"{part * 100.0 / whole:.1f}%" if whole else "—"
+
+
+@app.get("/funnel", response_class=HTMLResponse)
+async def funnel_page(request: Request, days: int = 7):
+	days = days if days in _FUNNEL_PERIODS else 7
+	rows = await get_funnel(days)
+
+	groups: list[dict] = []
+	by_flow: dict[str, dict] = {}
+	for r in rows:
+		g = by_flow.get(r["flow"])
+		if g is None:
+			g = {"flow": r["flow"], "blocks": [], "reached": r["delivered"]}
+			by_flow[r["flow"]] = g
+			groups.append(g)
+
+		prev = g["blocks"][-1]["delivered"] if g["blocks"] else 0
+		r["from_prev"] = _pct(r["delivered"], prev) if prev else ""
+		r["conversion"] = _pct(r["gate_pressed"], r["gate_shown"]) if r["gate_next_flow"] or r["gate_shown"] else ""
+		g["blocks"].append(r)
+
+	# доля от первого flow — где отваливаются между welcome -> day1 -> ...
+	top = groups[0]["reached"] if groups else 0
+	for g in groups:
+		g["from_top"] = _pct(g["reached"], top)
+
+	return templates.TemplateResponse(
+		"funnel.html",
+		{"request": request, "groups": groups, "days": days, "periods": _FUNNEL_PERIODS},
+	)
+
+
+# ─────────────────────────────────────────────────────────────
+# STATS PAGE + TIME SERIES (stats_series)
+#
+# Бакет может меняться и после своего конца: бот при ошибке записи возвращает точки
+# в буфер и пишет их позже, а несколько процессов бота досылают поздние точки.
+# Поэтому в памяти кешируются только бакеты старше окна повторов (_SERIES_SETTLE_SECONDS),
+# а браузеру — короткий max-age и ETag по самим данным (304 только если числа те же).
+
+_SERIES_DEFAULT_POINTS = {"minute": 180, "hour": 48, "day": 30}
+_SERIES_MAX_POINTS = 2000
+_SERIES_CACHE_SIZE = 256
+# окно, в которое ещё могут прийти поздние/повторные точки; старше — бакет считаем закрытым
+_SERIES_SETTLE_SECONDS = 3600
+_SERIES_CACHE: OrderedDict[tuple, dict] = OrderedDict()
+
+
+async def _closed_series(res: str, metrics: tuple, from_ts: int, to_ts: int) -> dict:
+	key = (res, metrics, from_ts, to_ts)
+	hit = _SERIES_CACHE.get(key)
+	if hit is not None:
+		_SERIES_CACHE.move_to_end(key)
+		return hit
+
+	data = await get_stats_series(res, list(metrics), from_ts, to_ts) if to_ts > from_ts else {m: [] for m in metrics}
+	_SERIES_CACHE[key] = data
+	while len(_SERIES_CACHE) > _SERIES_CACHE_SIZE:
+		_SERIES_CACHE.popitem(last=False)
+	return data
+
+
+@app.get("/stats/series.json")
+async def stats_series_json(request: Request, res: str = "hour", metrics: str = "", since: int = 0, until: int = 0):
+	if res not in SERIES_RESOLUTIONS:
+		return JSONResponse({"error": f"res must be one of {', '.join(SERIES_RESOLUTIONS)}"}, status_code=400)
+
+	wanted = tuple(m for m in (x.strip() for x in metrics.split(",")) if m in SERIES_METRICS) or SERIES_METRICS
+	step = SERIES_RESOLUTIONS[res]
+	now = int(time.time())
+	current = series_bucket(now, res)
+	settled = series_bucket(now - _SERIES_SETTLE_SECONDS, res)
+
+	until = series_bucket(until, res) + step if until > 0 else current + step
+	since = series_bucket(since, res) if since > 0 else until - _SERIES_DEFAULT_POINTS[res] * step
+	since = max(since, until - _SERIES_MAX_POINTS * step)
+
+	data = await _closed_series(res, wanted, since, max(since, min(until, settled)))
+	is_closed = until <= settled
+	if not is_closed:
+		fresh = await get_stats_series(res, list(wanted), max(since, settled), until)
+		data = {m: data[m] + fresh[m] for m in wanted}
+
+	body = {"res": res, "step": step, "since": since, "until": until, "series": data}
+
+	# ETag — по данным: после позднего flush числа (и тег) меняются
+	payload = json.dumps(body, sort_keys=True, separators=(",", ":")).encode()
+	etag = '"' + hashlib.sha1(payload).hexdigest() + '"'
+	# закрытый диапазон меняется редко, текущий бакет — не чаще flush бота
+	headers = {"ETag": etag, "Cache-Control": "max-age=60" if is_closed else "max-age=5"}
+	if _etag_matches(request.headers.get("if-none-match", ""), etag):
+		return Response(status_code=304, headers=headers)
+	return Response(payload, media_type="application/json", headers=headers)
+
+
+@app.get("/stats", response_class=HTMLResponse)
+async def stats_page(request: Request):
+	stats, active, retention = await asyncio.gather(get_stats(), get_active_users(), get_retention(14))
+	return templates.TemplateResponse(
+		"stats.html",
+		{
+			"request": request,
+			"stats": stats,
+			"active": active,
+			"retention": retention,
+			"retention_offsets": list(retention[0]["retention"].keys()) if retention else [],
+			"metrics": SERIES_METRICS,
+			"resolutions": list(SERIES_RESOLUTIONS),
+		},
+	)
+
+
+# ─────────────────────────────────────────────────────────────
+# ACTIVE USERS + RETENTION (activity_bitmaps)
+
+@app.get("/stats/active.json")
+async def stats_active_json(cohort_days: int = 14):
+	cohort_days = max(1, min(int(cohort_days), 90))
+	return {
+		"active": await get_active_users(),
+		"retention": await get_retention(cohort_days),
+	}
+
+
 @app.get("/flow/{flow}", response_class=HTMLResponse)
 async def flow_page(request: Request, flow: str):
 	blocks = await get_blocks(flow)
 	return templates.TemplateResponse(
 		"flow.html",
-		{"request": request, "flow": flow, "blocks": blocks},
+		{"request": request, "flow": flow, "blocks": blocks, "error": request.query_params.get("error", "")},
 	)
 
 
@@ -689,26 +1665,18 @@ async def save_block(
 	if delay_final < 0:
 		delay_final = 0.0
 
-	# ✅ upload circle
-	if circle_file and circle_file.filename:
-		ext = os.path.splitext(circle_file.filename)[1].lower() or ".mp4"
-		fname = f"{uuid.uuid4().hex}{ext}"
-		with open(os.path.join("media", fname), "wb") as f:
-			f.write(await circle_file.read())
-		circle_path = f"/media/{fname}"
-
-	# ✅ upload attachment
-	if attach_file and attach_file.filename:
-		orig_name = _safe_filename(attach_file.filename)
-		ext = os.path.splitext(orig_name)[1].lower()
-		fname = f"{uuid.uuid4().hex}{ext}" if ext else f"{uuid.uuid4().hex}"
-
-		with open(os.path.join("media", fname), "wb") as f:
-			f.write(await attach_file.read())
+	# ✅ upload circle (content-addressed)
+	try:
+		if circle_file and circle_file.filename:
+			circle_path, _ = await _save_upload(circle_file, default_ext=".mp4")
 
-		file_path = f"/media/{fname}"
-		file_name = orig_name
+		# ✅ upload attachment (content-addressed)
+		if attach_file and attach_file.filename:
+			file_path, file_name = await _save_upload(attach_file)
+	except UploadRejected as e:
+		return RedirectResponse(_with_error(f"/flow/{flow}", str(e)), status_code=302)
 
+	if attach_file and attach_file.filename:
 		ct = (attach_file.content_type or "").lower()
 		if ct.startswith("image/"):
 			file_kind = "photo"
@@ -775,6 +1743,17 @@ async def save_block(
 		"gate_reminder_text": gate_reminder_text,
 	}
 
+	err = await _check_graph_change(block={
+		"id": int(block_id),
+		"flow": flow,
+		"position": int(position),
+		"is_active": int(is_active),
+		"delay": float(delay_final),
+		"gate_next_flow": gate_next_flow,
+	})
+	if err:
+		return RedirectResponse(_with_error(f"/flow/{flow}", err), status_code=302)
+
 	if int(block_id) == 0:
 		await create_block(data)
 	else:
@@ -783,25 +1762,60 @@ async def save_block(
 	return RedirectResponse(f"/flow/{flow}", status_code=302)
 
 
+@app.post("/flow/{flow}/blocks/bulk")
+async def blocks_bulk(
+	flow: str,
+	op: str = Form(""),
+	block_ids: list[int] = Form([]),
+	delay_value: float = Form(0.0),
+	delay_unit: str = Form("seconds"),
+):
+	if op not in BLOCK_BULK_OPS or not block_ids:
+		return RedirectResponse(f"/flow/{flow}", status_code=302)
+
+	du = (delay_unit or "seconds").strip().lower()
+	delay = max(0.0, float(delay_value or 0)) * (1 if du == "seconds" else _unit_to_seconds(du))
+
+	err = await _check_bulk_blocks(flow, set(block_ids), op, delay)
+	if err:
+		return RedirectResponse(_with_error(f"/flow/{flow}", err), status_code=302)
+
+	await bulk_update_blocks(flow, block_ids, op, delay_seconds=delay)
+	return RedirectResponse(f"/flow/{flow}", status_code=302)
+
+
 @app.post("/block/{block_id}/delete")
 async def delete_block_action(block_id: int, flow: str = Form(...)):
+	# удаление для графа = блок выключен: мог быть единственной задержкой или gate на кольце
+	block = await get_block(block_id)
+	if block is not None:
+		err = await _check_graph_change(block={**block, "is_active": 0})
+		if err:
+			return RedirectResponse(_with_error(f"/flow/{flow}", err), status_code=302)
 	await delete_block(block_id)
 	return RedirectResponse(f"/flow/{flow}", status_code=302)
 
 
 @app.post("/block/{block_id}/up")
 async def move_up(block_id: int, flow: str = Form(...)):
-	blocks = await get_blocks(flow)
-	idx = next((i for i, b in enumerate(blocks) if b["id"] == block_id), None)
-	if idx is not None and idx > 0:
-		await swap_positions(blocks[idx]["id"], blocks[idx - 1]["id"])
+	await move_block(block_id, "up")
 	return RedirectResponse(f"/flow/{flow}", status_code=302)
 
 
 @app.post("/block/{block_id}/down")
 async def move_down(block_id: int, flow: str = Form(...)):
-	blocks = await get_blocks(flow)
-	idx = next((i for i, b in enumerate(blocks) if b["id"] == block_id), None)
-	if idx is not None and idx < len(blocks) - 1:
-		await swap_positions(blocks[idx]["id"], blocks[idx + 1]["id"])
-	return RedirectResponse(f"/flow/{flow}", status_code=302)
\ No newline at end of file
+	await move_block(block_id, "down")
+	return RedirectResponse(f"/flow/{flow}", status_code=302)
+
+
+@app.post("/flow/{flow}/reorder")
+async def reorder_flow_blocks(request: Request, flow: str):
+	"""drag-and-drop: {"ids": [block_id, ...]} — полный порядок блоков flow."""
+	ids = await _json_list(request, "ids")
+	try:
+		ok = ids is not None and await reorder_blocks(flow, [int(i) for i in ids])
+	except (TypeError, ValueError):
+		ok = False
+	if not ok:
+		return JSONResponse({"ok": False, "error": _STALE_ORDER}, status_code=409)
+	return JSONResponse({"ok": True})
\ No newline at end of file
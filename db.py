@@ -1,23 +1,39 @@
 # db.py (PostgreSQL / asyncpg)
 import os
+import json
+import math
 import time
+import asyncio
+import logging
 import calendar
 from datetime import datetime, timezone, timedelta
-from typing import List, Dict, Optional, Tuple
+from typing import List, Dict, Optional, Tuple, Callable
 
 import asyncpg
 
 DATABASE_URL = os.getenv("DATABASE_URL", "").strip()
 
+log = logging.getLogger(__name__)
+
 _pool: Optional[asyncpg.Pool] = None
 
 
+async def _init_connection(conn: asyncpg.Connection) -> None:
+	# jsonb <-> dict/list без ручного json.loads в каждом месте
+	await conn.set_type_codec(
+		"jsonb",
+		encoder=lambda v: json.dumps(v, ensure_ascii=False),
+		decoder=json.loads,
+		schema="pg_catalog",
+	)
+
+
 async def get_pool() -> asyncpg.Pool:
 	global _pool
 	if _pool is None:
 		if not DATABASE_URL:
 			raise RuntimeError("DATABASE_URL env var is not set. Add it in Railway Variables.")
-		_pool = await asyncpg.create_pool(DATABASE_URL, min_size=1, max_size=10)
+		_pool = await asyncpg.create_pool(DATABASE_URL, min_size=1, max_size=10, init=_init_connection)
 	return _pool
 
 
@@ -33,6 +49,16 @@ async def _column_exists(conn: asyncpg.Connection, table: str, column: str) -> b
 	return await conn.fetchval(q, table, column) is not None
 
 
+async def _column_type(conn: asyncpg.Connection, table: str, column: str) -> str:
+	q = """
+	SELECT data_type
+	FROM information_schema.columns
+	WHERE table_schema='public' AND table_name=$1 AND column_name=$2
+	LIMIT 1
+	"""
+	return (await conn.fetchval(q, table, column) or "").strip().lower()
+
+
 async def _table_exists(conn: asyncpg.Connection, table: str) -> bool:
 	q = """
 	SELECT 1
@@ -97,20 +123,427 @@ def value_unit_to_seconds(value: int, unit: str) -> int:
 	return v * _unit_to_seconds(unit)
 
 
-async def init_db():
-	pool = await get_pool()
-	async with pool.acquire() as conn:
-		# --- USERS ---
+# ===================== VERSIONED MIGRATIONS =====================
+#
+# Тяжёлые миграции (смена типов, бэкфилл) — по номерам в schema_migrations.
+# Бот и CRM оба вызывают init_db, поэтому миграции идут под advisory lock.
+# Каждая миграция идемпотентна: на свежей базе просто ничего не делает.
+
+_MIGRATIONS_LOCK_KEY = 7_310_001
+_MIGRATIONS_LOCK_POLL = 0.5
+_BACKFILL_BATCH = int(os.getenv("MIGRATION_BATCH_SIZE", "5000"))
+
+
+class MigrationSkipped(Exception):
+	"""
+	Необязательная миграция сейчас невозможна (например, нет прав на расширение).
+	Версия не записывается в schema_migrations — попробуем снова при следующем init_db.
+	"""
+
+
+def _affected(status: str) -> int:
+	# "UPDATE 123" -> 123
+	try:
+		return int((status or "").rsplit(" ", 1)[-1])
+	except ValueError:
+		return 0
+
+
+async def _add_constraint_once(conn: asyncpg.Connection, table: str, name: str, ddl: str) -> None:
+	exists = await conn.fetchval("SELECT 1 FROM pg_constraint WHERE conname=$1;", name)
+	if not exists:
+		await conn.execute(f"ALTER TABLE {table} ADD CONSTRAINT {name} {ddl};")
+
+
+async def _set_not_null(conn: asyncpg.Connection, table: str, column: str) -> None:
+	# NOT NULL через CHECK NOT VALID + VALIDATE: проверка без эксклюзивной блокировки; повторный запуск — no-op
+	done = await conn.fetchval(
+		"SELECT attnotnull FROM pg_attribute WHERE attrelid = $1::regclass AND attname = $2;",
+		table, column,
+	)
+	if done:
+		return
+	name = f"{table}_{column}_not_null"
+	await _add_constraint_once(conn, table, name, f"CHECK ({column} IS NOT NULL) NOT VALID")
+	await conn.execute(f"ALTER TABLE {table} VALIDATE CONSTRAINT {name};")
+	await conn.execute(f"ALTER TABLE {table} ALTER COLUMN {column} SET NOT NULL;")
+	await conn.execute(f"ALTER TABLE {table} DROP CONSTRAINT IF EXISTS {name};")
+
+
+# users: текстовые колонки -> типизированные (одни и те же выражения для бэкфилла и догонки под локом)
+_USERS_LAST_START_TZ = r"""CASE WHEN btrim(COALESCE(last_start_at, '')) ~ '^\d{1,12}$'
+	THEN to_timestamp(btrim(last_start_at)::bigint) END"""
+_USERS_UPDATED_TZ = r"""CASE WHEN btrim(COALESCE(updated_at, '')) ~ '^\d{1,12}$'
+	THEN to_timestamp(btrim(updated_at)::bigint) END"""
+_USERS_FLOW_STATUS = """CASE WHEN lower(btrim(COALESCE(flow_status, ''))) IN ('in_progress', 'completed')
+	THEN lower(btrim(flow_status)) ELSE 'new' END"""
+_USERS_TYPED_SET = f"""
+	last_start_at_tz = {_USERS_LAST_START_TZ},
+	updated_at_tz = COALESCE({_USERS_UPDATED_TZ}, updated_at_tz, now()),
+	flow_status_v = {_USERS_FLOW_STATUS}
+"""
+
+
+async def _migrate_users_state_jsonb(conn: asyncpg.Connection) -> None:
+	"""
+	users.state: TEXT (json строкой) -> JSONB; битый/пустой json -> {}.
+	Как typed-колонки ниже: state_v рядом, бэкфилл пачками, догонка + swap под коротким локом.
+	"""
+	if await _column_type(conn, "users", "state") == "text":
 		await conn.execute("""
-		CREATE TABLE IF NOT EXISTS users (
-			user_id BIGINT PRIMARY KEY,
-			state TEXT DEFAULT '',
-			flow_status TEXT DEFAULT '',
-			last_start_at TEXT DEFAULT '',
-			updated_at TEXT DEFAULT ''
-		);
+		CREATE OR REPLACE FUNCTION pg_temp.try_jsonb(s TEXT) RETURNS JSONB AS $$
+		BEGIN
+			IF s IS NULL OR btrim(s) = '' THEN
+				RETURN '{}'::jsonb;
+			END IF;
+			RETURN CASE WHEN jsonb_typeof(s::jsonb) = 'object' THEN s::jsonb ELSE '{}'::jsonb END;
+		EXCEPTION WHEN others THEN
+			RETURN '{}'::jsonb;
+		END;
+		$$ LANGUAGE plpgsql IMMUTABLE;
+		""")
+		try:
+			await conn.execute("ALTER TABLE users ADD COLUMN IF NOT EXISTS state_v JSONB;")
+
+			last_id = -1
+			while True:
+				ids = await conn.fetch(
+					"SELECT user_id FROM users WHERE user_id > $1 ORDER BY user_id ASC LIMIT $2;",
+					last_id, _BACKFILL_BATCH,
+				)
+				if not ids:
+					break
+				last_id = int(ids[-1]["user_id"])
+				await conn.execute(
+					"UPDATE users SET state_v = pg_temp.try_jsonb(state) WHERE user_id = ANY($1::bigint[]);",
+					[int(r["user_id"]) for r in ids],
+				)
+
+			async with conn.transaction():
+				await conn.execute("LOCK TABLE users IN ACCESS EXCLUSIVE MODE;")
+				# новые строки и state, изменённый старым кодом за время бэкфилла
+				await conn.execute("""
+					UPDATE users SET state_v = pg_temp.try_jsonb(state)
+					WHERE state_v IS DISTINCT FROM pg_temp.try_jsonb(state);
+				""")
+				await conn.execute("ALTER TABLE users DROP COLUMN state;")
+				await conn.execute("ALTER TABLE users RENAME COLUMN state_v TO state;")
+				await conn.execute("ALTER TABLE users ALTER COLUMN state SET DEFAULT '{}'::jsonb;")
+		finally:
+			await conn.execute("DROP FUNCTION IF EXISTS pg_temp.try_jsonb(TEXT);")
+
+	if await _column_type(conn, "users", "state") == "jsonb":
+		await _set_not_null(conn, "users", "state")
+
+
+async def _migrate_users_typed_columns(conn: asyncpg.Connection) -> None:
+	"""
+	users.last_start_at / updated_at: TEXT (epoch строкой) -> TIMESTAMPTZ,
+	users.flow_status: свободный текст -> 'new' | 'in_progress' | 'completed'.
+	users.state: TEXT -> JSONB (_migrate_users_state_jsonb; раньше было в init_db).
+
+	Новые колонки добавляются рядом (без перезаписи таблицы), заполняются
+	пачками по user_id (короткие транзакции, без долгой блокировки),
+	потом старые колонки меняются на новые в одной быстрой транзакции.
+	"""
+	if not await _table_exists(conn, "users"):
+		return
+
+	await _migrate_users_state_jsonb(conn)
+
+	if await _column_type(conn, "users", "updated_at") == "text":
+		await conn.execute("ALTER TABLE users ADD COLUMN IF NOT EXISTS last_start_at_tz TIMESTAMPTZ;")
+		await conn.execute("ALTER TABLE users ADD COLUMN IF NOT EXISTS updated_at_tz TIMESTAMPTZ;")
+		await conn.execute("ALTER TABLE users ADD COLUMN IF NOT EXISTS flow_status_v TEXT;")
+
+		last_id = -1
+		while True:
+			ids = await conn.fetch(
+				"SELECT user_id FROM users WHERE user_id > $1 ORDER BY user_id ASC LIMIT $2;",
+				last_id, _BACKFILL_BATCH,
+			)
+			if not ids:
+				break
+			last_id = int(ids[-1]["user_id"])
+			await conn.execute(f"""
+				UPDATE users SET {_USERS_TYPED_SET}
+				WHERE user_id = ANY($1::bigint[]);
+			""", [int(r["user_id"]) for r in ids])
+
+		async with conn.transaction():
+			await conn.execute("LOCK TABLE users IN ACCESS EXCLUSIVE MODE;")
+			# догоняем строки, появившиеся или изменённые старым кодом за время бэкфилла
+			await conn.execute(f"""
+				UPDATE users SET {_USERS_TYPED_SET}
+				WHERE updated_at_tz IS NULL
+				   OR last_start_at_tz IS DISTINCT FROM ({_USERS_LAST_START_TZ})
+				   OR updated_at_tz IS DISTINCT FROM COALESCE({_USERS_UPDATED_TZ}, updated_at_tz)
+				   OR flow_status_v IS DISTINCT FROM ({_USERS_FLOW_STATUS});
+			""")
+			await conn.execute("""
+				ALTER TABLE users
+					DROP COLUMN last_start_at,
+					DROP COLUMN updated_at,
+					DROP COLUMN flow_status;
+			""")
+			await conn.execute("ALTER TABLE users RENAME COLUMN last_start_at_tz TO last_start_at;")
+			await conn.execute("ALTER TABLE users RENAME COLUMN updated_at_tz TO updated_at;")
+			await conn.execute("ALTER TABLE users RENAME COLUMN flow_status_v TO flow_status;")
+			await conn.execute("ALTER TABLE users ALTER COLUMN updated_at SET DEFAULT now();")
+			await conn.execute("ALTER TABLE users ALTER COLUMN flow_status SET DEFAULT 'new';")
+
+	# вне if: если процесс упал после swap, повторный запуск доделает ограничения
+	if await _column_type(conn, "users", "updated_at") == "timestamp with time zone":
+		await _set_not_null(conn, "users", "updated_at")
+		await _add_constraint_once(
+			conn, "users", "users_flow_status_check",
+			"CHECK (flow_status IN ('new', 'in_progress', 'completed')) NOT VALID",
+		)
+		await conn.execute("ALTER TABLE users VALIDATE CONSTRAINT users_flow_status_check;")
+		await _set_not_null(conn, "users", "flow_status")
+
+	# CONCURRENTLY — без блокировки записи (вне транзакции)
+	await conn.execute("CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_users_updated_at ON users(updated_at);")
+	await conn.execute("CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_users_last_start_at ON users(last_start_at);")
+	await conn.execute("CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_users_flow_status ON users(flow_status);")
+
+
+async def _migrate_merge_users_into_bot_users(conn: asyncpg.Connection) -> None:
+	"""
+	users (state) + bot_users (счётчики, username, seen) -> одна запись в bot_users.
+
+	Колонки добавляются с константными дефолтами (без перезаписи таблицы),
+	данные users переносятся пачками, затем в короткой транзакции догоняем
+	строки, изменённые за время переноса, и переименовываем users -> users_legacy
+	(оставляем для отката; удалить руками, когда всё проверено).
+	"""
+	await conn.execute("""
+		ALTER TABLE bot_users
+			ADD COLUMN IF NOT EXISTS state JSONB NOT NULL DEFAULT '{}'::jsonb,
+			ADD COLUMN IF NOT EXISTS flow_status TEXT NOT NULL DEFAULT 'new',
+			ADD COLUMN IF NOT EXISTS last_start_at TIMESTAMPTZ,
+			ADD COLUMN IF NOT EXISTS updated_at TIMESTAMPTZ NOT NULL DEFAULT now();
+	""")
+
+	has_check = await conn.fetchval("""
+		SELECT 1 FROM pg_constraint
+		WHERE conname='bot_users_flow_status_check' AND conrelid='bot_users'::regclass;
+	""")
+	if not has_check:
+		await conn.execute("""
+			ALTER TABLE bot_users ADD CONSTRAINT bot_users_flow_status_check
+				CHECK (flow_status IN ('new', 'in_progress', 'completed')) NOT VALID;
+		""")
+		await conn.execute("ALTER TABLE bot_users VALIDATE CONSTRAINT bot_users_flow_status_check;")
+
+	copy_sql = """
+		INSERT INTO bot_users(
+			user_id, username, first_seen_ts, last_seen_ts,
+			state, flow_status, last_start_at, updated_at
+		)
+		SELECT
+			u.user_id, '',
+			EXTRACT(EPOCH FROM u.updated_at)::bigint, EXTRACT(EPOCH FROM u.updated_at)::bigint,
+			u.state, u.flow_status, u.last_start_at, u.updated_at
+		FROM users u
+		WHERE {where}
+		ON CONFLICT (user_id) DO UPDATE SET
+			state=EXCLUDED.state,
+			flow_status=EXCLUDED.flow_status,
+			last_start_at=COALESCE(EXCLUDED.last_start_at, bot_users.last_start_at),
+			updated_at=EXCLUDED.updated_at;
+	"""
+
+	if await _table_exists(conn, "users"):
+		started = await conn.fetchval("SELECT now();")
+
+		last_id = -1
+		while True:
+			ids = await conn.fetch(
+				"SELECT user_id FROM users WHERE user_id > $1 ORDER BY user_id ASC LIMIT $2;",
+				last_id, _BACKFILL_BATCH,
+			)
+			if not ids:
+				break
+			last_id = int(ids[-1]["user_id"])
+			await conn.execute(
+				copy_sql.format(where="u.user_id = ANY($1::bigint[])"),
+				[int(r["user_id"]) for r in ids],
+			)
+
+		async with conn.transaction():
+			await conn.execute("LOCK TABLE users IN EXCLUSIVE MODE;")
+			await conn.execute(copy_sql.format(where="u.updated_at >= $1"), started)
+			await conn.execute("ALTER TABLE users RENAME TO users_legacy;")
+
+	await conn.execute("CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_bot_users_flow_status ON bot_users(flow_status);")
+	await conn.execute("CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_bot_users_last_start_at ON bot_users(last_start_at);")
+
+
+async def _migrate_seed_stats_rollups(conn: asyncpg.Connection) -> None:
+	"""
+	Начальное заполнение stats_totals / stats_hourly из bot_users.
+	По часам восстанавливаем только new_users (first_seen_ts) —
+	старты/сообщения по времени раньше не хранились.
+	"""
+	async with conn.transaction():
+		await conn.execute("""
+			INSERT INTO stats_totals(id, total_users, total_starts, total_messages, reconciled_ts)
+			SELECT 1, COUNT(*), COALESCE(SUM(starts_count),0), COALESCE(SUM(messages_count),0), $1
+			FROM bot_users
+			ON CONFLICT (id) DO UPDATE SET
+				total_users=EXCLUDED.total_users,
+				total_starts=EXCLUDED.total_starts,
+				total_messages=EXCLUDED.total_messages,
+				reconciled_ts=EXCLUDED.reconciled_ts;
+		""", int(time.time()))
+		await conn.execute("""
+			INSERT INTO stats_hourly(hour_ts, new_users)
+			SELECT first_seen_ts - first_seen_ts % 3600, COUNT(*)
+			FROM bot_users
+			GROUP BY 1
+			ON CONFLICT (hour_ts) DO UPDATE SET new_users=EXCLUDED.new_users;
 		""")
 
+
+async def _migrate_bot_users_recency_index(conn: asyncpg.Connection) -> None:
+	# (last_seen_ts, user_id) — ORDER BY ... DESC и keyset-курсор одним index scan
+	await conn.execute("""
+		CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_bot_users_last_seen
+		ON bot_users(last_seen_ts DESC, user_id DESC);
+	""")
+
+
+async def _migrate_bot_users_dense_seq(conn: asyncpg.Connection) -> None:
+	"""
+	bot_users.seq — плотный номер юзера 1..N для битмапов активности.
+	Telegram user_id разрежены (до ~10^10), по ним битмап был бы гигабайтным,
+	а по seq — N/8 байт в день.
+
+	Колонка без дефолта (без перезаписи таблицы), дефолт nextval — только для новых
+	строк; старые нумеруются пачками по user_id.
+	"""
+	await conn.execute("ALTER TABLE bot_users ADD COLUMN IF NOT EXISTS seq BIGINT;")
+	await conn.execute("CREATE SEQUENCE IF NOT EXISTS bot_users_seq OWNED BY bot_users.seq;")
+	await conn.execute("ALTER TABLE bot_users ALTER COLUMN seq SET DEFAULT nextval('bot_users_seq');")
+
+	last_id = -1
+	while True:
+		ids = await conn.fetch(
+			"SELECT user_id FROM bot_users WHERE user_id > $1 AND seq IS NULL ORDER BY user_id ASC LIMIT $2;",
+			last_id, _BACKFILL_BATCH,
+		)
+		if not ids:
+			break
+		last_id = int(ids[-1]["user_id"])
+		await conn.execute(
+			"UPDATE bot_users SET seq = nextval('bot_users_seq') WHERE user_id = ANY($1::bigint[]) AND seq IS NULL;",
+			[int(r["user_id"]) for r in ids],
+		)
+
+	await conn.execute("CREATE UNIQUE INDEX CONCURRENTLY IF NOT EXISTS ux_bot_users_seq ON bot_users(seq);")
+
+
+async def _migrate_bot_users_username_trgm(conn: asyncpg.Connection) -> None:
+	"""
+	Поиск юзеров в CRM: GIN (pg_trgm) по username — ILIKE '%...%' без seq scan.
+	Если расширение поставить нельзя (нет прав), поиск работает и без индекса,
+	а миграция повторится при следующем старте (когда права выдадут).
+	"""
+	try:
+		await conn.execute("CREATE EXTENSION IF NOT EXISTS pg_trgm;")
+	except asyncpg.PostgresError as e:
+		raise MigrationSkipped(f"pg_trgm: {e}") from e
+	await conn.execute("""
+		CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_bot_users_username_trgm
+		ON bot_users USING gin (username gin_trgm_ops);
+	""")
+
+
+async def _migrate_unique_positions(conn: asyncpg.Connection) -> None:
+	"""
+	UNIQUE (flow, position) у блоков и UNIQUE (sort_order) у flows.
+	DEFERRABLE: проверка в конце statement, поэтому перестановка одним UPDATE
+	(обмен позиций, drag-and-drop) не спотыкается о промежуточные дубли.
+	Существующие дубли перенумеровываются с сохранением порядка (position, id).
+	"""
+	await conn.execute("""
+		UPDATE content_blocks c
+		SET position = n.rn
+		FROM (
+			SELECT id, row_number() OVER (PARTITION BY flow ORDER BY position, id) AS rn
+			FROM content_blocks
+			WHERE flow IN (
+				SELECT flow FROM content_blocks GROUP BY flow, position HAVING COUNT(*) > 1
+			)
+		) n
+		WHERE c.id = n.id AND c.position <> n.rn;
+	""")
+	await _add_constraint_once(
+		conn, "content_blocks", "ux_content_blocks_flow_position",
+		"UNIQUE (flow, position) DEFERRABLE INITIALLY IMMEDIATE",
+	)
+
+	await conn.execute("""
+		UPDATE flows f
+		SET sort_order = n.rn
+		FROM (SELECT name, row_number() OVER (ORDER BY sort_order, name) AS rn FROM flows) n
+		WHERE f.name = n.name AND f.sort_order <> n.rn
+		  AND EXISTS (SELECT 1 FROM flows GROUP BY sort_order HAVING COUNT(*) > 1);
+	""")
+	await _add_constraint_once(
+		conn, "flows", "ux_flows_sort_order",
+		"UNIQUE (sort_order) DEFERRABLE INITIALLY IMMEDIATE",
+	)
+
+
+# (version, name, fn) — только добавлять в конец, номера не переиспользовать
+_MIGRATIONS = [
+	(1, "users typed timestamps + flow_status", _migrate_users_typed_columns),
+	(2, "merge users into bot_users", _migrate_merge_users_into_bot_users),
+	(3, "seed stats rollups", _migrate_seed_stats_rollups),
+	(4, "bot_users recency index", _migrate_bot_users_recency_index),
+	(5, "bot_users dense seq", _migrate_bot_users_dense_seq),
+	(6, "bot_users username trigram index", _migrate_bot_users_username_trgm),
+	(7, "unique block positions and flow order", _migrate_unique_positions),
+]
+
+
+async def _apply_migrations(conn: asyncpg.Connection) -> None:
+	await conn.execute("""
+	CREATE TABLE IF NOT EXISTS schema_migrations (
+		version INTEGER PRIMARY KEY,
+		name TEXT NOT NULL DEFAULT '',
+		applied_ts BIGINT NOT NULL DEFAULT 0
+	);
+	""")
+
+	# не pg_advisory_lock: ожидающий держал бы открытый снапшот, а CREATE INDEX CONCURRENTLY
+	# у держателя лока ждёт все снапшоты -> deadlock при одновременном старте бота и CRM
+	while not await conn.fetchval("SELECT pg_try_advisory_lock($1);", _MIGRATIONS_LOCK_KEY):
+		await asyncio.sleep(_MIGRATIONS_LOCK_POLL)
+	try:
+		rows = await conn.fetch("SELECT version FROM schema_migrations;")
+		applied = {int(r["version"]) for r in rows}
+		for version, name, fn in _MIGRATIONS:
+			if version in applied:
+				continue
+			try:
+				await fn(conn)
+			except MigrationSkipped as e:
+				log.warning("migration %s (%s) skipped, will retry: %s", version, name, e)
+				continue
+			await conn.execute(
+				"INSERT INTO schema_migrations(version, name, applied_ts) VALUES ($1, $2, $3) ON CONFLICT (version) DO NOTHING;",
+				int(version), name, int(time.time()),
+			)
+	finally:
+		await conn.execute("SELECT pg_advisory_unlock($1);", _MIGRATIONS_LOCK_KEY)
+
+
+async def init_db():
+	pool = await get_pool()
+	async with pool.acquire() as conn:
 		# --- FLOWS ---
 		await conn.execute("""
 		CREATE TABLE IF NOT EXISTS flows (
@@ -167,7 +600,7 @@ async def init_db():
 		ON jobs(user_id, flow);
 		""")
 
-		# --- BOT USERS ---
+		# --- BOT USERS (единая запись юзера: аналитика + state) ---
 		await conn.execute("""
 		CREATE TABLE IF NOT EXISTS bot_users (
 			user_id BIGINT PRIMARY KEY,
@@ -175,7 +608,70 @@ async def init_db():
 			first_seen_ts BIGINT NOT NULL,
 			last_seen_ts BIGINT NOT NULL,
 			starts_count BIGINT NOT NULL DEFAULT 0,
-			messages_count BIGINT NOT NULL DEFAULT 0
+			messages_count BIGINT NOT NULL DEFAULT 0,
+
+			state JSONB NOT NULL DEFAULT '{}'::jsonb,
+			flow_status TEXT NOT NULL DEFAULT 'new'
+				CONSTRAINT bot_users_flow_status_check CHECK (flow_status IN ('new', 'in_progress', 'completed')),
+			last_start_at TIMESTAMPTZ,
+			updated_at TIMESTAMPTZ NOT NULL DEFAULT now()
+		);
+		""")
+
+		# --- STATS ROLLUPS (ведёт flush_user_activity, чинит reconcile_stats) ---
+		await conn.execute("""
+		CREATE TABLE IF NOT EXISTS stats_totals (
+			id SMALLINT PRIMARY KEY DEFAULT 1 CHECK (id = 1),
+			total_users BIGINT NOT NULL DEFAULT 0,
+			total_starts BIGINT NOT NULL DEFAULT 0,
+			total_messages BIGINT NOT NULL DEFAULT 0,
+			reconciled_ts BIGINT NOT NULL DEFAULT 0
+		);
+		""")
+		await conn.execute("""
+		CREATE TABLE IF NOT EXISTS stats_hourly (
+			hour_ts BIGINT PRIMARY KEY,
+			new_users BIGINT NOT NULL DEFAULT 0,
+			starts BIGINT NOT NULL DEFAULT 0,
+			messages BIGINT NOT NULL DEFAULT 0,
+			active_users BIGINT NOT NULL DEFAULT 0
+		);
+		""")
+
+		# --- STATS SERIES: метрики по бакетам minute/hour/day (sum, n, max) ---
+		await conn.execute("""
+		CREATE TABLE IF NOT EXISTS stats_series (
+			res TEXT NOT NULL,
+			metric TEXT NOT NULL,
+			bucket_ts BIGINT NOT NULL,
+			total BIGINT NOT NULL DEFAULT 0,
+			n BIGINT NOT NULL DEFAULT 0,
+			vmax BIGINT NOT NULL DEFAULT 0,
+			PRIMARY KEY (res, metric, bucket_ts)
+		);
+		""")
+
+		# --- ACTIVITY BITMAPS: kind='active' (был активен в day) / 'cohort' (первый /start в day) ---
+		await conn.execute("""
+		CREATE TABLE IF NOT EXISTS activity_bitmaps (
+			day DATE NOT NULL,
+			kind TEXT NOT NULL,
+			chunk INTEGER NOT NULL,
+			bits BIT VARYING NOT NULL,
+			PRIMARY KEY (kind, day, chunk)
+		);
+		""")
+
+		# --- FUNNEL: доставки/gate по (день, flow, блок), ведут copy_events и mark_gate_pressed ---
+		await conn.execute("""
+		CREATE TABLE IF NOT EXISTS funnel_daily (
+			day DATE NOT NULL,
+			flow TEXT NOT NULL,
+			block_id BIGINT NOT NULL,
+			delivered BIGINT NOT NULL DEFAULT 0,
+			gate_shown BIGINT NOT NULL DEFAULT 0,
+			gate_pressed BIGINT NOT NULL DEFAULT 0,
+			PRIMARY KEY (day, flow, block_id)
 		);
 		""")
 
@@ -243,6 +739,14 @@ async def init_db():
 		);
 		""")
 
+		# ✅ FLOW VERSIONS: растёт при каждом изменении контента flow (для кеша в боте)
+		await conn.execute("""
+		CREATE TABLE IF NOT EXISTS flow_versions (
+			flow TEXT PRIMARY KEY,
+			version BIGINT NOT NULL DEFAULT 0
+		);
+		""")
+
 		# ---------------- MIGRATIONS ----------------
 
 		if not await _column_exists(conn, "flows", "sort_order"):
@@ -321,6 +825,9 @@ async def init_db():
 		except Exception:
 			pass
 
+		# ✅ версионные миграции (schema_migrations)
+		await _apply_migrations(conn)
+
 		# restore flows if empty
 		cnt = await conn.fetchval("SELECT COUNT(*) FROM flows;")
 		if int(cnt or 0) == 0:
@@ -334,6 +841,20 @@ async def init_db():
 				)
 				order += 1
 
+		# ✅ EVENTS: append-only лог, партиции по дням (см. EVENT LOG ниже)
+		await conn.execute("""
+		CREATE TABLE IF NOT EXISTS events (
+			ts TIMESTAMPTZ NOT NULL,
+			user_id BIGINT NOT NULL,
+			kind TEXT NOT NULL,
+			flow TEXT NOT NULL DEFAULT '',
+			block_id BIGINT NOT NULL DEFAULT 0,
+			detail TEXT NOT NULL DEFAULT ''
+		) PARTITION BY RANGE (ts);
+		""")
+		await conn.execute("CREATE INDEX IF NOT EXISTS ix_events_user_ts ON events (user_id, ts);")
+		await _ensure_event_partitions(conn, datetime.now(timezone.utc).date(), EVENTS_PRECREATE_DAYS)
+
 		# ✅ ensure flow_modes exists for every flow (default off)
 		flow_rows = await conn.fetch("SELECT name FROM flows;")
 		for r in flow_rows:
@@ -426,24 +947,25 @@ async def list_broadcasts() -> List[Dict]:
 			FROM broadcasts
 			ORDER BY id DESC;
 		""")
-	return [
-		{
-			"id": int(r["id"]),
-			"title": r["title"] or "",
-			"flow": (r["flow"] or "").strip(),
-			"target_user_id": (int(r["target_user_id"]) if r["target_user_id"] is not None else None),
-			"schedule_type": (r["schedule_type"] or "monthly").strip(),
-			"interval_days": int(r["interval_days"] or 30),
-			"days_of_month": (r["days_of_month"] or "1").strip(),
-			"at_hour": int(r["at_hour"] or 12),
-			"at_minute": int(r["at_minute"] or 0),
-			"next_run_ts": int(r["next_run_ts"] or 0),
-			"last_run_ts": int(r["last_run_ts"] or 0),
-			"is_active": int(r["is_active"] or 0),
-			"created_ts": int(r["created_ts"] or 0),
-		}
-		for r in rows
-	]
+	return [_broadcast_row_to_dict(r) for r in rows]
+
+
+def _broadcast_row_to_dict(r: asyncpg.Record) -> Dict:
+	return {
+		"id": int(r["id"]),
+		"title": r["title"] or "",
+		"flow": (r["flow"] or "").strip(),
+		"target_user_id": (int(r["target_user_id"]) if r["target_user_id"] is not None else None),
+		"schedule_type": (r["schedule_type"] or "monthly").strip(),
+		"interval_days": int(r["interval_days"] or 30),
+		"days_of_month": (r["days_of_month"] or "1").strip(),
+		"at_hour": int(r["at_hour"] or 12),
+		"at_minute": int(r["at_minute"] or 0),
+		"next_run_ts": int(r["next_run_ts"] or 0),
+		"last_run_ts": int(r["last_run_ts"] or 0),
+		"is_active": int(r["is_active"] or 0),
+		"created_ts": int(r["created_ts"] or 0),
+	}
 
 
 async def create_broadcast(
@@ -606,13 +1128,14 @@ async def set_flow_mode(flow: str, mode: str) -> None:
 	mode = _norm_mode(mode)
 
 	pool = await get_pool()
-	async with pool.acquire() as conn:
+	async with pool.acquire() as conn, conn.transaction():
 		await conn.execute("""
 		INSERT INTO flow_modes(flow, mode)
 		VALUES ($1, $2)
 		ON CONFLICT (flow) DO UPDATE SET
 			mode=EXCLUDED.mode;
 		""", flow, mode)
+		await _notify_config_changed(conn, "modes")
 
 
 # ===================== FLOW ACTIONS =====================
@@ -639,17 +1162,18 @@ async def get_flow_actions(after_flow: Optional[str] = None) -> List[Dict]:
 			ORDER BY after_flow ASC, id ASC;
 			""")
 
-	return [
-		{
-			"id": int(r["id"]),
-			"after_flow": (r["after_flow"] or "").strip(),
-			"action_type": (r["action_type"] or "start_flow").strip(),
-			"target_flow": (r["target_flow"] or "").strip(),
-			"delay_seconds": int(r["delay_seconds"] or 0),
-			"is_active": int(r["is_active"] or 0),
-		}
-		for r in rows
-	]
+	return [_action_row_to_dict(r) for r in rows]
+
+
+def _action_row_to_dict(r: asyncpg.Record) -> Dict:
+	return {
+		"id": int(r["id"]),
+		"after_flow": (r["after_flow"] or "").strip(),
+		"action_type": (r["action_type"] or "start_flow").strip(),
+		"target_flow": (r["target_flow"] or "").strip(),
+		"delay_seconds": int(r["delay_seconds"] or 0),
+		"is_active": int(r["is_active"] or 0),
+	}
 
 
 async def upsert_flow_action(
@@ -671,7 +1195,7 @@ async def upsert_flow_action(
 	is_active = 1 if int(is_active) else 0
 
 	pool = await get_pool()
-	async with pool.acquire() as conn:
+	async with pool.acquire() as conn, conn.transaction():
 		await conn.execute("""
 		INSERT INTO flow_actions(after_flow, action_type, target_flow, delay_seconds, is_active)
 		VALUES ($1, $2, $3, $4, $5)
@@ -679,12 +1203,14 @@ async def upsert_flow_action(
 			delay_seconds=EXCLUDED.delay_seconds,
 			is_active=EXCLUDED.is_active;
 		""", after_flow, action_type, target_flow, delay_seconds, is_active)
+		await _notify_config_changed(conn, "actions")
 
 
 async def delete_flow_action(action_id: int) -> None:
 	pool = await get_pool()
-	async with pool.acquire() as conn:
+	async with pool.acquire() as conn, conn.transaction():
 		await conn.execute("DELETE FROM flow_actions WHERE id=$1;", int(action_id))
+		await _notify_config_changed(conn, "actions")
 
 
 async def delete_flow_actions_for_flow(flow: str) -> None:
@@ -695,160 +1221,943 @@ async def delete_flow_actions_for_flow(flow: str) -> None:
 	if not flow:
 		return
 	pool = await get_pool()
-	async with pool.acquire() as conn:
+	async with pool.acquire() as conn, conn.transaction():
 		await conn.execute("""
 		DELETE FROM flow_actions
 		WHERE after_flow=$1 OR target_flow=$1;
 		""", flow)
+		await _notify_config_changed(conn, "actions")
 
 
-# ===================== BOT ANALYTICS =====================
-
-async def inc_start(user_id: int, username: Optional[str]):
-	now = int(time.time())
-	username = (username or "").strip()
+# ===================== USER STATE (bot_users.state JSONB) =====================
 
+async def get_user_state(user_id: int) -> Dict:
 	pool = await get_pool()
 	async with pool.acquire() as conn:
-		await conn.execute("""
-		INSERT INTO bot_users(user_id, username, first_seen_ts, last_seen_ts, starts_count, messages_count)
-		VALUES ($1, $2, $3, $4, 1, 0)
-		ON CONFLICT (user_id) DO UPDATE SET
-			username=EXCLUDED.username,
-			last_seen_ts=EXCLUDED.last_seen_ts,
-			starts_count=bot_users.starts_count + 1;
-		""", int(user_id), username, now, now)
+		v = await conn.fetchval("SELECT state FROM bot_users WHERE user_id=$1;", int(user_id))
+	return v if isinstance(v, dict) else {}
 
 
-async def inc_message(user_id: int, username: Optional[str]):
+async def mark_course_completed(user_id: int) -> Dict:
+	"""
+	Конец курса: lessons_unlocked=true + flow_status='completed' одним UPSERT.
+	"""
 	now = int(time.time())
-	username = (username or "").strip()
-
 	pool = await get_pool()
 	async with pool.acquire() as conn:
-		await conn.execute("""
-		INSERT INTO bot_users(user_id, username, first_seen_ts, last_seen_ts, starts_count, messages_count)
-		VALUES ($1, $2, $3, $4, 0, 1)
-		ON CONFLICT (user_id) DO UPDATE SET
-			username=EXCLUDED.username,
-			last_seen_ts=EXCLUDED.last_seen_ts,
-			messages_count=bot_users.messages_count + 1;
-		""", int(user_id), username, now, now)
+		v = await conn.fetchval("""
+			INSERT INTO bot_users(user_id, first_seen_ts, last_seen_ts, state, flow_status)
+			VALUES ($1, $2, $2, '{"lessons_unlocked": true}'::jsonb, 'completed')
+			ON CONFLICT (user_id) DO UPDATE SET
+				state=jsonb_set(bot_users.state, '{lessons_unlocked}', 'true'::jsonb, true),
+				flow_status='completed',
+				updated_at=now()
+			RETURNING state;
+		""", int(user_id), now)
+	return v if isinstance(v, dict) else {}
 
 
-async def get_stats():
-	now = int(time.time())
-	hour_ago = now - 3600
+# ===================== BOT ANALYTICS =====================
 
-	pool = await get_pool()
-	async with pool.acquire() as conn:
-		total_users = await conn.fetchval("SELECT COUNT(*) FROM bot_users;")
-		active_last_hour = await conn.fetchval(
-			"SELECT COUNT(*) FROM bot_users WHERE last_seen_ts >= $1;",
-			hour_ago
-		)
-		row = await conn.fetchrow("""
-			SELECT COALESCE(SUM(starts_count),0) AS starts,
-				   COALESCE(SUM(messages_count),0) AS messages
-			FROM bot_users;
-		""")
+def _hour(ts: int) -> int:
+	return int(ts) - int(ts) % 3600
 
-	return {
-		"total_users": int(total_users or 0),
-		"active_last_hour": int(active_last_hour or 0),
-		"total_starts": int(row["starts"] or 0),
-		"total_messages": int(row["messages"] or 0),
-	}
 
+def _rollup_deltas(rows, prev_seen: Dict[int, int]) -> Dict[int, List[int]]:
+	"""
+	hour_ts -> [new_users, starts, messages, active_users].
+	Пачка покрывает секунды, поэтому все дельты юзера относим к часу его last_ts;
+	активным в этом часе юзер считается, если до пачки его там ещё не было.
+	"""
+	hourly: Dict[int, List[int]] = {}
+	for user_id, _, starts, messages, first_ts, last_ts, _ in rows:
+		h = _hour(last_ts)
+		d = hourly.setdefault(h, [0, 0, 0, 0])
+		d[1] += int(starts)
+		d[2] += int(messages)
+
+		prev = prev_seen.get(int(user_id))
+		if prev is None:
+			hourly.setdefault(_hour(first_ts), [0, 0, 0, 0])[0] += 1
+		if prev is None or int(prev) < h:
+			d[3] += 1
+	return hourly
+
+
+async def flush_user_activity(rows: List[Tuple[int, str, int, int, int, int, int]]) -> None:
+	"""
+	Пачка накопленной активности одним UPSERT + инкремент stats_totals/stats_hourly
+	и OR в activity_bitmaps в той же транзакции.
+	rows: (user_id, username, starts, messages, first_ts, last_ts, last_start_ts|0)
+	"""
+	if not rows:
+		return
 
-async def get_users(limit: int = 500):
+	cols = list(zip(*rows))
 	pool = await get_pool()
 	async with pool.acquire() as conn:
-		rows = await conn.fetch("""
-		SELECT user_id, username, first_seen_ts, last_seen_ts, starts_count, messages_count
-		FROM bot_users
-		ORDER BY last_seen_ts DESC
-		LIMIT $1;
-		""", int(limit))
+		async with conn.transaction():
+			# старый last_seen_ts нужен для new/active; FOR UPDATE в порядке user_id — без дедлоков
+			prev = await conn.fetch("""
+				SELECT user_id, last_seen_ts, starts_count FROM bot_users
+				WHERE user_id = ANY($1::bigint[])
+				ORDER BY user_id
+				FOR UPDATE;
+			""", list(cols[0]))
+			prev_seen = {int(r["user_id"]): int(r["last_seen_ts"]) for r in prev}
+			prev_starts = {int(r["user_id"]): int(r["starts_count"]) for r in prev}
+
+			seqs = await conn.fetch("""
+			INSERT INTO bot_users(
+				user_id, username, first_seen_ts, last_seen_ts, starts_count, messages_count,
+				flow_status, last_start_at
+			)
+			SELECT
+				t.user_id, t.username, t.first_ts, t.last_ts, t.starts, t.messages,
+				CASE WHEN t.starts > 0 THEN 'in_progress' ELSE 'new' END,
+				CASE WHEN t.last_start_ts > 0 THEN to_timestamp(t.last_start_ts) END
+			FROM unnest($1::bigint[], $2::text[], $3::bigint[], $4::bigint[], $5::bigint[], $6::bigint[], $7::bigint[])
+				AS t(user_id, username, starts, messages, first_ts, last_ts, last_start_ts)
+			ORDER BY t.user_id
+			ON CONFLICT (user_id) DO UPDATE SET
+				username=EXCLUDED.username,
+				last_seen_ts=GREATEST(bot_users.last_seen_ts, EXCLUDED.last_seen_ts),
+				starts_count=bot_users.starts_count + EXCLUDED.starts_count,
+				messages_count=bot_users.messages_count + EXCLUDED.messages_count,
+				last_start_at=COALESCE(EXCLUDED.last_start_at, bot_users.last_start_at),
+				flow_status=CASE
+					WHEN EXCLUDED.starts_count > 0 AND bot_users.flow_status='new' THEN 'in_progress'
+					ELSE bot_users.flow_status
+				END
+			RETURNING user_id, seq;
+			""", *[list(c) for c in cols])
+
+			# порядок блокировок: bot_users -> stats_totals -> stats_hourly -> activity_bitmaps (как и в reconcile_stats)
+			await conn.execute("""
+				INSERT INTO stats_totals(id, total_users, total_starts, total_messages)
+				VALUES (1, $1, $2, $3)
+				ON CONFLICT (id) DO UPDATE SET
+					total_users=stats_totals.total_users + EXCLUDED.total_users,
+					total_starts=stats_totals.total_starts + EXCLUDED.total_starts,
+					total_messages=stats_totals.total_messages + EXCLUDED.total_messages;
+			""", len(rows) - len(prev_seen), sum(int(x) for x in cols[2]), sum(int(x) for x in cols[3]))
+
+			hourly = _rollup_deltas(rows, prev_seen)
+			hours = sorted(hourly)
+			await conn.execute("""
+				INSERT INTO stats_hourly(hour_ts, new_users, starts, messages, active_users)
+				SELECT * FROM unnest($1::bigint[], $2::bigint[], $3::bigint[], $4::bigint[], $5::bigint[])
+				ON CONFLICT (hour_ts) DO UPDATE SET
+					new_users=stats_hourly.new_users + EXCLUDED.new_users,
+					starts=stats_hourly.starts + EXCLUDED.starts,
+					messages=stats_hourly.messages + EXCLUDED.messages,
+					active_users=stats_hourly.active_users + EXCLUDED.active_users;
+			""", hours, *[[hourly[h][i] for h in hours] for i in range(4)])
 
-	return [
-		{
-			"user_id": int(r["user_id"]),
-			"username": r["username"] or "",
-			"first_seen_ts": int(r["first_seen_ts"]),
-			"last_seen_ts": int(r["last_seen_ts"]),
-			"starts_count": int(r["starts_count"]),
-			"messages_count": int(r["messages_count"]),
-		}
-		for r in rows
-	]
+			seq_by_user = {int(r["user_id"]): r["seq"] for r in seqs}
+			await _or_activity_bits(conn, _activity_bits(rows, seq_by_user, prev_starts))
 
 
-# ===================== FLOW TRIGGERS =====================
+# ===================== STATS SERIES (minute / hour / day) =====================
+#
+# Бот копит точки в памяти по минутам и пишет их пачкой: каждая минутная точка
+# сразу прибавляется и в свой час, и в свой день — чтение любого разрешения
+# это range scan по PK без GROUP BY.
 
-async def get_flow_triggers() -> List[Dict]:
-	pool = await get_pool()
-	async with pool.acquire() as conn:
-		rows = await conn.fetch("""
-		SELECT flow, trigger, offset_seconds, is_active
-		FROM flow_triggers
-		ORDER BY offset_seconds ASC, flow ASC;
-		""")
+SERIES_RESOLUTIONS = {"minute": 60, "hour": 3600, "day": 86400}
+SERIES_METRICS = ("starts", "messages", "deliveries", "job_lag")
 
-	return [
-		{
-			"flow": r["flow"],
-			"trigger": r["trigger"],
-			"offset_seconds": int(r["offset_seconds"] or 0),
-			"is_active": int(r["is_active"] or 0),
-		}
-		for r in rows
-	]
 
+def series_bucket(ts: int, res: str) -> int:
+	step = SERIES_RESOLUTIONS[res]
+	return int(ts) - int(ts) % step
 
-async def set_flow_trigger(flow: str, offset_seconds: int, is_active: int = 1, trigger: str = "after_start") -> None:
-	flow = (flow or "").strip()
-	if not flow:
-		return
 
-	offset_seconds = int(offset_seconds)
-	is_active = 1 if int(is_active) else 0
-	trigger = (trigger or "after_start").strip() or "after_start"
+async def add_stats_series(points: List[Tuple[int, str, int, int, int]]) -> None:
+	"""
+	points: (minute_ts, metric, total, n, vmax)
+	"""
+	if not points:
+		return
 
+	acc: Dict[Tuple[str, str, int], List[int]] = {}
+	for minute_ts, metric, total, n, vmax in points:
+		for res in SERIES_RESOLUTIONS:
+			key = (res, metric, series_bucket(minute_ts, res))
+			a = acc.get(key)
+			if a is None:
+				acc[key] = [int(total), int(n), int(vmax)]
+			else:
+				a[0] += int(total)
+				a[1] += int(n)
+				a[2] = max(a[2], int(vmax))
+
+	keys = sorted(acc)
 	pool = await get_pool()
 	async with pool.acquire() as conn:
 		await conn.execute("""
-		INSERT INTO flow_triggers(flow, trigger, offset_seconds, is_active)
-		VALUES ($1, $2, $3, $4)
-		ON CONFLICT (flow) DO UPDATE SET
-			trigger=EXCLUDED.trigger,
-			offset_seconds=EXCLUDED.offset_seconds,
-			is_active=EXCLUDED.is_active;
-		""", flow, trigger, offset_seconds, is_active)
-
+			INSERT INTO stats_series(res, metric, bucket_ts, total, n, vmax)
+			SELECT * FROM unnest($1::text[], $2::text[], $3::bigint[], $4::bigint[], $5::bigint[], $6::bigint[])
+			ON CONFLICT (res, metric, bucket_ts) DO UPDATE SET
+				total=stats_series.total + EXCLUDED.total,
+				n=stats_series.n + EXCLUDED.n,
+				vmax=GREATEST(stats_series.vmax, EXCLUDED.vmax);
+		""",
+			[k[0] for k in keys], [k[1] for k in keys], [k[2] for k in keys],
+			[acc[k][0] for k in keys], [acc[k][1] for k in keys], [acc[k][2] for k in keys],
+		)
 
-async def delete_flow_trigger(flow: str) -> None:
-	flow = (flow or "").strip()
-	if not flow:
-		return
 
+async def prune_stats_series(minute_days: int = 7) -> None:
+	# минутные бакеты нужны только для "последних часов"; часы и дни храним всегда
+	cutoff = int(time.time()) - max(1, int(minute_days)) * 86400
 	pool = await get_pool()
 	async with pool.acquire() as conn:
-		await conn.execute("DELETE FROM flow_triggers WHERE flow=$1;", flow)
+		await conn.execute("DELETE FROM stats_series WHERE res='minute' AND bucket_ts < $1;", cutoff)
 
 
-# ===================== GATES (pressed state) =====================
+async def get_stats_series(res: str, metrics: List[str], from_ts: int, to_ts: int) -> Dict[str, List[Dict]]:
+	"""
+	Бакеты [from_ts, to_ts) разрешения res; пустые бакеты заполняются нулями.
+	"""
+	step = SERIES_RESOLUTIONS[res]
+	from_ts = series_bucket(from_ts, res)
+	to_ts = series_bucket(to_ts, res)
 
-async def mark_gate_pressed(user_id: int, block_id: int) -> None:
-	now = int(time.time())
 	pool = await get_pool()
 	async with pool.acquire() as conn:
-		await conn.execute("""
-		INSERT INTO user_gates(user_id, block_id, pressed_at)
-		VALUES ($1, $2, $3)
-		ON CONFLICT (user_id, block_id) DO UPDATE SET
-			pressed_at=EXCLUDED.pressed_at;
-		""", int(user_id), int(block_id), now)
+		rows = await conn.fetch("""
+			SELECT metric, bucket_ts, total, n, vmax
+			FROM stats_series
+			WHERE res=$1 AND metric = ANY($2::text[]) AND bucket_ts >= $3 AND bucket_ts < $4
+			ORDER BY metric, bucket_ts;
+		""", res, list(metrics), from_ts, to_ts)
+
+	found = {(r["metric"], int(r["bucket_ts"])): r for r in rows}
+	out: Dict[str, List[Dict]] = {}
+	for m in metrics:
+		points = []
+		for ts in range(from_ts, to_ts, step):
+			r = found.get((m, ts))
+			total, n, vmax = (int(r["total"]), int(r["n"]), int(r["vmax"])) if r else (0, 0, 0)
+			points.append({"ts": ts, "total": total, "n": n, "max": vmax, "avg": round(total / n, 2) if n else 0})
+		out[m] = points
+	return out
+
+
+# ===================== ACTIVITY BITMAPS (DAU/WAU/MAU, retention) =====================
+#
+# Один бит на юзера (по bot_users.seq) на день, куски по _BITMAP_CHUNK_BITS бит.
+# Запись — OR пачки в существующий кусок (bits | EXCLUDED.bits), чтение —
+# объединение/пересечение как int в Python (int.bit_count).
+# 1M юзеров = ~125 KB на день на kind.
+
+_BITMAP_CHUNK_BITS = 8192
+
+
+def _day(ts: int):
+	return datetime.fromtimestamp(int(ts), tz=timezone.utc).date()
+
+
+def _activity_bits(rows, seq_by_user: Dict[int, Optional[int]], prev_starts: Dict[int, int]) -> Dict[Tuple, int]:
+	"""
+	(kind, day, chunk) -> int-битмап.
+	cohort — день первого /start (до пачки стартов не было).
+	"""
+	out: Dict[Tuple, int] = {}
+
+	def put(kind: str, day, seq: int) -> None:
+		chunk, bit = divmod(int(seq), _BITMAP_CHUNK_BITS)
+		key = (kind, day, chunk)
+		out[key] = out.get(key, 0) | (1 << bit)
+
+	for user_id, _, starts, _, _, last_ts, last_start_ts in rows:
+		seq = seq_by_user.get(int(user_id))
+		if seq is None:
+			continue
+		put("active", _day(last_ts), seq)
+		if int(starts) > 0 and not prev_starts.get(int(user_id)):
+			put("cohort", _day(last_start_ts or last_ts), seq)
+	return out
+
+
+async def _or_activity_bits(conn: asyncpg.Connection, bits: Dict[Tuple, int]) -> None:
+	if not bits:
+		return
+	keys = sorted(bits)
+	await conn.execute("""
+		INSERT INTO activity_bitmaps(kind, day, chunk, bits)
+		SELECT * FROM unnest($1::text[], $2::date[], $3::int[], $4::varbit[])
+		ON CONFLICT (kind, day, chunk) DO UPDATE SET
+			bits=activity_bitmaps.bits | EXCLUDED.bits;
+	""",
+		[k[0] for k in keys], [k[1] for k in keys], [k[2] for k in keys],
+		[asyncpg.BitString.from_int(bits[k], _BITMAP_CHUNK_BITS) for k in keys],
+	)
+
+
+async def _load_bitmaps(conn: asyncpg.Connection, kind: str, day_from, day_to) -> Dict:
+	"""day -> {chunk: int} за [day_from, day_to]."""
+	rows = await conn.fetch("""
+		SELECT day, chunk, bits FROM activity_bitmaps
+		WHERE kind=$1 AND day BETWEEN $2 AND $3;
+	""", kind, day_from, day_to)
+	out: Dict = {}
+	for r in rows:
+		out.setdefault(r["day"], {})[int(r["chunk"])] = r["bits"].to_int()
+	return out
+
+
+def _union(maps) -> Dict[int, int]:
+	acc: Dict[int, int] = {}
+	for m in maps:
+		for chunk, x in m.items():
+			acc[chunk] = acc.get(chunk, 0) | x
+	return acc
+
+
+def _count(m: Dict[int, int]) -> int:
+	return sum(x.bit_count() for x in m.values())
+
+
+def _count_and(a: Dict[int, int], b: Dict[int, int]) -> int:
+	return sum((x & b[c]).bit_count() for c, x in a.items() if c in b)
+
+
+async def get_active_users(day=None) -> Dict:
+	"""DAU / WAU / MAU на день day (UTC, по умолчанию сегодня) — окна 1 / 7 / 30 дней."""
+	day = day or datetime.now(timezone.utc).date()
+	pool = await get_pool()
+	async with pool.acquire() as conn:
+		by_day = await _load_bitmaps(conn, "active", day - timedelta(days=29), day)
+
+	def window(n: int) -> int:
+		return _count(_union(by_day.get(day - timedelta(days=i), {}) for i in range(n)))
+
+	return {"day": day.isoformat(), "dau": window(1), "wau": window(7), "mau": window(30)}
+
+
+async def get_retention(cohort_days: int = 14, offsets: Tuple[int, ...] = (1, 3, 7, 14, 30)) -> List[Dict]:
+	"""
+	Day-N retention по когортам первого /start за последние cohort_days дней:
+	|cohort(D) ∩ active(D+N)| / |cohort(D)|. Будущие дни — None.
+	"""
+	today = datetime.now(timezone.utc).date()
+	first = today - timedelta(days=max(1, int(cohort_days)) - 1)
+
+	pool = await get_pool()
+	async with pool.acquire() as conn:
+		cohorts = await _load_bitmaps(conn, "cohort", first, today)
+		active = await _load_bitmaps(conn, "active", first, today)
+
+	out: List[Dict] = []
+	for i in range(max(1, int(cohort_days))):
+		d = first + timedelta(days=i)
+		cohort = cohorts.get(d, {})
+		size = _count(cohort)
+		ret: Dict[int, Optional[float]] = {}
+		for n in offsets:
+			target = d + timedelta(days=n)
+			if target > today:
+				ret[n] = None
+			else:
+				ret[n] = round(_count_and(cohort, active.get(target, {})) * 100.0 / size, 1) if size else 0.0
+		out.append({"day": d.isoformat(), "size": size, "retention": ret})
+	return out
+
+
+async def get_stats():
+	"""
+	O(1): одна строка stats_totals + два часа stats_hourly.
+	active_last_hour — оценка скользящего окна: текущий час + доля прошлого.
+	"""
+	now = int(time.time())
+	cur_hour = _hour(now)
+	prev_weight = 1.0 - (now - cur_hour) / 3600.0
+
+	pool = await get_pool()
+	async with pool.acquire() as conn:
+		totals = await conn.fetchrow("SELECT total_users, total_starts, total_messages FROM stats_totals WHERE id=1;")
+		hours = await conn.fetch(
+			"SELECT hour_ts, active_users FROM stats_hourly WHERE hour_ts IN ($1, $2);",
+			cur_hour, cur_hour - 3600,
+		)
+
+	active = {int(r["hour_ts"]): int(r["active_users"] or 0) for r in hours}
+	active_last_hour = active.get(cur_hour, 0) + int(round(active.get(cur_hour - 3600, 0) * prev_weight))
+
+	return {
+		"total_users": int(totals["total_users"] or 0) if totals else 0,
+		"active_last_hour": active_last_hour,
+		"total_starts": int(totals["total_starts"] or 0) if totals else 0,
+		"total_messages": int(totals["total_messages"] or 0) if totals else 0,
+	}
+
+
+async def reconcile_stats() -> Dict:
+	"""
+	Периодическая сверка: пересчитывает stats_totals и active_users текущего часа
+	из bot_users (полный проход — поэтому редко, а не на каждый заход в CRM).
+	Чинит дрейф от записей мимо flush_user_activity и упавших пачек.
+	"""
+	now = int(time.time())
+	cur_hour = _hour(now)
+
+	pool = await get_pool()
+	async with pool.acquire() as conn:
+		async with conn.transaction():
+			# пока держим строку totals, flush'и ждут — их дельты лягут поверх пересчёта
+			await conn.execute("INSERT INTO stats_totals(id) VALUES (1) ON CONFLICT (id) DO NOTHING;")
+			before = await conn.fetchrow(
+				"SELECT total_users, total_starts, total_messages FROM stats_totals WHERE id=1 FOR UPDATE;"
+			)
+			row = await conn.fetchrow("""
+				SELECT COUNT(*) AS users,
+					   COALESCE(SUM(starts_count),0) AS starts,
+					   COALESCE(SUM(messages_count),0) AS messages,
+					   COUNT(*) FILTER (WHERE last_seen_ts >= $1) AS active
+				FROM bot_users;
+			""", cur_hour)
+
+			await conn.execute("""
+				INSERT INTO stats_totals(id, total_users, total_starts, total_messages, reconciled_ts)
+				VALUES (1, $1, $2, $3, $4)
+				ON CONFLICT (id) DO UPDATE SET
+					total_users=EXCLUDED.total_users,
+					total_starts=EXCLUDED.total_starts,
+					total_messages=EXCLUDED.total_messages,
+					reconciled_ts=EXCLUDED.reconciled_ts;
+			""", int(row["users"]), int(row["starts"]), int(row["messages"]), now)
+			await conn.execute("""
+				INSERT INTO stats_hourly(hour_ts, active_users) VALUES ($1, $2)
+				ON CONFLICT (hour_ts) DO UPDATE SET active_users=EXCLUDED.active_users;
+			""", cur_hour, int(row["active"]))
+
+	return {
+		"users_drift": int(row["users"]) - int(before["total_users"]),
+		"starts_drift": int(row["starts"]) - int(before["total_starts"]),
+		"messages_drift": int(row["messages"]) - int(before["total_messages"]),
+	}
+
+
+def _user_row_to_dict(r: asyncpg.Record) -> Dict:
+	return {
+		"user_id": int(r["user_id"]),
+		"username": r["username"] or "",
+		"first_seen_ts": int(r["first_seen_ts"]),
+		"last_seen_ts": int(r["last_seen_ts"]),
+		"starts_count": int(r["starts_count"]),
+		"messages_count": int(r["messages_count"]),
+	}
+
+
+async def get_users(limit: int = 500):
+	pool = await get_pool()
+	async with pool.acquire() as conn:
+		rows = await conn.fetch("""
+		SELECT user_id, username, first_seen_ts, last_seen_ts, starts_count, messages_count
+		FROM bot_users
+		ORDER BY last_seen_ts DESC, user_id DESC
+		LIMIT $1;
+		""", int(limit))
+
+	return [_user_row_to_dict(r) for r in rows]
+
+
+async def iter_users(batch_size: int = 2000):
+	"""
+	Все юзеры пачками через серверный курсор (память не растёт с размером таблицы).
+	Соединение пула занято, пока генератор не дочитан/не закрыт.
+	"""
+	pool = await get_pool()
+	async with pool.acquire() as conn:
+		async with conn.transaction(isolation="repeatable_read", readonly=True):
+			cur = await conn.cursor("""
+				SELECT user_id, username, first_seen_ts, last_seen_ts, starts_count, messages_count
+				FROM bot_users
+				ORDER BY user_id;
+			""")
+			while True:
+				rows = await cur.fetch(int(batch_size))
+				if not rows:
+					break
+				yield [_user_row_to_dict(r) for r in rows]
+
+
+async def get_users_page(
+	after_ts: Optional[int] = None,
+	after_id: Optional[int] = None,
+	limit: int = 50,
+	backward: bool = False,
+) -> Dict:
+	"""
+	Keyset-пагинация по (last_seen_ts DESC, user_id DESC), без OFFSET.
+	after_ts/after_id — курсор: последняя строка прошлой страницы (или первая, если backward).
+	Возвращает {"users": [...], "next": (ts, id)|None, "prev": (ts, id)|None}.
+	"""
+	limit = max(1, min(int(limit), 500))
+	has_cursor = after_ts is not None and after_id is not None
+
+	if not has_cursor:
+		where, order, args = "", "DESC", []
+	elif backward:
+		where, order, args = "WHERE (last_seen_ts, user_id) > ($2, $3)", "ASC", [int(after_ts), int(after_id)]
+	else:
+		where, order, args = "WHERE (last_seen_ts, user_id) < ($2, $3)", "DESC", [int(after_ts), int(after_id)]
+
+	pool = await get_pool()
+	async with pool.acquire() as conn:
+		rows = await conn.fetch(f"""
+		SELECT user_id, username, first_seen_ts, last_seen_ts, starts_count, messages_count
+		FROM bot_users
+		{where}
+		ORDER BY last_seen_ts {order}, user_id {order}
+		LIMIT $1;
+		""", limit + 1, *args)
+
+	more = len(rows) > limit
+	users = [_user_row_to_dict(r) for r in rows[:limit]]
+	if has_cursor and backward:
+		users.reverse()
+
+	def cursor(u: Optional[Dict]):
+		return (u["last_seen_ts"], u["user_id"]) if u else None
+
+	if has_cursor and backward:
+		has_prev, has_next = more, True
+	else:
+		has_prev, has_next = has_cursor, more
+
+	return {
+		"users": users,
+		"next": cursor(users[-1]) if has_next and users else None,
+		"prev": cursor(users[0]) if has_prev and users else None,
+	}
+
+
+# ===================== CSV EXPORT (COPY ... TO STDOUT) =====================
+#
+# Фильтры — в WHERE (для events ещё и отсечение партиций по ts; без ORDER BY,
+# чтобы не сортировать весь диапазон), данные идут из COPY прямо в output(chunk).
+
+USER_STATUSES = ("new", "in_progress", "completed")
+
+
+async def copy_users_csv(
+	output: Callable,
+	seen_from: Optional[int] = None,
+	seen_to: Optional[int] = None,
+	status: str = "",
+) -> None:
+	where, args = [], []
+	if seen_from is not None:
+		args.append(int(seen_from))
+		where.append(f"last_seen_ts >= ${len(args)}")
+	if seen_to is not None:
+		args.append(int(seen_to))
+		where.append(f"last_seen_ts < ${len(args)}")
+	if status in USER_STATUSES:
+		args.append(status)
+		where.append(f"flow_status = ${len(args)}")
+
+	sql = f"""
+		SELECT user_id, username, first_seen_ts, last_seen_ts,
+			   to_char(to_timestamp(first_seen_ts) AT TIME ZONE 'UTC', 'YYYY-MM-DD HH24:MI:SS') AS first_seen_utc,
+			   to_char(to_timestamp(last_seen_ts) AT TIME ZONE 'UTC', 'YYYY-MM-DD HH24:MI:SS') AS last_seen_utc,
+			   starts_count, messages_count, flow_status, last_start_at
+		FROM bot_users
+		{("WHERE " + " AND ".join(where)) if where else ""}
+		ORDER BY user_id
+	"""
+	pool = await get_pool()
+	async with pool.acquire() as conn:
+		await conn.copy_from_query(sql, *args, output=output, format="csv", header=True)
+
+
+async def copy_events_csv(
+	output: Callable,
+	ts_from: datetime,
+	ts_to: datetime,
+	kinds: Optional[List[str]] = None,
+	flow: str = "",
+	user_id: Optional[int] = None,
+) -> None:
+	args: list = [ts_from, ts_to]
+	where = ["ts >= $1", "ts < $2"]
+	kinds = [k for k in (kinds or []) if k in EVENT_KINDS]
+	if kinds:
+		args.append(kinds)
+		where.append(f"kind = ANY(${len(args)}::text[])")
+	if flow:
+		args.append(flow)
+		where.append(f"flow = ${len(args)}")
+	if user_id is not None:
+		args.append(int(user_id))
+		where.append(f"user_id = ${len(args)}")
+
+	sql = f"""
+		SELECT ts, user_id, kind, flow, block_id, detail
+		FROM events
+		WHERE {" AND ".join(where)}
+	"""
+	pool = await get_pool()
+	async with pool.acquire() as conn:
+		await conn.copy_from_query(sql, *args, output=output, format="csv", header=True)
+
+
+# ===================== USER SEARCH (CRM) =====================
+
+_HAS_TRGM: Optional[bool] = None
+
+
+async def _has_trgm(conn: asyncpg.Connection) -> bool:
+	global _HAS_TRGM
+	if _HAS_TRGM is None:
+		_HAS_TRGM = bool(await conn.fetchval("SELECT 1 FROM pg_extension WHERE extname='pg_trgm';"))
+	return _HAS_TRGM
+
+
+def _like_escape(s: str) -> str:
+	return s.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+
+
+async def search_users(query: str, limit: int = 20) -> List[Dict]:
+	"""
+	Число -> точное совпадение по user_id (PK); плюс подстрока username
+	(ILIKE через GIN pg_trgm, ближайшие по similarity — первыми).
+	"""
+	q = (query or "").strip().lstrip("@")
+	if not q:
+		return []
+	limit = max(1, min(int(limit), 100))
+
+	pool = await get_pool()
+	async with pool.acquire() as conn:
+		out: List[Dict] = []
+		# bigint: длинные числа не ищем по id (asyncpg упадёт) — только по username ниже
+		if q.isascii() and q.isdigit() and int(q) < 2 ** 63:
+			r = await conn.fetchrow("""
+				SELECT user_id, username, first_seen_ts, last_seen_ts, starts_count, messages_count
+				FROM bot_users WHERE user_id=$1;
+			""", int(q))
+			if r:
+				out.append(_user_row_to_dict(r))
+
+		args = [_like_escape(q), limit]
+		order = "last_seen_ts DESC"
+		if await _has_trgm(conn):
+			order = "similarity(username, $3) DESC, last_seen_ts DESC"
+			args.append(q)
+		rows = await conn.fetch(f"""
+			SELECT user_id, username, first_seen_ts, last_seen_ts, starts_count, messages_count
+			FROM bot_users
+			WHERE username ILIKE '%' || $1 || '%'
+			ORDER BY {order}
+			LIMIT $2;
+		""", *args)
+
+	seen = {u["user_id"] for u in out}
+	out.extend(_user_row_to_dict(r) for r in rows if int(r["user_id"]) not in seen)
+	return out[:limit]
+
+
+async def get_user_card(user_id: int) -> Optional[Dict]:
+	"""
+	Юзер + невыполненные jobs (ux_jobs_user_flow) + нажатые gate (PK user_gates).
+	"""
+	uid = int(user_id)
+	pool = await get_pool()
+	async with pool.acquire() as conn:
+		async with conn.transaction(isolation="repeatable_read", readonly=True):
+			r = await conn.fetchrow("""
+				SELECT user_id, username, first_seen_ts, last_seen_ts, starts_count, messages_count,
+					   flow_status, last_start_at, state
+				FROM bot_users WHERE user_id=$1;
+			""", uid)
+			if r is None:
+				return None
+			jobs = await conn.fetch("""
+				SELECT id, flow, run_at_ts FROM jobs
+				WHERE user_id=$1 AND is_done=0
+				ORDER BY run_at_ts ASC;
+			""", uid)
+			gates = await conn.fetch("""
+				SELECT g.block_id, g.pressed_at, b.flow, b.gate_next_flow, b.gate_button_text
+				FROM user_gates g
+				LEFT JOIN content_blocks b ON b.id = g.block_id
+				WHERE g.user_id=$1
+				ORDER BY g.pressed_at DESC;
+			""", uid)
+
+	user = _user_row_to_dict(r)
+	user.update({
+		"flow_status": r["flow_status"],
+		"last_start_at": r["last_start_at"],
+		"state": r["state"] if isinstance(r["state"], dict) else {},
+	})
+	return {
+		"user": user,
+		"jobs": [
+			{"id": int(j["id"]), "key": j["flow"], "run_at_ts": int(j["run_at_ts"])}
+			for j in jobs
+		],
+		"gates": [
+			{
+				"block_id": int(g["block_id"]),
+				"pressed_at": int(g["pressed_at"]),
+				"flow": g["flow"] or "",
+				"next_flow": g["gate_next_flow"] or "",
+				"button_text": g["gate_button_text"] or "",
+			}
+			for g in gates
+		],
+	}
+
+
+# ===================== EVENT LOG (day-partitioned) =====================
+#
+# events: start | message | block_delivered | gate_shown | gate_pressed | job_failed
+# Пишется только пачками через COPY (copy_records_to_table) — на порядок дешевле
+# построчных INSERT. Каждый день — своя партиция events_YYYYMMDD, старые
+# партиции удаляются целиком (DROP TABLE, без DELETE и VACUUM).
+
+EVENT_KINDS = ("start", "message", "block_delivered", "gate_shown", "gate_pressed", "job_failed")
+EVENT_COLUMNS = ["ts", "user_id", "kind", "flow", "block_id", "detail"]
+EVENTS_PRECREATE_DAYS = 2  # сегодня + завтра
+EVENTS_RETENTION_DAYS = int(os.getenv("EVENTS_RETENTION_DAYS", "180"))
+
+# дни, для которых партиция уже точно есть (в этом процессе)
+_EVENT_PARTITIONS: set = set()
+
+
+def _event_partition_name(day) -> str:
+	return f"events_{day.strftime('%Y%m%d')}"
+
+
+async def _ensure_event_partitions(conn: asyncpg.Connection, start_day, days: int) -> None:
+	# days — число дневных партиций начиная со start_day включительно
+	for i in range(max(1, int(days))):
+		day = start_day + timedelta(days=i)
+		if day in _EVENT_PARTITIONS:
+			continue
+		nxt = day + timedelta(days=1)
+		await conn.execute(f"""
+			CREATE TABLE IF NOT EXISTS {_event_partition_name(day)}
+			PARTITION OF events
+			FOR VALUES FROM ('{day.isoformat()} 00:00:00+00') TO ('{nxt.isoformat()} 00:00:00+00');
+		""")
+		_EVENT_PARTITIONS.add(day)
+
+
+async def ensure_event_partitions(days: int = EVENTS_PRECREATE_DAYS) -> None:
+	pool = await get_pool()
+	async with pool.acquire() as conn:
+		await _ensure_event_partitions(conn, datetime.now(timezone.utc).date(), days)
+
+
+async def drop_old_event_partitions(retention_days: int = EVENTS_RETENTION_DAYS) -> List[str]:
+	cutoff = datetime.now(timezone.utc).date() - timedelta(days=max(1, int(retention_days)))
+	pool = await get_pool()
+	async with pool.acquire() as conn:
+		rows = await conn.fetch("""
+			SELECT c.relname
+			FROM pg_inherits i
+			JOIN pg_class c ON c.oid = i.inhrelid
+			JOIN pg_class p ON p.oid = i.inhparent
+			WHERE p.relname = 'events';
+		""")
+		dropped: List[str] = []
+		for r in rows:
+			name = r["relname"]
+			try:
+				day = datetime.strptime(name[len("events_"):], "%Y%m%d").date()
+			except ValueError:
+				continue
+			if day < cutoff:
+				await conn.execute(f"DROP TABLE IF EXISTS {name};")
+				_EVENT_PARTITIONS.discard(day)
+				dropped.append(name)
+	return dropped
+
+
+async def copy_events(records: List[Tuple[datetime, int, str, str, int, str]]) -> None:
+	"""
+	records: (ts[tz-aware], user_id, kind, flow, block_id, detail)
+	"""
+	if not records:
+		return
+
+	pool = await get_pool()
+	async with pool.acquire() as conn:
+		days = sorted({r[0].astimezone(timezone.utc).date() for r in records})
+		missing = [d for d in days if d not in _EVENT_PARTITIONS]
+		for d in missing:
+			await _ensure_event_partitions(conn, d, 1)
+		async with conn.transaction():
+			await conn.copy_records_to_table("events", records=records, columns=EVENT_COLUMNS)
+			await _bump_funnel(conn, records)
+
+
+# ===================== FUNNEL (pre-aggregated) =====================
+#
+# funnel_daily копит счётчики по (day, flow, block_id): сколько раз блок доставлен,
+# сколько раз показан gate и сколько юзеров его нажали (первое нажатие).
+# CRM читает только эти суммы — user_gates/jobs/events не сканируются.
+
+_FUNNEL_KINDS = {"block_delivered": 0, "gate_shown": 1}
+
+
+async def _bump_funnel(conn: asyncpg.Connection, records) -> None:
+	counts: Dict[Tuple, List[int]] = {}
+	for ts, _, kind, flow, block_id, detail in records:
+		i = _FUNNEL_KINDS.get(kind)
+		if i is None or not flow or not block_id:
+			continue
+		# напоминания не считаем показами — иначе конверсия gate занижается
+		if kind == "gate_shown" and detail == "reminder":
+			continue
+		key = (ts.astimezone(timezone.utc).date(), flow, int(block_id))
+		counts.setdefault(key, [0, 0])[i] += 1
+
+	if not counts:
+		return
+
+	keys = sorted(counts)
+	await conn.execute("""
+		INSERT INTO funnel_daily(day, flow, block_id, delivered, gate_shown)
+		SELECT * FROM unnest($1::date[], $2::text[], $3::bigint[], $4::bigint[], $5::bigint[])
+		ON CONFLICT (day, flow, block_id) DO UPDATE SET
+			delivered=funnel_daily.delivered + EXCLUDED.delivered,
+			gate_shown=funnel_daily.gate_shown + EXCLUDED.gate_shown;
+	""",
+		[k[0] for k in keys], [k[1] for k in keys], [k[2] for k in keys],
+		[counts[k][0] for k in keys], [counts[k][1] for k in keys],
+	)
+
+
+async def get_funnel(days: int = 7, flows: Optional[List[str]] = None) -> List[Dict]:
+	"""
+	Суммы funnel_daily за последние days дней (UTC), по блокам в порядке flows -> position.
+	Блоки, которых уже нет в content_blocks, идут в конец своего flow.
+	"""
+	since = datetime.now(timezone.utc).date() - timedelta(days=max(1, int(days)) - 1)
+
+	pool = await get_pool()
+	async with pool.acquire() as conn:
+		rows = await conn.fetch("""
+			SELECT f.flow, f.block_id,
+				   SUM(f.delivered) AS delivered,
+				   SUM(f.gate_shown) AS gate_shown,
+				   SUM(f.gate_pressed) AS gate_pressed,
+				   b.position, b.type, b.title, b.gate_next_flow,
+				   COALESCE(fl.sort_order, 2147483647) AS flow_order
+			FROM funnel_daily f
+			LEFT JOIN content_blocks b ON b.id = f.block_id
+			LEFT JOIN flows fl ON fl.name = f.flow
+			WHERE f.day >= $1
+			  AND ($2::text[] IS NULL OR f.flow = ANY($2::text[]))
+			GROUP BY f.flow, f.block_id, b.position, b.type, b.title, b.gate_next_flow, fl.sort_order
+			ORDER BY flow_order, f.flow, b.position NULLS LAST, f.block_id;
+		""", since, flows or None)
+
+	return [
+		{
+			"flow": r["flow"],
+			"block_id": int(r["block_id"]),
+			"position": int(r["position"]) if r["position"] is not None else None,
+			"type": r["type"] or "",
+			"title": r["title"] or "",
+			"gate_next_flow": r["gate_next_flow"] or "",
+			"delivered": int(r["delivered"] or 0),
+			"gate_shown": int(r["gate_shown"] or 0),
+			"gate_pressed": int(r["gate_pressed"] or 0),
+		}
+		for r in rows
+	]
+
+
+# ===================== FLOW TRIGGERS =====================
+
+async def get_flow_triggers() -> List[Dict]:
+	pool = await get_pool()
+	async with pool.acquire() as conn:
+		rows = await conn.fetch("""
+		SELECT flow, trigger, offset_seconds, is_active
+		FROM flow_triggers
+		ORDER BY offset_seconds ASC, flow ASC;
+		""")
+
+	return [_trigger_row_to_dict(r) for r in rows]
+
+
+def _trigger_row_to_dict(r: asyncpg.Record) -> Dict:
+	return {
+		"flow": r["flow"],
+		"trigger": r["trigger"],
+		"offset_seconds": int(r["offset_seconds"] or 0),
+		"is_active": int(r["is_active"] or 0),
+	}
+
+
+async def set_flow_trigger(flow: str, offset_seconds: int, is_active: int = 1, trigger: str = "after_start") -> None:
+	flow = (flow or "").strip()
+	if not flow:
+		return
+
+	offset_seconds = int(offset_seconds)
+	is_active = 1 if int(is_active) else 0
+	trigger = (trigger or "after_start").strip() or "after_start"
+
+	pool = await get_pool()
+	async with pool.acquire() as conn, conn.transaction():
+		await conn.execute("""
+		INSERT INTO flow_triggers(flow, trigger, offset_seconds, is_active)
+		VALUES ($1, $2, $3, $4)
+		ON CONFLICT (flow) DO UPDATE SET
+			trigger=EXCLUDED.trigger,
+			offset_seconds=EXCLUDED.offset_seconds,
+			is_active=EXCLUDED.is_active;
+		""", flow, trigger, offset_seconds, is_active)
+		await _notify_config_changed(conn, "triggers")
+
+
+async def delete_flow_trigger(flow: str) -> None:
+	flow = (flow or "").strip()
+	if not flow:
+		return
+
+	pool = await get_pool()
+	async with pool.acquire() as conn, conn.transaction():
+		await conn.execute("DELETE FROM flow_triggers WHERE flow=$1;", flow)
+		await _notify_config_changed(conn, "triggers")
+
+
+# ===================== GATES (pressed state) =====================
+
+async def mark_gate_pressed(user_id: int, block_id: int) -> bool:
+	"""
+	Возвращает True, если это первое нажатие (оно же идёт в funnel_daily.gate_pressed).
+	"""
+	now = int(time.time())
+	pool = await get_pool()
+	async with pool.acquire() as conn:
+		async with conn.transaction():
+			first = await conn.fetchval("""
+			INSERT INTO user_gates(user_id, block_id, pressed_at)
+			VALUES ($1, $2, $3)
+			ON CONFLICT (user_id, block_id) DO UPDATE SET
+				pressed_at=EXCLUDED.pressed_at
+			RETURNING (xmax = 0);
+			""", int(user_id), int(block_id), now)
+
+			if first:
+				await conn.execute("""
+				INSERT INTO funnel_daily(day, flow, block_id, gate_pressed)
+				SELECT $1, b.flow, b.id, 1 FROM content_blocks b WHERE b.id=$2
+				ON CONFLICT (day, flow, block_id) DO UPDATE SET
+					gate_pressed=funnel_daily.gate_pressed + 1;
+				""", datetime.now(timezone.utc).date(), int(block_id))
+	return bool(first)
 
 
 async def is_gate_pressed(user_id: int, block_id: int) -> bool:
@@ -937,7 +2246,110 @@ async def mark_job_done_by_user_flow(user_id: int, flow: str) -> None:
 		""", int(user_id), flow)
 
 
+# ===================== FLOW VERSIONS + NOTIFY =====================
+#
+# CRM при каждом изменении блоков flow поднимает версию и шлёт NOTIFY
+# (доставляется только после COMMIT). Бот держит блоки в памяти и
+# перечитывает flow только когда его версия выросла.
+
+FLOW_CHANGED_CHANNEL = "flow_changed"
+
+# modes / triggers / actions: бот держит их одним снапшотом и перечитывает по NOTIFY
+CONFIG_CHANGED_CHANNEL = "config_changed"
+
+
+async def _bump_flow_version(conn: asyncpg.Connection, flow: str) -> int:
+	flow = (flow or "").strip()
+	if not flow:
+		return 0
+	v = await conn.fetchval("""
+		INSERT INTO flow_versions(flow, version)
+		VALUES ($1, 1)
+		ON CONFLICT (flow) DO UPDATE SET
+			version=flow_versions.version + 1
+		RETURNING version;
+	""", flow)
+	await conn.execute(
+		"SELECT pg_notify($1, $2);",
+		FLOW_CHANGED_CHANNEL,
+		json.dumps({"flow": flow, "version": int(v or 0)}, ensure_ascii=False),
+	)
+	return int(v or 0)
+
+
+async def _notify_config_changed(conn: asyncpg.Connection, what: str) -> None:
+	await conn.execute("SELECT pg_notify($1, $2);", CONFIG_CHANGED_CHANNEL, what)
+
+
+async def get_config_snapshot() -> Dict:
+	"""
+	modes + triggers + actions одним снапшотом (REPEATABLE READ).
+	"""
+	pool = await get_pool()
+	async with pool.acquire() as conn:
+		async with conn.transaction(isolation="repeatable_read", readonly=True):
+			mode_rows = await conn.fetch("SELECT flow, mode FROM flow_modes;")
+			trigger_rows = await conn.fetch("""
+				SELECT flow, trigger, offset_seconds, is_active
+				FROM flow_triggers
+				ORDER BY offset_seconds ASC, flow ASC;
+			""")
+			action_rows = await conn.fetch("""
+				SELECT id, after_flow, action_type, target_flow, delay_seconds, is_active
+				FROM flow_actions
+				ORDER BY after_flow ASC, id ASC;
+			""")
+
+	modes: Dict[str, str] = {}
+	for r in mode_rows:
+		f = (r["flow"] or "").strip()
+		if f:
+			modes[f] = _norm_mode(r["mode"] or "off")
+
+	return {
+		"modes": modes,
+		"triggers": [_trigger_row_to_dict(r) for r in trigger_rows],
+		"actions": [_action_row_to_dict(r) for r in action_rows],
+	}
+
+
+async def open_listener(handlers: Dict[str, Callable]) -> asyncpg.Connection:
+	"""
+	Отдельное (не из пула) соединение под LISTEN.
+	handlers: { channel: callback(conn, pid, channel, payload) }
+	"""
+	if not DATABASE_URL:
+		raise RuntimeError("DATABASE_URL env var is not set. Add it in Railway Variables.")
+	conn = await asyncpg.connect(DATABASE_URL)
+	try:
+		for channel, cb in handlers.items():
+			await conn.add_listener(channel, cb)
+	except Exception:
+		await conn.close()
+		raise
+	return conn
+
+
 # ===================== FLOWS =====================
+#
+# Порядок flow (sort_order) и блоков (position) уникален (см. миграцию 7).
+# Всё, что выбирает "следующий" номер или переставляет flows, берёт
+# _FLOW_ORDER_LOCK_KEY на транзакцию; правки блоков — FOR UPDATE строки flow.
+
+_FLOW_ORDER_LOCK_KEY = 7_310_002
+
+
+async def _lock_flow_order(conn: asyncpg.Connection) -> None:
+	await conn.execute("SELECT pg_advisory_xact_lock($1);", _FLOW_ORDER_LOCK_KEY)
+
+
+async def _lock_flows(conn: asyncpg.Connection, *flows: str) -> None:
+	# в порядке имени — две правки с переносом блока между flow не дедлочат
+	await conn.execute(
+		"SELECT 1 FROM flows WHERE name = ANY($1::text[]) ORDER BY name FOR UPDATE;",
+		sorted({(f or "").strip() for f in flows if f}),
+	)
+
 
 async def get_flows() -> List[str]:
 	pool = await get_pool()
@@ -952,12 +2364,13 @@ async def create_flow(name: str) -> None:
 		return
 
 	pool = await get_pool()
-	async with pool.acquire() as conn:
-		mx = await conn.fetchval("SELECT COALESCE(MAX(sort_order), 0) FROM flows;")
-		await conn.execute(
-			"INSERT INTO flows(name, sort_order) VALUES ($1, $2) ON CONFLICT (name) DO NOTHING;",
-			name, int(mx or 0) + 1
-		)
+	async with pool.acquire() as conn, conn.transaction():
+		await _lock_flow_order(conn)
+		await conn.execute("""
+			INSERT INTO flows(name, sort_order)
+			SELECT $1, COALESCE(MAX(sort_order), 0) + 1 FROM flows
+			ON CONFLICT (name) DO NOTHING;
+		""", name)
 
 	# ✅ default mode off
 	try:
@@ -970,6 +2383,7 @@ async def delete_flow(name: str) -> None:
 	pool = await get_pool()
 	async with pool.acquire() as conn:
 		async with conn.transaction():
+			await _lock_flow_order(conn)
 			await conn.execute("DELETE FROM content_blocks WHERE flow=$1;", name)
 			await conn.execute("DELETE FROM jobs WHERE flow=$1;", name)
 			await conn.execute("DELETE FROM flow_triggers WHERE flow=$1;", name)
@@ -977,103 +2391,470 @@ async def delete_flow(name: str) -> None:
 			await conn.execute("DELETE FROM flows WHERE name=$1;", name)
 			# ✅ удалить сценарии, где участвует этот flow
 			await conn.execute("DELETE FROM flow_actions WHERE after_flow=$1 OR target_flow=$1;", name)
+			# версию не удаляем: если flow создадут заново, кеш в боте не спутает его со старым
+			await _bump_flow_version(conn, name)
+			await _notify_config_changed(conn, "flow_deleted")
 
 
 async def move_flow(name: str, direction: str) -> None:
+	"""Обмен sort_order с соседом сверху/снизу — один UPDATE, без чтения всего списка."""
+	if direction not in ("up", "down"):
+		return
+	cmp, order = ("<", "DESC") if direction == "up" else (">", "ASC")
+
+	pool = await get_pool()
+	async with pool.acquire() as conn, conn.transaction():
+		await _lock_flow_order(conn)
+		await conn.execute(f"""
+			WITH me AS (
+				SELECT name, sort_order FROM flows WHERE name=$1
+			), nb AS (
+				SELECT f.name, f.sort_order
+				FROM flows f, me
+				WHERE f.sort_order {cmp} me.sort_order
+				ORDER BY f.sort_order {order}
+				LIMIT 1
+			)
+			UPDATE flows f
+			SET sort_order = s.sort_order
+			FROM (
+				SELECT me.name, nb.sort_order FROM me, nb
+				UNION ALL
+				SELECT nb.name, me.sort_order FROM me, nb
+			) s
+			WHERE f.name = s.name;
+		""", name)
+
+
+async def reorder_flows(names: List[str]) -> bool:
+	"""
+	Полный порядок flow (drag-and-drop): sort_order = 1..n одним UPDATE ... FROM unnest.
+	False — список устарел (flow добавили/удалили: это не перестановка всех flow), ничего не меняем.
+	"""
+	names = [(n or "").strip() for n in names]
+	if len(set(names)) != len(names):
+		raise ValueError("duplicate flow in order")
+
 	pool = await get_pool()
 	async with pool.acquire() as conn:
-		rows = await conn.fetch("SELECT name, sort_order FROM flows ORDER BY sort_order ASC;")
-		idx = next((i for i, r in enumerate(rows) if r["name"] == name), None)
-		if idx is None:
-			return
+		try:
+			async with conn.transaction():
+				await _lock_flow_order(conn)
+				same = await conn.fetchval("""
+					SELECT COUNT(*) = $2 AND COALESCE(bool_and(name = ANY($1::text[])), TRUE)
+					FROM flows;
+				""", names, len(names))
+				if not same:
+					return False
+				await conn.execute("""
+					UPDATE flows f
+					SET sort_order = o.pos
+					FROM unnest($1::text[], $2::int[]) AS o(name, pos)
+					WHERE f.name = o.name AND f.sort_order <> o.pos;
+				""", names, list(range(1, len(names) + 1)))
+		except asyncpg.UniqueViolationError:
+			return False
+	return True
+
+
+async def clone_flow(src: str, dst: str) -> None:
+	"""
+	Копия flow целиком: блоки, trigger, mode, исходящие flow_actions —
+	по одному INSERT ... SELECT на таблицу в одной транзакции.
+	Ссылки flow на самого себя (gate_next_flow, action target) переводятся на копию.
+	mode "auto" копируется как "off": иначе копия сразу пойдёт всем новым юзерам
+	вместе с оригиналом. ValueError с причиной: src нет / dst уже существует.
+	"""
+	src = (src or "").strip()
+	dst = (dst or "").strip()
+	if not src or not dst:
+		raise ValueError("Пустое имя flow")
+	if src == dst:
+		raise ValueError(f"flow {dst} уже есть")
 
-		if direction == "up" and idx > 0:
-			a = rows[idx]
-			b = rows[idx - 1]
-		elif direction == "down" and idx < len(rows) - 1:
-			a = rows[idx]
-			b = rows[idx + 1]
-		else:
-			return
+	pool = await get_pool()
+	async with pool.acquire() as conn, conn.transaction():
+		await _lock_flow_order(conn)
+		created = await conn.fetchval("""
+			INSERT INTO flows(name, sort_order)
+			SELECT $2, COALESCE(MAX(sort_order), 0) + 1 FROM flows
+			HAVING bool_or(name = $1)
+			ON CONFLICT (name) DO NOTHING
+			RETURNING name;
+		""", src, dst)
+		if created is None:
+			# ✅ различаем причины: иначе пропавший src выглядел как конфликт имён
+			if not await conn.fetchval("SELECT 1 FROM flows WHERE name=$1;", src):
+				raise ValueError(f"flow {src} не найден")
+			raise ValueError(f"flow {dst} уже есть")
 
-		async with conn.transaction():
-			await conn.execute("UPDATE flows SET sort_order=$1 WHERE name=$2;", int(b["sort_order"]), a["name"])
-			await conn.execute("UPDATE flows SET sort_order=$1 WHERE name=$2;", int(a["sort_order"]), b["name"])
+		await conn.execute("""
+			INSERT INTO content_blocks
+			(flow, position, type, title, text, circle_path, video_url, buttons_json,
+			 is_active, delay_seconds, file_path, file_kind, file_name,
+			 gate_next_flow, gate_button_text, gate_prompt_text, gate_reminder_seconds, gate_reminder_text)
+			SELECT $2, position, type, title, text, circle_path, video_url, buttons_json,
+				   is_active, delay_seconds, file_path, file_kind, file_name,
+				   CASE WHEN gate_next_flow = $1 THEN $2 ELSE gate_next_flow END,
+				   gate_button_text, gate_prompt_text, gate_reminder_seconds, gate_reminder_text
+			FROM content_blocks
+			WHERE flow=$1;
+		""", src, dst)
 
+		await conn.execute("""
+			INSERT INTO flow_triggers(flow, trigger, offset_seconds, is_active)
+			SELECT $2, trigger, offset_seconds, is_active
+			FROM flow_triggers
+			WHERE flow=$1;
+		""", src, dst)
 
-# ===================== CONTENT BLOCKS =====================
+		await conn.execute("""
+			INSERT INTO flow_modes(flow, mode)
+			SELECT $2, CASE WHEN mode = 'auto' THEN 'off' ELSE mode END
+			FROM flow_modes
+			WHERE flow=$1
+			ON CONFLICT (flow) DO NOTHING;
+		""", src, dst)
 
-async def next_position(flow: str) -> int:
+		await conn.execute("""
+			INSERT INTO flow_actions(after_flow, action_type, target_flow, delay_seconds, is_active)
+			SELECT $2, action_type, CASE WHEN target_flow = $1 THEN $2 ELSE target_flow END, delay_seconds, is_active
+			FROM flow_actions
+			WHERE after_flow=$1
+			ON CONFLICT (after_flow, action_type, target_flow) DO NOTHING;
+		""", src, dst)
+
+		await _bump_flow_version(conn, dst)
+		await _notify_config_changed(conn, "flow_cloned")
+
+
+async def _fetch_flow_graph_data(conn: asyncpg.Connection) -> Dict:
+	flow_rows = await conn.fetch("SELECT name FROM flows ORDER BY sort_order ASC;")
+	block_rows = await conn.fetch("""
+		SELECT id, flow, position, is_active, delay_seconds, gate_next_flow
+		FROM content_blocks
+		ORDER BY flow ASC, position ASC;
+	""")
+	action_rows = await conn.fetch("""
+		SELECT id, after_flow, action_type, target_flow, delay_seconds, is_active
+		FROM flow_actions
+		ORDER BY after_flow ASC, id ASC;
+	""")
+	trigger_rows = await conn.fetch("""
+		SELECT flow, trigger, offset_seconds, is_active
+		FROM flow_triggers
+		ORDER BY offset_seconds ASC, flow ASC;
+	""")
+	mode_rows = await conn.fetch("SELECT flow, mode FROM flow_modes;")
+
+	return {
+		"flows": [r["name"] for r in flow_rows],
+		"blocks": [
+			{
+				"id": int(r["id"]),
+				"flow": r["flow"],
+				"position": int(r["position"]),
+				"is_active": int(r["is_active"] or 0),
+				"delay": float(r["delay_seconds"] or 0.0),
+				"gate_next_flow": r["gate_next_flow"] or "",
+			}
+			for r in block_rows
+		],
+		"actions": [_action_row_to_dict(r) for r in action_rows],
+		"triggers": [_trigger_row_to_dict(r) for r in trigger_rows],
+		"modes": {(r["flow"] or "").strip(): _norm_mode(r["mode"] or "off") for r in mode_rows},
+	}
+
+
+async def get_flow_graph_data() -> Dict:
+	"""
+	Всё, что нужно flow_graph.build_flow_graph, одним снапшотом:
+	блоки — только колонки, влияющие на переходы (без текстов/медиа).
+	"""
 	pool = await get_pool()
 	async with pool.acquire() as conn:
-		mx = await conn.fetchval("SELECT COALESCE(MAX(position), 0) FROM content_blocks WHERE flow=$1;", flow)
-		return int(mx or 0) + 1
+		async with conn.transaction(isolation="repeatable_read", readonly=True):
+			return await _fetch_flow_graph_data(conn)
 
 
-async def get_blocks(flow: str) -> List[Dict]:
+async def get_crm_index_snapshot() -> Dict:
+	"""
+	Всё для главной CRM одним соединением и одним снапшотом (REPEATABLE READ):
+	данные графа flow (flows, blocks, actions, triggers, modes) + broadcasts.
+	"""
 	pool = await get_pool()
 	async with pool.acquire() as conn:
-		rows = await conn.fetch("""
-			SELECT
-				id, flow, position, type,
-				title, text,
-				circle_path, video_url, buttons_json,
-				is_active, delay_seconds,
-				file_path, file_kind, file_name,
-				gate_next_flow, gate_button_text, gate_prompt_text, gate_reminder_seconds, gate_reminder_text
-			FROM content_blocks
-			WHERE flow=$1
-			ORDER BY position ASC;
-		""", flow)
+		async with conn.transaction(isolation="repeatable_read", readonly=True):
+			data = await _fetch_flow_graph_data(conn)
+			broadcast_rows = await conn.fetch("""
+				SELECT id, title, flow, target_user_id, schedule_type, interval_days, days_of_month,
+					   at_hour, at_minute, next_run_ts, last_run_ts, is_active, created_ts
+				FROM broadcasts
+				ORDER BY id DESC;
+			""")
 
-	return [
-		{
-			"id": int(r["id"]),
-			"flow": r["flow"],
-			"position": int(r["position"]),
-			"type": r["type"],
-			"title": r["title"] or "",
-			"text": r["text"] or "",
-			"circle": r["circle_path"] or "",
-			"video": r["video_url"] or "",
-			"buttons": r["buttons_json"] or "",
-			"is_active": int(r["is_active"] or 0),
-
-			# ✅ FIX: по умолчанию 0.0 (никаких скрытых задержек)
-			"delay": float(r["delay_seconds"] or 0.0),
-
-			"file_path": r["file_path"] or "",
-			"file_kind": r["file_kind"] or "",
-			"file_name": r["file_name"] or "",
-
-			"gate_next_flow": r.get("gate_next_flow") or "",
-			"gate_button_text": r.get("gate_button_text") or "",
-			"gate_prompt_text": r.get("gate_prompt_text") or "",
-			"gate_reminder_seconds": int(r.get("gate_reminder_seconds") or 0),
-			"gate_reminder_text": r.get("gate_reminder_text") or "",
-		}
-		for r in rows
-	]
+	data["broadcasts"] = [_broadcast_row_to_dict(r) for r in broadcast_rows]
+	return data
 
 
-async def get_block(block_id: int) -> Optional[Dict]:
+# ===================== FLOW BUNDLES (export / import) =====================
+#
+# Бандл — JSON с одним или несколькими flow: блоки (без id), mode, trigger
+# и сценарии flow_actions, где after_flow входит в бандл.
+# Импорт: COPY во временные staging-таблицы + по одному set-based merge на таблицу,
+# всё в одной транзакции — flow в бандле заменяются целиком или не меняются вовсе.
+
+FLOW_BUNDLE_FORMAT = "flow-bundle"
+FLOW_BUNDLE_VERSION = 1
+
+_BUNDLE_BLOCK_COLUMNS = (
+	"flow", "position", "type", "title", "text",
+	"circle_path", "video_url", "buttons_json",
+	"is_active", "delay_seconds",
+	"file_path", "file_kind", "file_name",
+	"gate_next_flow", "gate_button_text", "gate_prompt_text", "gate_reminder_seconds", "gate_reminder_text",
+)
+_BUNDLE_ACTION_COLUMNS = ("after_flow", "action_type", "target_flow", "delay_seconds", "is_active")
+_BUNDLE_TRIGGER_COLUMNS = ("flow", "trigger", "offset_seconds", "is_active")
+_BUNDLE_MODE_COLUMNS = ("flow", "mode")
+
+
+async def export_flow_bundle(flows: Optional[List[str]] = None) -> Dict:
+	"""
+	flows=None -> все flow. Один снапшот (REPEATABLE READ), порядок flow — как в CRM.
+	"""
 	pool = await get_pool()
 	async with pool.acquire() as conn:
-		r = await conn.fetchrow("""
-			SELECT
-				id, flow, position, type,
-				title, text,
-				circle_path, video_url, buttons_json,
-				is_active, delay_seconds,
-				file_path, file_kind, file_name,
-				gate_next_flow, gate_button_text, gate_prompt_text, gate_reminder_seconds, gate_reminder_text
-			FROM content_blocks
-			WHERE id=$1;
-		""", int(block_id))
+		async with conn.transaction(isolation="repeatable_read", readonly=True):
+			names = [r["name"] for r in await conn.fetch("SELECT name FROM flows ORDER BY sort_order ASC;")]
+			if flows is not None:
+				wanted = {(f or "").strip() for f in flows}
+				names = [n for n in names if n in wanted]
+
+			block_rows = await conn.fetch(f"""
+				SELECT {_BLOCK_COLUMNS}
+				FROM content_blocks
+				WHERE flow = ANY($1::text[])
+				ORDER BY flow ASC, position ASC;
+			""", names)
+			mode_rows = await conn.fetch("SELECT flow, mode FROM flow_modes WHERE flow = ANY($1::text[]);", names)
+			trigger_rows = await conn.fetch("""
+				SELECT flow, trigger, offset_seconds, is_active
+				FROM flow_triggers
+				WHERE flow = ANY($1::text[]);
+			""", names)
+			action_rows = await conn.fetch("""
+				SELECT id, after_flow, action_type, target_flow, delay_seconds, is_active
+				FROM flow_actions
+				WHERE after_flow = ANY($1::text[])
+				ORDER BY after_flow ASC, id ASC;
+			""", names)
+
+	blocks: Dict[str, List[Dict]] = {n: [] for n in names}
+	for r in block_rows:
+		b = _block_row_to_dict(r)
+		del b["id"], b["flow"]
+		blocks[r["flow"]].append(b)
+
+	modes = {r["flow"]: _norm_mode(r["mode"]) for r in mode_rows}
+	triggers = {r["flow"]: _trigger_row_to_dict(r) for r in trigger_rows}
+
+	actions = []
+	for r in action_rows:
+		a = _action_row_to_dict(r)
+		del a["id"]
+		actions.append(a)
+
+	out_flows = []
+	for n in names:
+		t = triggers.get(n)
+		if t is not None:
+			t = {k: v for k, v in t.items() if k != "flow"}
+		out_flows.append({"name": n, "mode": modes.get(n, "off"), "trigger": t, "blocks": blocks[n]})
+
+	return {
+		"format": FLOW_BUNDLE_FORMAT,
+		"version": FLOW_BUNDLE_VERSION,
+		"exported_ts": int(time.time()),
+		"flows": out_flows,
+		"actions": actions,
+	}
+
+
+_INT8_MAX = 2 ** 63 - 1
+
+
+def _bundle_seconds(v, what: str) -> int:
+	# BIGINT-колонки: за пределами диапазона COPY упал бы с DataError — отклоняем заранее
+	n = int(v or 0)
+	if n < 0 or n > _INT8_MAX:
+		raise ValueError(f"{what} вне диапазона: {n}")
+	return n
+
+
+def _bundle_flag(v) -> int:
+	return 1 if int(v or 0) else 0
+
+
+def _bundle_block_record(flow: str, position: int, b: Dict) -> Tuple:
+	delay = float(b.get("delay", 0.0) or 0.0)
+	if not math.isfinite(delay) or delay < 0:
+		raise ValueError(f"delay вне диапазона: {delay}")
+	return (
+		flow, position, str(b.get("type") or "text"),
+		str(b.get("title") or ""), str(b.get("text") or ""),
+		str(b.get("circle") or ""), str(b.get("video") or ""), str(b.get("buttons") or ""),
+		_bundle_flag(b.get("is_active", 1)), delay,
+		str(b.get("file_path") or ""), str(b.get("file_kind") or ""), str(b.get("file_name") or ""),
+		str(b.get("gate_next_flow") or "").strip(), str(b.get("gate_button_text") or ""),
+		str(b.get("gate_prompt_text") or ""), _bundle_seconds(b.get("gate_reminder_seconds", 0), "gate_reminder_seconds"),
+		str(b.get("gate_reminder_text") or ""),
+	)
+
+
+def flow_bundle_records(bundle: Dict) -> Dict[str, List]:
+	"""
+	Бандл -> строки для COPY (flows, blocks, modes, triggers, actions).
+	Позиции перенумеровываются 1..n в порядке бандла. ValueError — если бандл не наш.
+	"""
+	if not isinstance(bundle, dict) or bundle.get("format") != FLOW_BUNDLE_FORMAT:
+		raise ValueError("Это не flow bundle")
+	if int(bundle.get("version") or 0) != FLOW_BUNDLE_VERSION:
+		raise ValueError(f"Неподдерживаемая версия бандла: {bundle.get('version')}")
+
+	names: List[str] = []
+	blocks: List[Tuple] = []
+	modes: List[Tuple] = []
+	triggers: List[Tuple] = []
+	for f in bundle.get("flows") or []:
+		name = str(f.get("name") or "").strip()
+		if not name or name in names:
+			raise ValueError(f"Пустое или повторяющееся имя flow: {name!r}")
+		names.append(name)
+
+		for i, b in enumerate(f.get("blocks") or [], start=1):
+			blocks.append(_bundle_block_record(name, i, b))
+
+		modes.append((name, _norm_mode(f.get("mode") or "off")))
+
+		t = f.get("trigger")
+		if t:
+			triggers.append((
+				name,
+				str(t.get("trigger") or "after_start"),
+				_bundle_seconds(t.get("offset_seconds", 0), "offset_seconds"),
+				_bundle_flag(t.get("is_active", 1)),
+			))
+
+	if not names:
+		raise ValueError("В бандле нет flow")
+
+	actions: List[Tuple] = []
+	for a in bundle.get("actions") or []:
+		after = str(a.get("after_flow") or "").strip()
+		target = str(a.get("target_flow") or "").strip()
+		if after not in names or not target:
+			continue
+		actions.append((
+			after,
+			_norm_action_type(a.get("action_type") or "start_flow"),
+			target,
+			_bundle_seconds(a.get("delay_seconds", 0), "delay_seconds"),
+			_bundle_flag(a.get("is_active", 1)),
+		))
+
+	return {"flows": names, "blocks": blocks, "modes": modes, "triggers": triggers, "actions": actions}
+
+
+async def import_flow_bundle(bundle: Dict) -> List[str]:
+	"""
+	Заменяет flow из бандла целиком (блоки, mode, trigger, исходящие actions),
+	новые flow добавляет в конец списка. Одна транзакция; возвращает имена flow.
+	"""
+	rec = flow_bundle_records(bundle)
+	names = rec["flows"]
+
+	pool = await get_pool()
+	async with pool.acquire() as conn, conn.transaction():
+		# staging: те же типы колонок, что у целевых таблиц, без ограничений; удаляются на COMMIT
+		for tmp, table, cols in (
+			("_bundle_blocks", "content_blocks", _BUNDLE_BLOCK_COLUMNS),
+			("_bundle_actions", "flow_actions", _BUNDLE_ACTION_COLUMNS),
+			("_bundle_triggers", "flow_triggers", _BUNDLE_TRIGGER_COLUMNS),
+			("_bundle_modes", "flow_modes", _BUNDLE_MODE_COLUMNS),
+		):
+			await conn.execute(
+				f"CREATE TEMP TABLE {tmp} ON COMMIT DROP AS SELECT {', '.join(cols)} FROM {table} WITH NO DATA;"
+			)
+
+		await conn.copy_records_to_table("_bundle_blocks", records=rec["blocks"], columns=list(_BUNDLE_BLOCK_COLUMNS))
+		await conn.copy_records_to_table("_bundle_actions", records=rec["actions"], columns=list(_BUNDLE_ACTION_COLUMNS))
+		await conn.copy_records_to_table("_bundle_triggers", records=rec["triggers"], columns=list(_BUNDLE_TRIGGER_COLUMNS))
+		await conn.copy_records_to_table("_bundle_modes", records=rec["modes"], columns=list(_BUNDLE_MODE_COLUMNS))
+
+		# ✅ новые flow — в конец, в порядке бандла
+		await _lock_flow_order(conn)
+		await conn.execute("""
+			INSERT INTO flows(name, sort_order)
+			SELECT f.name, mx.m + f.ord
+			FROM unnest($1::text[]) WITH ORDINALITY AS f(name, ord),
+				 (SELECT COALESCE(MAX(sort_order), 0) AS m FROM flows) mx
+			ON CONFLICT (name) DO NOTHING;
+		""", names)
+		await _lock_flows(conn, *names)
+
+		cols = ", ".join(_BUNDLE_BLOCK_COLUMNS)
+		await conn.execute("DELETE FROM content_blocks WHERE flow = ANY($1::text[]);", names)
+		await conn.execute(f"INSERT INTO content_blocks ({cols}) SELECT {cols} FROM _bundle_blocks;")
+
+		await conn.execute("""
+			INSERT INTO flow_modes(flow, mode)
+			SELECT flow, mode FROM _bundle_modes
+			ON CONFLICT (flow) DO UPDATE SET mode=EXCLUDED.mode;
+		""")
+
+		await conn.execute("DELETE FROM flow_triggers WHERE flow = ANY($1::text[]);", names)
+		await conn.execute("""
+			INSERT INTO flow_triggers(flow, trigger, offset_seconds, is_active)
+			SELECT flow, trigger, offset_seconds, is_active FROM _bundle_triggers;
+		""")
+
+		await conn.execute("DELETE FROM flow_actions WHERE after_flow = ANY($1::text[]);", names)
+		await conn.execute("""
+			INSERT INTO flow_actions(after_flow, action_type, target_flow, delay_seconds, is_active)
+			SELECT DISTINCT ON (after_flow, action_type, target_flow)
+				after_flow, action_type, target_flow, delay_seconds, is_active
+			FROM _bundle_actions
+			ORDER BY after_flow, action_type, target_flow;
+		""")
+
+		for name in names:
+			await _bump_flow_version(conn, name)
+		await _notify_config_changed(conn, "flows_imported")
+
+	return names
 
-	if not r:
-		return None
 
+# ===================== CONTENT BLOCKS =====================
+
+async def next_position(flow: str) -> int:
+	pool = await get_pool()
+	async with pool.acquire() as conn:
+		mx = await conn.fetchval("SELECT COALESCE(MAX(position), 0) FROM content_blocks WHERE flow=$1;", flow)
+		return int(mx or 0) + 1
+
+
+_BLOCK_COLUMNS = """
+	id, flow, position, type,
+	title, text,
+	circle_path, video_url, buttons_json,
+	is_active, delay_seconds,
+	file_path, file_kind, file_name,
+	gate_next_flow, gate_button_text, gate_prompt_text, gate_reminder_seconds, gate_reminder_text
+"""
+
+
+def _block_row_to_dict(r: asyncpg.Record) -> Dict:
 	return {
 		"id": int(r["id"]),
 		"flow": r["flow"],
@@ -1086,7 +2867,7 @@ async def get_block(block_id: int) -> Optional[Dict]:
 		"buttons": r["buttons_json"] or "",
 		"is_active": int(r["is_active"] or 0),
 
-		# ✅ FIX
+		# ✅ FIX: по умолчанию 0.0 (никаких скрытых задержек)
 		"delay": float(r["delay_seconds"] or 0.0),
 
 		"file_path": r["file_path"] or "",
@@ -1101,9 +2882,68 @@ async def get_block(block_id: int) -> Optional[Dict]:
 	}
 
 
-async def create_block(data: Dict) -> None:
+async def get_blocks(flow: str) -> List[Dict]:
+	pool = await get_pool()
+	async with pool.acquire() as conn:
+		rows = await conn.fetch(f"""
+			SELECT {_BLOCK_COLUMNS}
+			FROM content_blocks
+			WHERE flow=$1
+			ORDER BY position ASC;
+		""", flow)
+
+	return [_block_row_to_dict(r) for r in rows]
+
+
+async def get_blocks_versioned(flow: str) -> Tuple[int, List[Dict]]:
+	"""
+	Блоки + версия flow из одного снапшота (чтобы кеш не склеил старые блоки с новой версией).
+	"""
+	flow = (flow or "").strip()
 	pool = await get_pool()
 	async with pool.acquire() as conn:
+		async with conn.transaction(isolation="repeatable_read", readonly=True):
+			v = await conn.fetchval("SELECT version FROM flow_versions WHERE flow=$1;", flow)
+			rows = await conn.fetch(f"""
+				SELECT {_BLOCK_COLUMNS}
+				FROM content_blocks
+				WHERE flow=$1
+				ORDER BY position ASC;
+			""", flow)
+
+	return int(v or 0), [_block_row_to_dict(r) for r in rows]
+
+
+async def get_block(block_id: int) -> Optional[Dict]:
+	pool = await get_pool()
+	async with pool.acquire() as conn:
+		r = await conn.fetchrow(f"""
+			SELECT {_BLOCK_COLUMNS}
+			FROM content_blocks
+			WHERE id=$1;
+		""", int(block_id))
+
+	if not r:
+		return None
+
+	return _block_row_to_dict(r)
+
+
+async def _make_room(conn: asyncpg.Connection, flow: str, position: int, block_id: int = 0) -> None:
+	# позиция занята другим блоком -> сдвигаем его и всё ниже на +1 (один UPDATE; UNIQUE deferrable)
+	await conn.execute("""
+		UPDATE content_blocks
+		SET position = position + 1
+		WHERE flow=$1 AND position >= $2 AND id <> $3
+		  AND EXISTS (SELECT 1 FROM content_blocks WHERE flow=$1 AND position=$2 AND id <> $3);
+	""", flow, int(position), int(block_id))
+
+
+async def create_block(data: Dict) -> None:
+	pool = await get_pool()
+	async with pool.acquire() as conn, conn.transaction():
+		await _lock_flows(conn, data["flow"])
+		await _make_room(conn, data["flow"], int(data["position"]))
 		await conn.execute("""
 			INSERT INTO content_blocks
 			(flow, position, type, title, text, circle_path, video_url, buttons_json,
@@ -1128,11 +2968,15 @@ async def create_block(data: Dict) -> None:
 			int(data.get("gate_reminder_seconds", 0) or 0),
 			data.get("gate_reminder_text", ""),
 		)
+		await _bump_flow_version(conn, data["flow"])
 
 
 async def update_block(block_id: int, data: Dict) -> None:
 	pool = await get_pool()
-	async with pool.acquire() as conn:
+	async with pool.acquire() as conn, conn.transaction():
+		old_flow = await conn.fetchval("SELECT flow FROM content_blocks WHERE id=$1;", int(block_id))
+		await _lock_flows(conn, old_flow, data["flow"])
+		await _make_room(conn, data["flow"], int(data["position"]), int(block_id))
 		await conn.execute("""
 			UPDATE content_blocks
 			SET flow=$1, position=$2, type=$3,
@@ -1160,21 +3004,140 @@ async def update_block(block_id: int, data: Dict) -> None:
 			data.get("gate_reminder_text", ""),
 			int(block_id),
 		)
+		await _bump_flow_version(conn, data["flow"])
+		if old_flow and old_flow != data["flow"]:
+			await _bump_flow_version(conn, old_flow)
 
 
 async def delete_block(block_id: int) -> None:
 	pool = await get_pool()
-	async with pool.acquire() as conn:
-		await conn.execute("DELETE FROM content_blocks WHERE id=$1;", int(block_id))
+	async with pool.acquire() as conn, conn.transaction():
+		flow = await conn.fetchval("SELECT flow FROM content_blocks WHERE id=$1;", int(block_id))
+		if not flow:
+			return
+		await _lock_flows(conn, flow)
+		deleted = await conn.fetchval(
+			"DELETE FROM content_blocks WHERE id=$1 AND flow=$2 RETURNING flow;", int(block_id), flow
+		)
+		if deleted:
+			await _bump_flow_version(conn, flow)
 
 
-async def swap_positions(id_a: int, id_b: int) -> None:
+async def move_block(block_id: int, direction: str) -> bool:
+	"""
+	Обмен position с соседним блоком того же flow — один UPDATE, без get_blocks.
+	Под блокировкой flow (как остальные правки блоков); False — блока нет или конфликт позиций.
+	"""
+	if direction not in ("up", "down"):
+		return False
+	cmp, order = ("<", "DESC") if direction == "up" else (">", "ASC")
+
 	pool = await get_pool()
 	async with pool.acquire() as conn:
-		async with conn.transaction():
-			a_pos = await conn.fetchval("SELECT position FROM content_blocks WHERE id=$1;", int(id_a))
-			b_pos = await conn.fetchval("SELECT position FROM content_blocks WHERE id=$1;", int(id_b))
-			if a_pos is None or b_pos is None:
-				return
-			await conn.execute("UPDATE content_blocks SET position=$1 WHERE id=$2;", int(b_pos), int(id_a))
-			await conn.execute("UPDATE content_blocks SET position=$1 WHERE id=$2;", int(a_pos), int(id_b))
\ No newline at end of file
+		try:
+			async with conn.transaction():
+				flow = await conn.fetchval("SELECT flow FROM content_blocks WHERE id=$1;", int(block_id))
+				if not flow:
+					return False
+				await _lock_flows(conn, flow)
+				moved = await conn.fetchval(f"""
+					WITH me AS (
+						SELECT id, flow, position FROM content_blocks WHERE id=$1 AND flow=$2
+					), nb AS (
+						SELECT c.id, c.position
+						FROM content_blocks c, me
+						WHERE c.flow = me.flow AND c.position {cmp} me.position
+						ORDER BY c.position {order}
+						LIMIT 1
+					), upd AS (
+						UPDATE content_blocks c
+						SET position = s.position
+						FROM (
+							SELECT me.id, nb.position FROM me, nb
+							UNION ALL
+							SELECT nb.id, me.position FROM me, nb
+						) s
+						WHERE c.id = s.id
+						RETURNING c.flow
+					)
+					SELECT flow FROM upd LIMIT 1;
+				""", int(block_id), flow)
+				if moved:
+					await _bump_flow_version(conn, flow)
+		except asyncpg.UniqueViolationError:
+			return False
+	return bool(moved)
+
+
+async def reorder_blocks(flow: str, block_ids: List[int]) -> bool:
+	"""
+	Полный порядок блоков flow (drag-and-drop): position = 1..n одним UPDATE ... FROM unnest.
+	False — список устарел (не перестановка всех блоков flow: блок добавили/удалили/перенесли),
+	ничего не меняем. Добавление/удаление блоков берёт ту же блокировку flow.
+	"""
+	flow = (flow or "").strip()
+	ids = [int(i) for i in block_ids]
+	if len(set(ids)) != len(ids):
+		raise ValueError("duplicate block id in order")
+
+	pool = await get_pool()
+	async with pool.acquire() as conn:
+		try:
+			async with conn.transaction():
+				await _lock_flows(conn, flow)
+				same = await conn.fetchval("""
+					SELECT COUNT(*) = $3 AND COALESCE(bool_and(id = ANY($2::bigint[])), TRUE)
+					FROM content_blocks
+					WHERE flow = $1;
+				""", flow, ids, len(ids))
+				if not same:
+					return False
+				status = await conn.execute("""
+					UPDATE content_blocks c
+					SET position = o.pos
+					FROM unnest($2::bigint[], $3::int[]) AS o(id, pos)
+					WHERE c.id = o.id AND c.flow = $1 AND c.position <> o.pos;
+				""", flow, ids, list(range(1, len(ids) + 1)))
+				if _affected(status):
+					await _bump_flow_version(conn, flow)
+		except asyncpg.UniqueViolationError:
+			return False
+	return True
+
+
+BLOCK_BULK_OPS = ("enable", "disable", "delete", "delay")
+
+
+async def bulk_update_blocks(flow: str, block_ids: List[int], op: str, delay_seconds: float = 0.0) -> int:
+	"""
+	Массовая операция над выбранными блоками flow — один statement.
+	id из чужого flow игнорируются. Возвращает число изменённых блоков.
+	"""
+	flow = (flow or "").strip()
+	ids = [int(i) for i in block_ids]
+	if op not in BLOCK_BULK_OPS or not ids:
+		return 0
+
+	pool = await get_pool()
+	async with pool.acquire() as conn, conn.transaction():
+		await _lock_flows(conn, flow)
+		if op == "delete":
+			status = await conn.execute(
+				"DELETE FROM content_blocks WHERE flow=$1 AND id = ANY($2::bigint[]);",
+				flow, ids,
+			)
+		elif op == "delay":
+			status = await conn.execute("""
+				UPDATE content_blocks SET delay_seconds=$3
+				WHERE flow=$1 AND id = ANY($2::bigint[]) AND delay_seconds IS DISTINCT FROM $3;
+			""", flow, ids, max(0.0, float(delay_seconds or 0.0)))
+		else:
+			status = await conn.execute("""
+				UPDATE content_blocks SET is_active=$3
+				WHERE flow=$1 AND id = ANY($2::bigint[]) AND is_active IS DISTINCT FROM $3;
+			""", flow, ids, 1 if op == "enable" else 0)
+
+		n = _affected(status)
+		if n:
+			await _bump_flow_version(conn, flow)
+	return n
@@ -0,0 +1,271 @@
+# flow_graph.py
+#
+# Граф переходов между flow:
+#   - auto-рёбра: flow_actions (after_flow -> target_flow через delay_seconds).
+#     Срабатывают только если flow дошёл до конца, т.е. в нём нет активного gate.
+#   - gate-рёбра: content_blocks.gate_next_flow — переход только по кнопке юзера.
+#
+# Опасно только кольцо из auto-рёбер: каждый юзер будет бесконечно порождать jobs.
+# Кольцо с нулевой суммарной задержкой — это job storm, такие правки CRM отклоняет.
+import heapq
+from typing import Dict, List, Optional, Set, Tuple
+
+
+class FlowGraph:
+	__slots__ = ("flows", "duration", "gated", "auto_edges", "gate_edges", "roots")
+
+	def __init__(self):
+		self.flows: Set[str] = set()
+		self.duration: Dict[str, int] = {}                              # сумма delay блоков до конца/до gate
+		self.gated: Set[str] = set()                                    # flow останавливается на gate
+		self.auto_edges: Dict[str, List[Tuple[str, int, int]]] = {}     # after -> [(target, delay, action_id)]
+		self.gate_edges: Dict[str, List[Tuple[str, int]]] = {}          # flow -> [(next_flow, block_id)]
+		self.roots: Dict[str, int] = {}                                 # flow -> offset после /start
+
+	def fires_actions(self, flow: str) -> bool:
+		return flow not in self.gated
+
+	def edge_weight(self, after: str, delay: int) -> int:
+		return int(self.duration.get(after, 0)) + max(0, int(delay or 0))
+
+
+class FlowCycle:
+	__slots__ = ("flows", "min_delay")
+
+	def __init__(self, flows: List[str], min_delay: int):
+		self.flows = flows
+		self.min_delay = min_delay
+
+	@property
+	def is_zero_delay(self) -> bool:
+		return self.min_delay <= 0
+
+	def describe(self) -> str:
+		path = " → ".join(self.flows + self.flows[:1])
+		if self.is_zero_delay:
+			return f"Бесконечный цикл без задержки: {path}"
+		return f"Цикл (повтор каждые ≥{self.min_delay}s): {path}"
+
+
+def build_flow_graph(
+	flows: List[str],
+	blocks: List[Dict],
+	actions: List[Dict],
+	triggers: Optional[List[Dict]] = None,
+	modes: Optional[Dict[str, str]] = None,
+) -> FlowGraph:
+	"""
+	blocks: активные и неактивные блоки (flow, position, is_active, delay, gate_next_flow, id).
+	actions: строки flow_actions. triggers/modes — чтобы знать корни (auto после /start).
+	"""
+	g = FlowGraph()
+	g.flows.update((f or "").strip() for f in flows if (f or "").strip())
+
+	for b in sorted(blocks, key=lambda x: (x.get("flow") or "", int(x.get("position") or 0))):
+		flow = (b.get("flow") or "").strip()
+		if not flow:
+			continue
+		g.flows.add(flow)
+		if not int(b.get("is_active") or 0) or flow in g.gated:
+			continue
+
+		try:
+			delay = max(0, int(float(b.get("delay") or 0)))
+		except (TypeError, ValueError):
+			delay = 0
+		g.duration[flow] = g.duration.get(flow, 0) + delay
+
+		next_flow = (b.get("gate_next_flow") or "").strip()
+		if next_flow:
+			g.gated.add(flow)
+			g.flows.add(next_flow)
+			g.gate_edges.setdefault(flow, []).append((next_flow, int(b.get("id") or 0)))
+
+	for a in actions:
+		if not int(a.get("is_active") or 0):
+			continue
+		if (a.get("action_type") or "start_flow") != "start_flow":
+			continue
+		after = (a.get("after_flow") or "").strip()
+		target = (a.get("target_flow") or "").strip()
+		if not after or not target:
+			continue
+		g.flows.update((after, target))
+		g.auto_edges.setdefault(after, []).append(
+			(target, max(0, int(a.get("delay_seconds") or 0)), int(a.get("id") or 0))
+		)
+
+	modes = modes or {}
+	for t in triggers or []:
+		flow = (t.get("flow") or "").strip()
+		if not flow or not int(t.get("is_active") or 0):
+			continue
+		if (modes.get(flow) or "off") != "auto":
+			continue
+		g.roots[flow] = max(0, int(t.get("offset_seconds") or 0))
+		g.flows.add(flow)
+
+	return g
+
+
+def _live_auto_edges(g: FlowGraph) -> Dict[str, List[Tuple[str, int]]]:
+	"""auto-рёбра, которые реально сработают: flow без gate, вес = длительность flow + delay."""
+	out: Dict[str, List[Tuple[str, int]]] = {}
+	for after, edges in g.auto_edges.items():
+		if not g.fires_actions(after):
+			continue
+		out[after] = [(target, g.edge_weight(after, delay)) for target, delay, _ in edges]
+	return out
+
+
+def _strongly_connected(nodes: Set[str], edges: Dict[str, List[Tuple[str, int]]]) -> List[List[str]]:
+	# Tarjan, итеративно (без рекурсии — глубина графа не ограничена)
+	index: Dict[str, int] = {}
+	low: Dict[str, int] = {}
+	on_stack: Set[str] = set()
+	stack: List[str] = []
+	out: List[List[str]] = []
+	counter = 0
+
+	for root in sorted(nodes):
+		if root in index:
+			continue
+		work = [(root, 0)]
+		while work:
+			v, i = work.pop()
+			if i == 0:
+				index[v] = low[v] = counter
+				counter += 1
+				stack.append(v)
+				on_stack.add(v)
+			succ = edges.get(v, [])
+			if i < len(succ):
+				work.append((v, i + 1))
+				w = succ[i][0]
+				if w not in index:
+					work.append((w, 0))
+				elif w in on_stack:
+					low[v] = min(low[v], index[w])
+				continue
+			if low[v] == index[v]:
+				comp = []
+				while True:
+					w = stack.pop()
+					on_stack.discard(w)
+					comp.append(w)
+					if w == v:
+						break
+				out.append(comp)
+			if work:
+				parent = work[-1][0]
+				low[parent] = min(low[parent], low[v])
+	return out
+
+
+def _shortest(edges: Dict[str, List[Tuple[str, int]]], sources: Dict[str, int], allowed: Optional[Set[str]] = None) -> Dict[str, int]:
+	dist: Dict[str, int] = {}
+	heap = [(d, f) for f, d in sources.items()]
+	heapq.heapify(heap)
+	while heap:
+		d, v = heapq.heappop(heap)
+		if v in dist:
+			continue
+		dist[v] = d
+		for w, wt in edges.get(v, []):
+			if allowed is not None and w not in allowed:
+				continue
+			if w not in dist:
+				heapq.heappush(heap, (d + wt, w))
+	return dist
+
+
+def find_auto_cycles(g: FlowGraph) -> List[FlowCycle]:
+	edges = _live_auto_edges(g)
+	cycles: List[FlowCycle] = []
+
+	for comp in _strongly_connected(g.flows, edges):
+		members = set(comp)
+		if len(comp) == 1:
+			v = comp[0]
+			self_loops = [wt for w, wt in edges.get(v, []) if w == v]
+			if not self_loops:
+				continue
+			cycles.append(FlowCycle([v], min(self_loops)))
+			continue
+
+		# минимальная длина кольца внутри компоненты: v -> ... -> v
+		best = None
+		best_flow = comp[0]
+		for v in comp:
+			starts = {w: wt for w, wt in edges.get(v, []) if w in members}
+			back = None
+			for w, d in _shortest(edges, starts, members).items():
+				for x, wt in edges.get(w, []):
+					if x == v:
+						total = d + wt
+						back = total if back is None else min(back, total)
+			if back is not None and (best is None or back < best):
+				best, best_flow = back, v
+
+		order = _cycle_order(best_flow, members, edges)
+		cycles.append(FlowCycle(order, int(best or 0)))
+
+	cycles.sort(key=lambda c: (c.min_delay, c.flows))
+	return cycles
+
+
+def _cycle_order(start: str, members: Set[str], edges: Dict[str, List[Tuple[str, int]]]) -> List[str]:
+	# один из путей start -> ... -> start по компоненте (для понятного сообщения в CRM)
+	prev: Dict[str, str] = {}
+	queue = [start]
+	seen = {start}
+	while queue:
+		v = queue.pop(0)
+		for w, _ in edges.get(v, []):
+			if w not in members:
+				continue
+			if w == start:
+				path = [v]
+				while path[-1] != start:
+					path.append(prev[path[-1]])
+				return list(reversed(path))
+			if w not in seen:
+				seen.add(w)
+				prev[w] = v
+				queue.append(w)
+	return [start]
+
+
+def expected_start_offsets(g: FlowGraph) -> Dict[str, int]:
+	"""
+	Самое раннее время старта каждого flow (секунды после /start) по auto-путям.
+	Gate-переходы зависят от юзера и сюда не входят.
+	"""
+	return _shortest(_live_auto_edges(g), dict(g.roots))
+
+
+def reachable_flows(g: FlowGraph, include_gates: bool = True, extra_roots: Optional[Set[str]] = None) -> Set[str]:
+	"""
+	Flow, до которых юзер может дойти: от auto-корней (и extra_roots, например
+	flow активных broadcasts) по auto-рёбрам и, если include_gates, по кнопкам gate.
+	"""
+	edges: Dict[str, Set[str]] = {}
+	for after, items in _live_auto_edges(g).items():
+		edges.setdefault(after, set()).update(t for t, _ in items)
+	if include_gates:
+		for flow, items in g.gate_edges.items():
+			edges.setdefault(flow, set()).update(t for t, _ in items)
+
+	seen: Set[str] = set()
+	stack = list(g.roots) + sorted(extra_roots or ())
+	while stack:
+		v = stack.pop()
+		if v in seen:
+			continue
+		seen.add(v)
+		stack.extend(edges.get(v, ()))
+	return seen
+
+
+def zero_delay_cycles(g: FlowGraph) -> List[FlowCycle]:
+	return [c for c in find_auto_cycles(g) if c.is_zero_delay]